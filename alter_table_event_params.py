@@ -1,10 +1,28 @@
-from google.cloud import bigquery
-from google.cloud.exceptions import NotFound
-from config import WRITE_PROJECT_ID, TEMP_TABLE, TEMP_DATASET, PROCESSED_TABLE_ID
+import random
+import time
+from google.api_core.exceptions import (
+    Forbidden,
+    InternalServerError,
+    ServiceUnavailable,
+    TooManyRequests
+)
+import metrics
+from clients import get_bigquery_client
+from properties import get_property
+from schema_cache import record_added_columns
+from config import (
+    PARAM_SOURCES,
+    ALTER_MAX_COLUMNS_PER_STATEMENT,
+    ALTER_MIN_INTERVAL_SECONDS,
+    ALTER_MAX_ATTEMPTS,
+    ALTER_BACKOFF_BASE_SECONDS,
+    ALTER_BACKOFF_MAX_SECONDS
+)
 
-def alter_processed_table_with_missing_event_params():
-    print("Initializing BigQuery client.")
-    client = bigquery.Client(project=WRITE_PROJECT_ID)
+def alter_processed_table_with_missing_event_params(missing_fields, prop=None):
+    prop = prop or get_property()
+    processed_table_id = prop["processed_table_id"]
+    client = get_bigquery_client(prop["write_project_id"])
 
     # -------------------------------
     # Data Type Mapping
@@ -19,54 +37,37 @@ def alter_processed_table_with_missing_event_params():
         "BOOLEAN": "BOOL"
     }
 
-    # -------------------------------
-    # Check if Temporary Table Exists
-    # -------------------------------
-    temp_table_ref_str = f"{WRITE_PROJECT_ID}.{TEMP_DATASET}.{TEMP_TABLE}"
-    print(f"Checking if temp table exists: {temp_table_ref_str}")
-    try:
-        client.get_table(temp_table_ref_str)
-    except NotFound:
-        print(f"Temp table not found: {temp_table_ref_str}")
-        return {
-            "status": "Error",
-            "message": f"Temp table `{temp_table_ref_str}` not found"
-        }
-
-    # -------------------------------
-    # Read Schema Differences
-    # -------------------------------
-    print("Reading missing field definitions from temp table.")
-    query = f"""
-        SELECT field_name, field_type
-        FROM `{temp_table_ref_str}`
-        WHERE field_name IS NOT NULL AND field_type IS NOT NULL
-    """
-    try:
-        result = client.query(query).result()
-    except Exception as e:
-        print(f"Failed to query temp table: {e}")
-        raise
-
     alter_statements = []
+    added_columns = []
     skipped_fields = []
+    record_fields = []
 
     # -------------------------------
     # Process Each Missing Field
     # -------------------------------
-    for row in result:
-        raw_name = row["field_name"]
-        raw_type = row["field_type"].upper().strip()
+    for field in missing_fields:
+        raw_name = field.get("field_name")
+        raw_type = (field.get("field_type") or "").upper().strip()
+        if not raw_name or not raw_type:
+            continue
 
         if raw_type not in TYPE_MAPPING:
             print(f"Skipping unknown type: {raw_type} for field: {raw_name}")
             skipped_fields.append(f"{raw_name} (type: {raw_type})")
             continue
 
-        new_column = f"{raw_name}_event_param"
+        source = field.get("source") or "event_params"
+        if PARAM_SOURCES[source].get("record"):
+            # Item params have one value per item, not per event, so they get
+            # no top-level column. Dataform adds them to the items record
+            # from config.js.
+            record_fields.append(field)
+            continue
+        new_column = f"{raw_name}{PARAM_SOURCES[source]['column_suffix']}"
         mapped_type = TYPE_MAPPING[raw_type]
         alter_stmt = f"ADD COLUMN IF NOT EXISTS `{new_column}` {mapped_type}"
         alter_statements.append(alter_stmt)
+        added_columns.append((source, raw_name))
 
     if not alter_statements:
         msg = "No valid new fields to add."
@@ -75,36 +76,115 @@ def alter_processed_table_with_missing_event_params():
             msg += f" Skipped: {', '.join(skipped_fields)}"
         return {
             "status": "No changes",
-            "message": msg
+            "message": msg,
+            "applied_fields": record_fields
         }
 
     # -------------------------------
-    # Construct ALTER TABLE Statement
+    # Execute ALTER TABLE in Chunks
     # -------------------------------
+    chunks = [
+        (alter_statements[i:i + ALTER_MAX_COLUMNS_PER_STATEMENT],
+         added_columns[i:i + ALTER_MAX_COLUMNS_PER_STATEMENT])
+        for i in range(0, len(alter_statements), ALTER_MAX_COLUMNS_PER_STATEMENT)
+    ]
+    print(f"Adding {len(alter_statements)} columns to {processed_table_id} in {len(chunks)} chunk(s).")
+
+    chunk_results = []
+    applied_columns = []
+    job_ids_by_field = {}
+    failure = None
+    last_submitted = None
+    with metrics.timed("alter_table"):
+        for index, (statements, columns) in enumerate(chunks):
+            if last_submitted is not None:
+                # Stay under the per-table metadata update rate between chunks.
+                wait = ALTER_MIN_INTERVAL_SECONDS - (time.monotonic() - last_submitted)
+                if wait > 0:
+                    time.sleep(wait)
+            last_submitted = time.monotonic()
+            try:
+                chunk_result = run_alter_chunk(client, processed_table_id, statements, index)
+            except Exception as e:
+                print(f"ALTER TABLE chunk {index + 1}/{len(chunks)} failed: {e}")
+                failure = {"chunk": index, "error": str(e)}
+                break
+            chunk_results.append(chunk_result)
+            applied_columns.extend(columns)
+            job_ids_by_field.update({f"{source}.{name}": chunk_result["job_id"] for source, name in columns})
+            # Keep the schema snapshot current chunk by chunk, so a retry
+            # after a failure only diffs the columns still missing.
+            record_added_columns(prop, columns, chunk_result["ended"])
+
+    if failure and not chunk_results:
+        raise Exception(f"ALTER TABLE failed on chunk 1/{len(chunks)}: {failure['error']}")
+
+    print(f"Altered table {processed_table_id}: {len(applied_columns)} of {len(alter_statements)} columns added.")
+    if skipped_fields:
+        print(f"Skipped fields: {skipped_fields}")
+
+    applied = set(applied_columns)
+    return {
+        # A partial result still lists applied_fields so the config update
+        # only references columns that exist.
+        "status": "Partial" if failure else "Success",
+        "added_fields": len(applied_columns),
+        "applied_fields": [
+            field for field in missing_fields
+            if ((field.get("source") or "event_params"), field.get("field_name")) in applied
+            or field in record_fields
+        ],
+        "executed_sql": "\n".join(chunk["sql"] for chunk in chunk_results),
+        "skipped_fields": skipped_fields,
+        "job_id": chunk_results[-1]["job_id"],
+        "job_ids_by_field": job_ids_by_field,
+        "chunks": [
+            {key: value for key, value in chunk.items() if key not in ("sql", "ended")}
+            for chunk in chunk_results
+        ],
+        "total_chunks": len(chunks),
+        "failure": failure
+    }
+
+def is_retryable_alter_error(error):
+    if isinstance(error, (TooManyRequests, ServiceUnavailable, InternalServerError)):
+        return True
+    # Table metadata update quota errors surface as 403 rateLimitExceeded.
+    return isinstance(error, Forbidden) and "rateLimitExceeded" in str(error)
+
+def run_alter_chunk(client, processed_table_id, statements, index):
     newline_indent = ',\n    '
     alter_sql = f"""
-        ALTER TABLE `{PROCESSED_TABLE_ID}`
-        {newline_indent.join(alter_statements)}
+        ALTER TABLE `{processed_table_id}`
+        {newline_indent.join(statements)}
     """
-    print("Executing ALTER TABLE statement:")
+    print(f"Executing ALTER TABLE chunk {index + 1} ({len(statements)} columns):")
     print(alter_sql)
 
-    try:
-        job = client.query(alter_sql)
-        job.result()
-    except Exception as e:
-        print(f"ALTER TABLE job failed: {e}")
-        raise
+    for attempt in range(1, ALTER_MAX_ATTEMPTS + 1):
+        start = time.perf_counter()
+        try:
+            job = client.query(alter_sql)
+            job.result()
+            break
+        except Exception as e:
+            if attempt == ALTER_MAX_ATTEMPTS or not is_retryable_alter_error(e):
+                raise
+            delay = min(ALTER_BACKOFF_MAX_SECONDS, ALTER_BACKOFF_BASE_SECONDS * 2 ** (attempt - 1))
+            delay *= random.uniform(0.5, 1.0)
+            print(f"ALTER TABLE chunk {index + 1} hit a retryable error (attempt {attempt}): {e}. "
+                  f"Retrying in {delay:.1f}s.")
+            time.sleep(delay)
 
-    print(f"Successfully altered table: {PROCESSED_TABLE_ID}")
+    elapsed_ms = round((time.perf_counter() - start) * 1000, 1)
+    metrics.record_query_job(f"alter_table_chunk_{index + 1}", job)
     print(f"BigQuery Job ID: {job.job_id}")
-    if skipped_fields:
-        print(f"Skipped fields: {skipped_fields}")
-
     return {
-        "status": "Success",
-        "added_fields": len(alter_statements),
-        "executed_sql": alter_sql,
-        "skipped_fields": skipped_fields,
-        "job_id": job.job_id
+        "chunk": index,
+        "columns": len(statements),
+        "job_id": job.job_id,
+        "attempts": attempt,
+        "elapsed_ms": elapsed_ms,
+        "sql": alter_sql,
+        "ended": job.ended,
     }
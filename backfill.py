@@ -0,0 +1,271 @@
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from google.cloud import bigquery
+from google.api_core.exceptions import NotFound
+import metrics
+from clients import get_bigquery_client
+from properties import get_property, get_state_table_id
+from resilience import remaining_seconds
+from config import (
+    RAW_TABLE_PATTERN,
+    PARAM_SOURCES,
+    BACKFILL_MAX_DAYS,
+    BACKFILL_MAX_CONCURRENT_JOBS,
+    BACKFILL_MAX_BYTES_BILLED,
+    BACKFILL_PARTITION_COLUMN,
+    BACKFILL_JOIN_KEYS,
+    BACKFILL_STATE_TABLE,
+    BACKFILL_MIN_REMAINING_SECONDS
+)
+
+# -------------------------------
+# Backfill progress log
+# -------------------------------
+# Every (column, partition) to backfill is appended to the state table as
+# "pending" and again as "done" or "skipped" once its DML job finishes. The
+# latest row per (column_name, table_suffix) wins, so a run that times out or
+# fails leaves its remaining partitions pending and the next run resumes them.
+# After each run, entries that are finished or superseded are deleted, so the
+# table only holds the latest row of unfinished work.
+# A run also stops starting partition jobs once less than
+# BACKFILL_MIN_REMAINING_SECONDS of the run deadline is left, and starts none
+# while a Dataform invocation (which writes the same table) is in flight.
+
+STATE_TABLE_SCHEMA = [
+    bigquery.SchemaField("column_name", "STRING"),
+    bigquery.SchemaField("source", "STRING"),
+    bigquery.SchemaField("param_key", "STRING"),
+    bigquery.SchemaField("field_type", "STRING"),
+    bigquery.SchemaField("table_suffix", "STRING"),
+    bigquery.SchemaField("status", "STRING"),
+    bigquery.SchemaField("job_id", "STRING"),
+    bigquery.SchemaField("updated_at", "TIMESTAMP"),
+]
+
+# Sources whose params live on the event row. Item params are per item, so
+# there is no single value to write back to an event row.
+BACKFILL_SOURCES = ["event_params", "user_properties"]
+
+# Value extraction per target column type, over a key/value struct `param`.
+VALUE_SQL = {
+    "STRING": "COALESCE(param.value.string_value, CAST(param.value.int_value AS STRING), "
+              "CAST(param.value.double_value AS STRING), CAST(param.value.float_value AS STRING))",
+    "INT64": "COALESCE(param.value.int_value, SAFE_CAST(param.value.string_value AS INT64))",
+    "FLOAT64": "COALESCE(param.value.double_value, param.value.float_value, "
+               "CAST(param.value.int_value AS FLOAT64), SAFE_CAST(param.value.string_value AS FLOAT64))",
+    "BOOL": "SAFE_CAST(param.value.string_value AS BOOL)",
+}
+
+def _append_state(client, prop, rows):
+    if not rows:
+        return
+    now = datetime.now(timezone.utc).isoformat()
+    job_config = bigquery.LoadJobConfig(
+        schema=STATE_TABLE_SCHEMA,
+        write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+    )
+    client.load_table_from_json(
+        [{**row, "updated_at": now} for row in rows], get_state_table_id(prop, BACKFILL_STATE_TABLE), job_config=job_config
+    ).result()
+
+def _load_pending(client, prop):
+    query = f"""
+        SELECT column_name, source, param_key, field_type, table_suffix
+        FROM `{get_state_table_id(prop, BACKFILL_STATE_TABLE)}`
+        WHERE TRUE
+        QUALIFY ROW_NUMBER() OVER (
+            PARTITION BY column_name, table_suffix ORDER BY updated_at DESC
+        ) = 1 AND status = 'pending'
+    """
+    try:
+        job = client.query(query)
+        rows = list(job.result())
+    except NotFound:
+        return []
+    metrics.record_query_job("load_backfill_state", job)
+    return [dict(row.items()) for row in rows]
+
+def _prune_state(client, prop):
+    table_id = get_state_table_id(prop, BACKFILL_STATE_TABLE)
+    query = f"""
+        DELETE FROM `{table_id}` AS t
+        WHERE EXISTS (
+            SELECT 1
+            FROM (
+                SELECT column_name, table_suffix, status, updated_at
+                FROM `{table_id}`
+                WHERE TRUE
+                QUALIFY ROW_NUMBER() OVER (
+                    PARTITION BY column_name, table_suffix ORDER BY updated_at DESC
+                ) = 1
+            ) AS latest
+            WHERE latest.column_name = t.column_name
+              AND latest.table_suffix = t.table_suffix
+              AND (latest.status IN ('done', 'skipped') OR t.updated_at < latest.updated_at)
+        )
+    """
+    job = client.query(query)
+    job.result()
+    metrics.record_query_job("prune_backfill_state", job)
+    return job.num_dml_affected_rows
+
+# -------------------------------
+# Partition DML
+# -------------------------------
+def _quote(value):
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+def build_backfill_sql(prop, suffix, columns):
+    raw_table = f"{prop['raw_project_id']}.{prop['raw_dataset']}.{RAW_TABLE_PATTERN.rstrip('*')}{suffix}"
+    keys = ", ".join(BACKFILL_JOIN_KEYS)
+    values = ",\n                        ".join(
+        f"(SELECT ANY_VALUE({VALUE_SQL.get(c['field_type'], VALUE_SQL['STRING'])}) "
+        f"FROM UNNEST(e.{c['source']}) AS param WHERE param.key = {_quote(c['param_key'])}) "
+        f"AS `{c['column_name']}`"
+        for c in columns
+    )
+    aggregates = ",\n                ".join(f"ANY_VALUE(`{c['column_name']}`) AS `{c['column_name']}`" for c in columns)
+    assignments = ",\n            ".join(f"`{c['column_name']}` = s.`{c['column_name']}`" for c in columns)
+    # NULL-safe, so events without a user_pseudo_id (consent mode) are
+    # matched as well.
+    join = "\n          AND ".join(f"t.{key} IS NOT DISTINCT FROM s.{key}" for key in BACKFILL_JOIN_KEYS)
+    # Rows are collapsed to one per join key, since UPDATE ... FROM fails if a
+    # target row matches more than one source row.
+    return f"""
+        UPDATE `{prop['processed_table_id']}` AS t
+        SET
+            {assignments}
+        FROM (
+            SELECT
+                {keys},
+                {aggregates}
+            FROM (
+                SELECT
+                    {keys},
+                        {values}
+                FROM `{raw_table}` AS e
+            )
+            GROUP BY {keys}
+        ) AS s
+        WHERE t.{BACKFILL_PARTITION_COLUMN} = PARSE_DATE('%Y%m%d', '{suffix}')
+          AND {join}
+    """
+
+def _backfill_partition(client, prop, suffix, columns):
+    sql = build_backfill_sql(prop, suffix, columns)
+    job_config = bigquery.QueryJobConfig(maximum_bytes_billed=BACKFILL_MAX_BYTES_BILLED)
+    try:
+        job = client.query(sql, job_config=job_config)
+        job.result()
+    except NotFound as e:
+        # The raw shard is not there (not exported yet or expired), so there
+        # is nothing to copy; newly processed days get the column from Dataform.
+        print(f"Raw shard for {suffix} not found; skipping backfill: {e}")
+        return {"table_suffix": suffix, "status": "skipped", "job_id": None, "columns": len(columns)}
+    metrics.record_query_job(f"backfill_{suffix}", job)
+    print(f"Backfilled {len(columns)} columns for partition {suffix} (job {job.job_id}).")
+    return {
+        "table_suffix": suffix,
+        "status": "done",
+        "job_id": job.job_id,
+        "columns": len(columns),
+        "rows_updated": job.num_dml_affected_rows,
+    }
+
+# -------------------------------
+# Backfill Entry Point
+# -------------------------------
+def backfill_new_columns(applied_fields, prop=None, dataform_running=False):
+    prop = prop or get_property()
+    client = get_bigquery_client(prop["write_project_id"])
+
+    # Register the new columns for the last BACKFILL_MAX_DAYS partitions.
+    today = datetime.utcnow().date()
+    suffixes = [(today - timedelta(days=i)).strftime("%Y%m%d") for i in range(BACKFILL_MAX_DAYS)]
+    new_rows = []
+    skipped_fields = []
+    for field in applied_fields:
+        source = field.get("source") or "event_params"
+        if source not in BACKFILL_SOURCES:
+            skipped_fields.append(f"{source}.{field['field_name']}")
+            continue
+        column_name = f"{field['field_name']}{PARAM_SOURCES[source]['column_suffix']}"
+        for suffix in suffixes:
+            new_rows.append({
+                "column_name": column_name,
+                "source": source,
+                "param_key": field["field_name"],
+                "field_type": (field.get("field_type") or "STRING").upper(),
+                "table_suffix": suffix,
+                "status": "pending",
+                "job_id": None,
+            })
+    if skipped_fields:
+        print(f"Not backfilling item params: {skipped_fields}")
+    with metrics.timed("register_backfill"):
+        _append_state(client, prop, new_rows)
+
+    # Pending work includes partitions left over from earlier runs.
+    with metrics.timed("load_backfill_state"):
+        pending = _load_pending(client, prop)
+    by_suffix = {}
+    for row in pending:
+        by_suffix.setdefault(row["table_suffix"], []).append(row)
+    if not by_suffix:
+        print("No partitions pending backfill.")
+        return {"status": "No changes", "partitions": []}
+    if dataform_running:
+        # Partition DML would conflict with Dataform's writes to the table.
+        print(f"Dataform invocation in flight. Leaving {len(by_suffix)} partitions pending backfill.")
+        return {"status": "Deferred", "partitions": [], "pending": len(by_suffix), "skipped_fields": skipped_fields}
+    print(f"Backfilling {len(pending)} column partitions across {len(by_suffix)} partitions.")
+
+    def run_partition(suffix):
+        columns = by_suffix[suffix]
+        remaining = remaining_seconds()
+        if remaining is not None and remaining < BACKFILL_MIN_REMAINING_SECONDS:
+            # Left pending in the state table for the next run.
+            return {"table_suffix": suffix, "status": "deferred", "job_id": None, "columns": len(columns)}
+        try:
+            result = _backfill_partition(client, prop, suffix, columns)
+        except Exception as e:
+            print(f"Backfill of partition {suffix} failed: {e}")
+            return {"table_suffix": suffix, "status": "failed", "error": str(e), "columns": len(columns)}
+        _append_state(client, prop, [
+            {**column, "status": result["status"], "job_id": result["job_id"]} for column in columns
+        ])
+        return result
+
+    # BigQuery runs at most a couple of mutating DML jobs per table at once
+    # and queues the rest, so the cap keeps jobs from piling up in the queue.
+    with metrics.timed("backfill_partitions"):
+        with ThreadPoolExecutor(max_workers=max(1, BACKFILL_MAX_CONCURRENT_JOBS)) as executor:
+            futures = [
+                executor.submit(contextvars.copy_context().run, run_partition, suffix)
+                for suffix in sorted(by_suffix, reverse=True)
+            ]
+        partitions = [future.result() for future in futures]
+
+    failed = [p for p in partitions if p["status"] == "failed"]
+    deferred = sum(1 for p in partitions if p["status"] == "deferred")
+    if deferred:
+        print(f"Run deadline near. Left {deferred} partitions pending backfill for the next run.")
+    pruned = None
+    if any(p["status"] in ("done", "skipped") for p in partitions):
+        try:
+            with metrics.timed("prune_backfill_state"):
+                pruned = _prune_state(client, prop)
+        except Exception as e:
+            # Pruning only keeps the table small; the latest row still wins.
+            print(f"[WARN] Failed to prune backfill state: {e}")
+    return {
+        "status": "Partial" if failed else "Success",
+        "partitions": partitions,
+        "completed": sum(1 for p in partitions if p["status"] == "done"),
+        "skipped": sum(1 for p in partitions if p["status"] == "skipped"),
+        "failed": len(failed),
+        "deferred": deferred,
+        "pruned_state_rows": pruned,
+        "skipped_fields": skipped_fields,
+    }
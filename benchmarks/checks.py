@@ -0,0 +1,143 @@
+import sys
+import time
+
+# Run from the repository root: python -m benchmarks.checks
+# Behaviour checks for the local stand-ins (trigger_control's local backend
+# and pull_worker.InMemoryQueue). The pipeline itself is replaced by a stub,
+# so no remote service is called.
+
+import properties
+import trigger_control
+from pipeline import run_coalesced_pipelines
+from pull_worker import InMemoryQueue, collect_batch, process_batch
+from benchmarks.run import base_overrides, overridden
+
+OTHER_PROPERTY_ID = "999000000"
+
+def _overrides(**extra):
+    return {**base_overrides(0), **extra}
+
+def _reset_trigger_state():
+    with trigger_control._local_lock:
+        trigger_control._local_seen.clear()
+        trigger_control._local_leases.clear()
+        trigger_control._local_pending.clear()
+        trigger_control._local_coalesced.clear()
+
+# -------------------------------
+# Lease
+# -------------------------------
+def check_lease_expiry_and_takeover():
+    _reset_trigger_state()
+    property_id = properties.get_property()["property_id"]
+    with overridden(_overrides(TRIGGER_LEASE_TTL_SECONDS=0.2)):
+        first = trigger_control.acquire_lease(property_id, "first")
+        assert first is not None, "an unheld lease is acquired"
+        assert trigger_control.acquire_lease(property_id, "second") is None, "a held lease is not acquired"
+        time.sleep(0.3)
+        second = trigger_control.acquire_lease(property_id, "second")
+        assert second is not None, "an expired lease is taken over"
+        # The first holder's late release must not free the new holder's lease.
+        trigger_control.release_lease(property_id, first)
+        assert trigger_control.acquire_lease(property_id, "third") is None, "a stale release keeps the new lease"
+        trigger_control.release_lease(property_id, second)
+        assert trigger_control.acquire_lease(property_id, "third") is not None, "a released lease is acquired"
+
+# -------------------------------
+# Coalescing
+# -------------------------------
+def check_pending_trigger_coalescing():
+    _reset_trigger_state()
+    prop = properties.get_property()
+    property_id = prop["property_id"]
+    runs = []
+    late = {}
+
+    def stub_run_pipelines(request, props, full_rescan=None, suffixes=None):
+        runs.append(suffixes)
+        if len(runs) == 1:
+            # A trigger that arrives while the first run holds the lease.
+            late.update(run_coalesced_pipelines(None, props, message_ids={property_id: ["late"]}))
+        return {p["property_id"]: {"status": "Success"} for p in props}
+
+    with overridden(_overrides(run_pipelines=stub_run_pipelines)):
+        results = run_coalesced_pipelines(
+            None, [prop], message_ids={property_id: ["first"]}, suffixes={property_id: ["20260101"]}
+        )
+        assert late[property_id]["status"] == "Coalesced", "a trigger during a run is coalesced"
+        assert results[property_id]["runs"] == 2, "the holder runs once more for the coalesced trigger"
+        assert runs == [{property_id: ["20260101"]}, None], "only the first run is narrowed to its suffixes"
+
+        # The coalesced trigger is redelivered after the follow-up covered it.
+        redelivered = run_coalesced_pipelines(None, [prop], message_ids={property_id: ["late"]})
+        assert redelivered[property_id]["status"] == "Covered", "a covered redelivery does not run again"
+        assert len(runs) == 2
+
+    # A holder that died leaves its lease to expire and the flag set, so the
+    # redelivered trigger runs.
+    _reset_trigger_state()
+    runs.clear()
+    with overridden(_overrides(run_pipelines=stub_run_pipelines, TRIGGER_LEASE_TTL_SECONDS=0.2)):
+        trigger_control.acquire_lease(property_id, "dead")
+        blocked = run_coalesced_pipelines(None, [prop], message_ids={property_id: ["orphan"]})
+        assert blocked[property_id]["status"] == "Coalesced"
+        time.sleep(0.3)
+        redelivered = run_coalesced_pipelines(None, [prop], message_ids={property_id: ["orphan"]})
+        assert redelivered[property_id]["status"] == "Success", "a trigger left by a dead holder runs"
+
+# -------------------------------
+# Pull worker batches
+# -------------------------------
+def check_batch_partial_failure():
+    _reset_trigger_state()
+    prop = properties.get_property()
+    property_id = prop["property_id"]
+    properties.REGISTERED_PROPERTIES[OTHER_PROPERTY_ID] = {**prop, "property_id": OTHER_PROPERTY_ID}
+    statuses = {property_id: "Success", OTHER_PROPERTY_ID: "Error"}
+
+    def stub_run_pipelines(request, props, full_rescan=None, suffixes=None):
+        return {p["property_id"]: {"status": statuses[p["property_id"]]} for p in props}
+
+    queue = InMemoryQueue()
+    try:
+        with overridden(_overrides(run_pipelines=stub_run_pipelines)):
+            ok = queue.publish("events_20260101", {"property_id": property_id})
+            failing = queue.publish("events_20260101", {"property_id": OTHER_PROPERTY_ID})
+            unknown = queue.publish("events_20260101", {"property_id": "404"})
+
+            summary = process_batch(queue, collect_batch(queue, wait_timeout=0))
+            acked = {m["message_id"] for m in queue.acked}
+            assert summary["status"] == "Partial Failure"
+            assert acked == {ok, unknown}, "successful and unknown-property messages are acknowledged"
+            assert trigger_control.is_message_processed(ok)
+            assert not trigger_control.is_message_processed(failing), "a failed message is not marked processed"
+
+            # The failed message is redelivered and succeeds on the next batch.
+            statuses[OTHER_PROPERTY_ID] = "Success"
+            batch = collect_batch(queue, wait_timeout=0)
+            assert [m["message_id"] for m in batch] == [failing], "only the failed message is redelivered"
+            assert process_batch(queue, batch)["status"] == "Success"
+            assert not collect_batch(queue, wait_timeout=0)
+    finally:
+        del properties.REGISTERED_PROPERTIES[OTHER_PROPERTY_ID]
+
+CHECKS = [
+    check_lease_expiry_and_takeover,
+    check_pending_trigger_coalescing,
+    check_batch_partial_failure,
+]
+
+def main():
+    failed = 0
+    for check in CHECKS:
+        try:
+            check()
+        except AssertionError as e:
+            failed += 1
+            print(f"FAIL {check.__name__}: {e}")
+            continue
+        print(f"ok   {check.__name__}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,325 @@
+import base64
+import hashlib
+import itertools
+import json
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+import requests
+from google.api_core.exceptions import NotFound
+import clients
+import metrics
+import schema_cache
+import update_dataform_config
+
+# -------------------------------
+# In-process stand-ins for GCP and GitHub
+# -------------------------------
+# The fakes are injected into the clients.py registry, so every stage runs its
+# real code path against them. Each API call sleeps for the configured
+# latency (scaled by latency_scale) and is counted per operation.
+
+DEFAULT_LATENCY_MS = {
+    "bigquery.get_table": 150,
+    "bigquery.dry_run": 300,
+    "bigquery.query": 1200,
+    "bigquery.ddl": 2500,
+    "bigquery.load": 1500,
+    "secret_manager.access": 80,
+    "github.get": 250,
+    "github.put": 600,
+    "dataform.post": 400,
+    "dataform.get": 200,
+}
+
+class FakeEnvironment:
+    def __init__(self, latency_ms=None, latency_scale=1.0):
+        self.latency_ms = {**DEFAULT_LATENCY_MS, **(latency_ms or {})}
+        self.latency_scale = latency_scale
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def call(self, operation):
+        with self._lock:
+            self.calls[operation] += 1
+        delay = self.latency_ms.get(operation, 0) * self.latency_scale / 1000
+        if delay:
+            time.sleep(delay)
+
+    def snapshot(self):
+        with self._lock:
+            return Counter(self.calls)
+
+# -------------------------------
+# BigQuery
+# -------------------------------
+class FakeField:
+    def __init__(self, name, field_type):
+        self.name = name
+        self.field_type = field_type
+
+class FakeTable:
+    def __init__(self, columns):
+        self._columns = dict(columns)
+        self._touch()
+
+    def _touch(self):
+        self.modified = datetime.now(timezone.utc)
+        self.etag = hashlib.md5(f"{len(self._columns)}:{self.modified}".encode()).hexdigest()
+
+    @property
+    def schema(self):
+        # The client library builds SchemaField objects on every access too.
+        return [FakeField(name, field_type) for name, field_type in self._columns.items()]
+
+    def add_columns(self, columns):
+        self._columns.update(columns)
+        self._touch()
+
+class FakeRowIterator:
+    def __init__(self, rows, total_rows=None):
+        self._rows = rows
+        self.total_rows = total_rows
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def to_arrow_iterable(self, bqstorage_client=None, max_queue_size=None):
+        import pyarrow as pa
+        batch = []
+        for row in self._rows:
+            batch.append(row)
+            if len(batch) == ARROW_BATCH_ROWS:
+                yield _to_record_batch(pa, batch)
+                batch = []
+        if batch:
+            yield _to_record_batch(pa, batch)
+
+ARROW_BATCH_ROWS = 100000
+
+def _to_record_batch(pa, rows):
+    fields = rows[0]._fields
+    return pa.RecordBatch.from_arrays(
+        [pa.array([getattr(row, field) for row in rows]) for field in fields], names=list(fields)
+    )
+
+class FakeJob:
+    _ids = itertools.count(1)
+
+    def __init__(self, rows=(), total_rows=None, bytes_processed=0):
+        self.job_id = f"fake_job_{next(self._ids)}"
+        self.created = self.started = datetime.now(timezone.utc)
+        self.ended = None
+        self.total_bytes_processed = bytes_processed
+        self.total_bytes_billed = bytes_processed
+        self.slot_millis = 0
+        self.num_dml_affected_rows = 0
+        self._rows = rows
+        self._total_rows = total_rows
+
+    def result(self):
+        self.ended = datetime.now(timezone.utc)
+        return FakeRowIterator(self._rows, self._total_rows)
+
+ALTER_COLUMN_PATTERN = re.compile(r"ADD COLUMN IF NOT EXISTS `([^`]+)` (\w+)")
+SUFFIX_FILTER_PATTERN = re.compile(r"_TABLE_SUFFIX IN \(([^)]*)\)")
+SAMPLED_SHARD_PATTERN = re.compile(r"'(\d{8})' AS table_suffix")
+SAMPLE_PERCENT_PATTERN = re.compile(r"TABLESAMPLE SYSTEM \(([\d.]+) PERCENT\)")
+STATE_SUFFIX_PATTERN = re.compile(r"table_suffix IN \(([^)]*)\)")
+INTRADAY_SHARD_PATTERN = re.compile(r"'(intraday_\d{8})' AS table_suffix")
+SOURCE_PATTERN = re.compile(r"'(\w+)' AS source")
+
+class FakeBigQueryClient:
+    def __init__(self, env, events, processed_columns, state_table_name, unexported_suffixes=()):
+        self.env = env
+        self.events = events
+        # Daily shards whose export has not landed yet: only their intraday
+        # tables have rows.
+        self.unexported_suffixes = set(unexported_suffixes)
+        self.processed = FakeTable(processed_columns)
+        self.state_table_name = state_table_name
+        self.tables = {}
+
+    def get_table(self, table_id):
+        self.env.call("bigquery.get_table")
+        return self.processed
+
+    def load_table_from_json(self, rows, table_id, job_config=None):
+        self.env.call("bigquery.load")
+        rows = list(rows)
+        disposition = str(getattr(job_config, "write_disposition", "")).upper()
+        if "APPEND" in disposition:
+            self.tables.setdefault(table_id, []).extend(rows)
+        else:
+            self.tables[table_id] = rows
+        return FakeJob()
+
+    def query(self, sql, job_config=None):
+        if job_config is not None and getattr(job_config, "dry_run", False):
+            self.env.call("bigquery.dry_run")
+            return FakeJob(bytes_processed=self.events.estimated_bytes(len(self._scan_suffixes(sql)[0])))
+        if "ALTER TABLE" in sql:
+            self.env.call("bigquery.ddl")
+            self.processed.add_columns(ALTER_COLUMN_PATTERN.findall(sql))
+            return FakeJob()
+
+        self.env.call("bigquery.query")
+        if "APPENDS(TABLE" in sql:
+            # Every intraday scan sees a full shard's worth of appended rows.
+            suffixes = INTRADAY_SHARD_PATTERN.findall(sql)
+            rows = list(self.events.aggregated_rows(suffixes, sources=set(SOURCE_PATTERN.findall(sql))))
+            return FakeJob(rows, len(rows), self.events.estimated_bytes(len(suffixes)))
+        if "AS inferred_type" in sql:
+            suffixes, sample_percent = self._scan_suffixes(sql)
+            suffixes = [suffix for suffix in suffixes if suffix not in self.unexported_suffixes]
+            # Only the sources unnested by the query come back.
+            sources = set(SOURCE_PATTERN.findall(sql))
+            bytes_processed = int(self.events.estimated_bytes(len(suffixes)) * (sample_percent or 100) / 100)
+            if "GROUP BY table_suffix" in sql:
+                rows = list(self.events.aggregated_rows(suffixes, sample_percent, sources))
+                return FakeJob(rows, len(rows), bytes_processed)
+            return FakeJob(
+                self.events.param_rows_for(suffixes, sample_percent, sources),
+                self.events.row_count(suffixes, sample_percent, sources),
+                bytes_processed
+            )
+        if self.state_table_name in sql:
+            return FakeJob(self._state_rows(sql))
+        return FakeJob()
+
+    def _scan_suffixes(self, sql):
+        match = SUFFIX_FILTER_PATTERN.search(sql)
+        if match:
+            return re.findall(r"'(\d{8})'", match.group(1)), None
+        percent = SAMPLE_PERCENT_PATTERN.search(sql)
+        return SAMPLED_SHARD_PATTERN.findall(sql), float(percent.group(1)) if percent else None
+
+    def _state_rows(self, sql):
+        table_id = next((t for t in self.tables if t.endswith(self.state_table_name)), None)
+        if table_id is None:
+            raise NotFound(f"Table {self.state_table_name} not found")
+        match = STATE_SUFFIX_PATTERN.search(sql)
+        wanted = set(re.findall(r"'([^']+)'", match.group(1))) if match else None
+        rows = []
+        for row in self.tables[table_id]:
+            if wanted is None or row["table_suffix"] in wanted:
+                # BigQuery returns TIMESTAMP columns as datetimes.
+                appended_until = row.get("appended_until")
+                rows.append(SimpleNamespace(**{
+                    **row, "appended_until": datetime.fromisoformat(appended_until) if appended_until else None
+                }))
+        return rows
+
+# -------------------------------
+# Secret Manager and credentials
+# -------------------------------
+class FakeSecretManager:
+    def __init__(self, env):
+        self.env = env
+
+    def access_secret_version(self, request, timeout=None):
+        self.env.call("secret_manager.access")
+        return SimpleNamespace(payload=SimpleNamespace(data=b"fake-github-token"))
+
+class FakeCredentials:
+    def __init__(self):
+        self.token = "fake-oauth-token"
+        self.expiry = datetime.utcnow() + timedelta(days=1)
+
+    def refresh(self, request):
+        self.expiry = datetime.utcnow() + timedelta(days=1)
+
+# -------------------------------
+# GitHub and Dataform over HTTP
+# -------------------------------
+class FakeResponse:
+    def __init__(self, method, url, status_code, payload=None, headers=None, elapsed=0.0):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.request = SimpleNamespace(method=method)
+        self.elapsed = timedelta(seconds=elapsed)
+        self._payload = payload
+
+    @property
+    def text(self):
+        return json.dumps(self._payload) if self._payload is not None else ""
+
+    def json(self):
+        return self._payload
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} for {self.url}", response=self)
+
+class FakeSession:
+    def __init__(self, env, config_content):
+        self.env = env
+        self.config_content = config_content
+        self.config_sha = hashlib.sha1(config_content.encode()).hexdigest()
+        self.invocations = itertools.count(1)
+
+    def _respond(self, method, url, operation, status_code, payload=None, headers=None):
+        start = time.perf_counter()
+        self.env.call(operation)
+        response = FakeResponse(method, url, status_code, payload, headers, time.perf_counter() - start)
+        metrics.record_http_response(response)
+        return response
+
+    def get(self, url, headers=None, **kwargs):
+        headers = headers or {}
+        if "api.github.com" in url:
+            etag = f'"{self.config_sha}"'
+            if headers.get("If-None-Match") == etag:
+                return self._respond("GET", url, "github.get", 304, headers={"ETag": etag})
+            return self._respond("GET", url, "github.get", 200, {
+                "sha": self.config_sha,
+                "content": base64.b64encode(self.config_content.encode()).decode(),
+            }, headers={"ETag": etag})
+        if "workflowInvocations/" in url:
+            return self._respond("GET", url, "dataform.get", 200, {"state": "SUCCEEDED"})
+        return self._respond("GET", url, "dataform.get", 200, {"invocationConfig": {}})
+
+    def put(self, url, headers=None, json=None, **kwargs):
+        if json.get("sha") != self.config_sha:
+            return self._respond("PUT", url, "github.put", 409, {"message": "sha mismatch"})
+        self.config_content = base64.b64decode(json["content"]).decode()
+        self.config_sha = hashlib.sha1(self.config_content.encode()).hexdigest()
+        return self._respond("PUT", url, "github.put", 200, {"commit": {"sha": self.config_sha}})
+
+    def post(self, url, headers=None, json=None, **kwargs):
+        if url.endswith("/compilationResults"):
+            return self._respond("POST", url, "dataform.post", 200, {"name": f"{url}/fake"})
+        return self._respond("POST", url, "dataform.post", 200, {
+            "name": f"{url}/{next(self.invocations)}", "state": "RUNNING"
+        })
+
+# -------------------------------
+# Installation
+# -------------------------------
+def render_config(known_keys_by_array):
+    blocks = []
+    for array_name, keys in known_keys_by_array.items():
+        entries = ",\n".join(f'    {{ name: "{k}", type: "string", renameTo: "{k}" }}' for k in sorted(keys))
+        blocks.append(f"  {array_name}: [\n{entries}\n  ],")
+    return "module.exports = {\n" + "\n".join(blocks) + "\n};\n"
+
+def install(env, prop, events, processed_columns, config_content, state_table_name, unexported_suffixes=()):
+    # Replaces the shared clients and drops every per-instance cache, so each
+    # scenario starts from a cold instance.
+    bigquery_client = FakeBigQueryClient(env, events, processed_columns, state_table_name, unexported_suffixes)
+    session = FakeSession(env, config_content)
+    with clients._lock:
+        clients._bigquery_clients.clear()
+        clients._bigquery_clients[prop["raw_project_id"]] = bigquery_client
+        clients._bigquery_clients[prop["write_project_id"]] = bigquery_client
+        clients._secret_manager_client = FakeSecretManager(env)
+        clients._http_session = session
+        clients._credentials = FakeCredentials()
+        clients._github_token = None
+    schema_cache._snapshots.clear()
+    update_dataform_config._contents_cache.clear()
+    return bigquery_client, session
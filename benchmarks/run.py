@@ -0,0 +1,298 @@
+import argparse
+import base64
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+# Run from the repository root: python -m benchmarks.run [options]
+# Needs the packages in requirements.txt; only the remote services are faked.
+
+import config
+import metrics
+from properties import get_property, get_state_table_id
+from benchmarks.fakes import FakeEnvironment, install, render_config
+from benchmarks.synthetic import SyntheticEvents
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SCENARIOS = os.path.join(BENCHMARK_DIR, "scenarios.json")
+DEFAULT_BASELINE = os.path.join(BENCHMARK_DIR, "baselines.json")
+
+# Modules whose imported config names are overridden per scenario.
+PIPELINE_MODULES = [
+    "config", "compare_event_params", "raw_param_scan", "discovery_state", "schema_cache",
+    "alter_table_event_params", "update_dataform_config", "pipeline", "backfill",
+    "trigger_control", "pull_worker", "workflow_tracker", "param_catalog", "resilience",
+]
+
+# Rows mode materialises every param row in Python; beyond this it would not
+# finish in reasonable time, so such scenarios are reported as skipped.
+ROWS_MODE_MAX_PARAM_ROWS = 10 ** 7
+
+# -------------------------------
+# Scenario Setup
+# -------------------------------
+@contextlib.contextmanager
+def overridden(overrides):
+    previous = []
+    for module_name in PIPELINE_MODULES:
+        module = sys.modules.get(module_name) or __import__(module_name)
+        for name, value in overrides.items():
+            if hasattr(module, name):
+                previous.append((module, name, getattr(module, name)))
+                setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for module, name, value in reversed(previous):
+            setattr(module, name, value)
+
+def base_overrides(latency_scale):
+    return {
+        # Nothing may leave the process or outlive the scenario.
+        "DATAFORM_TRACK_INVOCATIONS": False,
+        "BACKFILL_ENABLED": False,
+        "DISCOVERY_STATE_BACKEND": "bigquery",
+        "SCHEMA_CACHE_BACKEND": "memory",
+        "TRIGGER_STATE_BACKEND": "local",
+        "TRIGGER_COALESCE_WINDOW_SECONDS": 0,
+        "PULL_BATCH_WINDOW_SECONDS": 0,
+        "ALTER_MIN_INTERVAL_SECONDS": config.ALTER_MIN_INTERVAL_SECONDS * latency_scale,
+    }
+
+def build_environment(scenario, prop, env):
+    events = SyntheticEvents(scenario["param_rows"], scenario["distinct_keys"], config.DAYS_TO_LOOK_BACK)
+
+    # The rarest event_params keys are the ones missing from the processed
+    # table and config.js; every other synthetic key is already known.
+    new_keys = set(events.keys_for("event_params")[-scenario["new_keys"]:]) if scenario["new_keys"] else set()
+    columns = {"event_date": "DATE", "event_timestamp": "INT64", "event_name": "STRING", "user_pseudo_id": "STRING"}
+    known_by_array = {}
+    for source, source_config in config.PARAM_SOURCES.items():
+        known = [key for key in events.keys_for(source) if key not in new_keys]
+        known_by_array[source_config["config_array"]] = known
+        for key in known:
+            columns[f"{key}{source_config['column_suffix']}"] = "STRING"
+    filler = 0
+    while len(columns) < scenario["processed_columns"]:
+        columns[f"legacy_param_{filler:05d}_event_param"] = "STRING"
+        filler += 1
+
+    # The most recent `unexported_days` daily shards have not landed yet.
+    today = datetime.utcnow().date()
+    unexported = [(today - timedelta(days=i)).strftime("%Y%m%d") for i in range(scenario.get("unexported_days", 0))]
+    return install(
+        env, prop, events, columns, render_config(known_by_array),
+        get_state_table_id(prop, config.DISCOVERY_STATE_TABLE), unexported
+    )
+
+# -------------------------------
+# Measurement
+# -------------------------------
+def measure(env, fn, trace_memory, verbose):
+    before = env.snapshot()
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    output = io.StringIO()
+    with contextlib.redirect_stdout(sys.stdout if verbose else output):
+        result = fn()
+    latency_ms = (time.perf_counter() - start) * 1000
+    peak_mb = None
+    if trace_memory:
+        peak_mb = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+        tracemalloc.stop()
+    calls = env.snapshot()
+    calls.subtract(before)
+    return result, {
+        "latency_ms": round(latency_ms, 2),
+        "peak_mb": round(peak_mb, 2) if peak_mb is not None else None,
+        "api_calls": {op: n for op, n in sorted(calls.items()) if n},
+    }
+
+def skip_reason(scenario):
+    overrides = scenario.get("overrides", {})
+    if overrides.get("RAW_AGGREGATION_MODE", config.RAW_AGGREGATION_MODE) == "rows" \
+            and scenario["param_rows"] > ROWS_MODE_MAX_PARAM_ROWS:
+        return f"rows mode is capped at {ROWS_MODE_MAX_PARAM_ROWS} param rows ({scenario['param_rows']} requested)"
+    return None
+
+def run_scenario(scenario, latency_scale, trace_memory, verbose):
+    from compare_event_params import compare_event_params_and_store_schema_diff
+    from alter_table_event_params import alter_processed_table_with_missing_event_params
+    from update_dataform_config import update_config_file_with_new_params
+
+    overrides = {**base_overrides(latency_scale), **scenario.get("overrides", {})}
+    prop = get_property()
+    env = FakeEnvironment(scenario.get("latency_ms"), latency_scale)
+    stages = {}
+    with overridden(overrides):
+        build_environment(scenario, prop, env)
+        metrics.start_run()
+
+        compare_result, stages["compare_cold"] = measure(
+            env, lambda: compare_event_params_and_store_schema_diff(None, prop=prop), trace_memory, verbose
+        )
+        fields = compare_result["fields"]
+        _, stages["alter"] = measure(
+            env, lambda: alter_processed_table_with_missing_event_params(fields, prop=prop), trace_memory, verbose
+        )
+        _, stages["config_update"] = measure(
+            env, lambda: update_config_file_with_new_params(fields, prop=prop), trace_memory, verbose
+        )
+        # A second run against the warm discovery state and schema snapshot.
+        warm_result, stages["compare_warm"] = measure(
+            env, lambda: compare_event_params_and_store_schema_diff(None, prop=prop), trace_memory, verbose
+        )
+    stages["compare_cold"]["missing_count"] = compare_result["missing_count"]
+    stages["compare_warm"]["missing_count"] = warm_result["missing_count"]
+    return stages
+
+def load_replay_messages(path):
+    # Accepts Pub/Sub push bodies ({"message": {"data": base64, ...}}) or bare
+    # {"data": ..., "attributes": ...} lines.
+    messages = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            payload = json.loads(line)
+            message = payload.get("message", payload)
+            data = message.get("data", "")
+            if "message" in payload:
+                data = base64.b64decode(data).decode("utf-8")
+            messages.append((data, message.get("attributes") or {}))
+    return messages
+
+def run_replay(scenario, path, latency_scale, trace_memory, verbose):
+    from pull_worker import InMemoryQueue, collect_batch, process_batch
+
+    overrides = {**base_overrides(latency_scale), **scenario.get("overrides", {})}
+    prop = get_property()
+    env = FakeEnvironment(scenario.get("latency_ms"), latency_scale)
+    queue = InMemoryQueue()
+    messages = load_replay_messages(path)
+
+    def replay():
+        for data, attributes in messages:
+            queue.publish(data, attributes)
+        batches = []
+        while True:
+            batch = collect_batch(queue, wait_timeout=0)
+            if not batch:
+                return batches
+            batches.append(process_batch(queue, batch)["status"])
+
+    with overridden(overrides):
+        build_environment(scenario, prop, env)
+        batches, result = measure(env, replay, trace_memory, verbose)
+    result.update(messages=len(messages), batches=len(batches), batch_statuses=batches)
+    return {"replay": result}
+
+# -------------------------------
+# Baselines
+# -------------------------------
+def find_regressions(results, baseline, tolerance):
+    regressions = []
+    for scenario_name, stages in results.items():
+        if "skipped" in stages:
+            continue
+        for stage_name, current in stages.items():
+            previous = baseline.get(scenario_name, {}).get(stage_name)
+            if not previous:
+                continue
+            label = f"{scenario_name}.{stage_name}"
+            if (current["latency_ms"] > previous["latency_ms"] * (1 + tolerance)
+                    and current["latency_ms"] - previous["latency_ms"] > 5):
+                regressions.append(f"{label}: latency {previous['latency_ms']} -> {current['latency_ms']} ms")
+            if (current.get("peak_mb") is not None and previous.get("peak_mb") is not None
+                    and current["peak_mb"] > previous["peak_mb"] * (1 + tolerance)
+                    and current["peak_mb"] - previous["peak_mb"] > 1):
+                regressions.append(f"{label}: peak memory {previous['peak_mb']} -> {current['peak_mb']} MB")
+            # Call counts are deterministic, so any increase is a regression.
+            for op, count in current["api_calls"].items():
+                if count > previous["api_calls"].get(op, 0):
+                    regressions.append(f"{label}: {op} calls {previous['api_calls'].get(op, 0)} -> {count}")
+    return regressions
+
+def print_report(results):
+    print(f"{'scenario.stage':<36} {'latency_ms':>12} {'peak_mb':>9}  api_calls")
+    for scenario_name, stages in results.items():
+        if "skipped" in stages:
+            print(f"{scenario_name:<36} {'skipped':>12}            {stages['skipped']}")
+            continue
+        for stage_name, stage in stages.items():
+            peak = "-" if stage.get("peak_mb") is None else f"{stage['peak_mb']:.2f}"
+            calls = ", ".join(f"{op}={n}" for op, n in stage["api_calls"].items())
+            print(f"{scenario_name + '.' + stage_name:<36} {stage['latency_ms']:>12.2f} {peak:>9}  {calls}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the param discovery pipeline.")
+    parser.add_argument("--scenarios", default=DEFAULT_SCENARIOS)
+    parser.add_argument("--scenario", action="append", help="Run only these scenarios (repeatable).")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="Multiplier for fake API latencies; 0 disables sleeping.")
+    parser.add_argument("--replay", help="JSONL of Pub/Sub payloads to replay through the pull worker.")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative slowdown before flagging.")
+    parser.add_argument("--no-memory", action="store_true", help="Skip tracemalloc (it slows Python-heavy stages).")
+    parser.add_argument("--output", help="Write the results as JSON to this file.")
+    parser.add_argument("--verbose", action="store_true", help="Show pipeline logs.")
+    args = parser.parse_args(argv)
+
+    with open(args.scenarios) as f:
+        scenarios = json.load(f)
+    if args.scenario:
+        scenarios = [s for s in scenarios if s["name"] in args.scenario]
+
+    results = {}
+    for scenario in scenarios:
+        reason = skip_reason(scenario)
+        if reason:
+            print(f"Skipping scenario {scenario['name']}: {reason}.", file=sys.stderr)
+            results[scenario["name"]] = {"skipped": reason}
+            continue
+        print(f"Running scenario {scenario['name']}...", file=sys.stderr)
+        if args.replay:
+            results[scenario["name"]] = run_replay(
+                scenario, args.replay, args.latency_scale, not args.no_memory, args.verbose
+            )
+        else:
+            results[scenario["name"]] = run_scenario(
+                scenario, args.latency_scale, not args.no_memory, args.verbose
+            )
+    print_report(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        measured = {name: stages for name, stages in results.items() if "skipped" not in stages}
+        baseline.update(measured)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"Saved baseline for {sorted(measured)} to {args.baseline}")
+        return 0
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        if regressions:
+            print("Regressions against baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("No regressions against baseline.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,76 @@
+import random
+from collections import namedtuple
+
+# -------------------------------
+# Synthetic GA4 export
+# -------------------------------
+# Describes the raw `events_*` shards by key and per-type counts instead of
+# materialising rows, so a scenario can stand for 10^8 param rows while the
+# server-side aggregation path only ever sees a few thousand grouped rows.
+# Row-level streams (RAW_AGGREGATION_MODE="rows") are generated lazily from
+# the same counts.
+
+BYTES_PER_PARAM_ROW = 96
+
+# Share of keys per param source.
+SOURCE_SHARES = {"event_params": 0.8, "user_properties": 0.1, "items": 0.1}
+TYPES = ["STRING", "INT64", "FLOAT64"]
+
+AggregatedRow = namedtuple(
+    "AggregatedRow", "table_suffix source param_key string_count int64_count float64_count"
+)
+ParamRow = namedtuple("ParamRow", "source param_key inferred_type")
+
+class SyntheticEvents:
+    def __init__(self, param_rows, distinct_keys, days, seed=7):
+        self.param_rows = int(param_rows)
+        self.days = days
+        self.rows_per_shard = max(1, self.param_rows // days)
+        rng = random.Random(seed)
+
+        # (source, key, type weights, share of a shard's param rows)
+        self.keys = []
+        weights = [1.0 / (rank + 1) for rank in range(int(distinct_keys))]  # Zipf-like
+        total_weight = sum(weights)
+        sources = list(SOURCE_SHARES)
+        source_weights = [SOURCE_SHARES[s] for s in sources]
+        for rank, weight in enumerate(weights):
+            source = rng.choices(sources, source_weights)[0]
+            dominant = rng.choices(TYPES, [0.6, 0.3, 0.1])[0]
+            type_weights = {t: (0.98 if t == dominant else 0.01) for t in TYPES}
+            self.keys.append((source, f"synthetic_{source[:4]}_{rank:05d}", type_weights, weight / total_weight))
+
+    def keys_for(self, source):
+        return [key for s, key, _, _ in self.keys if s == source]
+
+    def estimated_bytes(self, shard_count):
+        return self.rows_per_shard * shard_count * BYTES_PER_PARAM_ROW
+
+    def _shard_counts(self, sample_percent, sources=None):
+        scale = (sample_percent or 100) / 100
+        for source, key, type_weights, share in self.keys:
+            if sources is not None and source not in sources:
+                continue
+            rows = int(self.rows_per_shard * share * scale)
+            if rows == 0:
+                # Rare keys drop out of small samples, as they would for real.
+                continue
+            yield source, key, {t: int(rows * w) for t, w in type_weights.items()}
+
+    def aggregated_rows(self, suffixes, sample_percent=None, sources=None):
+        for suffix in suffixes:
+            for source, key, counts in self._shard_counts(sample_percent, sources):
+                yield AggregatedRow(suffix, source, key, counts["STRING"], counts["INT64"], counts["FLOAT64"])
+
+    def param_rows_for(self, suffixes, sample_percent=None, sources=None):
+        for _ in suffixes:
+            for source, key, counts in self._shard_counts(sample_percent, sources):
+                for inferred_type, count in counts.items():
+                    row = ParamRow(source, key, inferred_type)
+                    for _ in range(count):
+                        yield row
+
+    def row_count(self, suffixes, sample_percent=None, sources=None):
+        return sum(
+            sum(counts.values()) for _, _, counts in self._shard_counts(sample_percent, sources)
+        ) * len(suffixes)
@@ -0,0 +1,161 @@
+import threading
+import time
+from datetime import datetime, timedelta
+import metrics
+from startup_timing import timed_import, record_init
+from resilience import call_with_retries
+from config import (
+    PROJECT_ID,
+    SECRET_MANAGER_TIMEOUT_SECONDS,
+    GITHUB_TOKEN_TTL_SECONDS,
+    OAUTH_TOKEN_REFRESH_MARGIN_SECONDS,
+    HTTP_POOL_MAXSIZE
+)
+
+# -------------------------------
+# Process-wide client registry
+# -------------------------------
+# Clients, sessions and tokens live for the life of the instance so warm
+# invocations reuse open connections and skip auth handshakes. Everything,
+# including the SDK imports, is created on first use.
+
+_lock = threading.RLock()
+_bigquery_clients = {}
+_bigquery_storage_client = None
+_bigquery_storage_checked = False
+_secret_manager_client = None
+_storage_client = None
+_subscriber_client = None
+_http_session = None
+_github_token = None
+_github_token_fetched_at = 0.0
+_credentials = None
+# Credentials have their own lock so a token refresh, which is a network
+# call, does not block client lookups in other threads.
+_credentials_lock = threading.Lock()
+
+def get_bigquery_client(project):
+    with _lock:
+        if project not in _bigquery_clients:
+            print(f"Initializing BigQuery client for project: {project}")
+            bigquery = timed_import("google.cloud.bigquery")
+            start = time.perf_counter()
+            _bigquery_clients[project] = bigquery.Client(project=project)
+            record_init(f"bigquery_client:{project}", start)
+        return _bigquery_clients[project]
+
+def get_bigquery_storage_client():
+    # Storage Read API client for Arrow downloads, or None when the optional
+    # google-cloud-bigquery-storage package is not installed (results are then
+    # paged over REST).
+    global _bigquery_storage_client, _bigquery_storage_checked
+    with _lock:
+        if not _bigquery_storage_checked:
+            _bigquery_storage_checked = True
+            try:
+                bigquery_storage = timed_import("google.cloud.bigquery_storage")
+            except ImportError:
+                print("google-cloud-bigquery-storage not installed. Reading Arrow results over REST.")
+                return None
+            start = time.perf_counter()
+            _bigquery_storage_client = bigquery_storage.BigQueryReadClient()
+            record_init("bigquery_storage_client", start)
+        return _bigquery_storage_client
+
+def get_secret_manager_client():
+    global _secret_manager_client
+    with _lock:
+        if _secret_manager_client is None:
+            print("Initializing Secret Manager client.")
+            secretmanager = timed_import("google.cloud.secretmanager")
+            start = time.perf_counter()
+            _secret_manager_client = secretmanager.SecretManagerServiceClient()
+            record_init("secret_manager_client", start)
+        return _secret_manager_client
+
+def get_storage_client():
+    global _storage_client
+    with _lock:
+        if _storage_client is None:
+            print("Initializing Cloud Storage client.")
+            storage = timed_import("google.cloud.storage")
+            start = time.perf_counter()
+            _storage_client = storage.Client(project=PROJECT_ID)
+            record_init("storage_client", start)
+        return _storage_client
+
+def get_subscriber_client():
+    global _subscriber_client
+    with _lock:
+        if _subscriber_client is None:
+            print("Initializing Pub/Sub subscriber client.")
+            pubsub = timed_import("google.cloud.pubsub_v1")
+            start = time.perf_counter()
+            _subscriber_client = pubsub.SubscriberClient()
+            record_init("pubsub_subscriber_client", start)
+        return _subscriber_client
+
+def get_http_session():
+    global _http_session
+    with _lock:
+        if _http_session is None:
+            # Keep-alive connections are pooled per host (GitHub, Dataform, OAuth).
+            requests = timed_import("requests")
+            adapters = timed_import("requests.adapters")
+            _http_session = requests.Session()
+            adapter = adapters.HTTPAdapter(pool_connections=HTTP_POOL_MAXSIZE, pool_maxsize=HTTP_POOL_MAXSIZE)
+            _http_session.mount("https://", adapter)
+            _http_session.hooks["response"].append(metrics.record_http_response)
+        return _http_session
+
+# -------------------------------
+# Cached credentials
+# -------------------------------
+def get_github_token():
+    global _github_token, _github_token_fetched_at
+    with _lock:
+        if _github_token and time.monotonic() - _github_token_fetched_at < GITHUB_TOKEN_TTL_SECONDS:
+            return _github_token
+
+    print("[INFO] Accessing GitHub token from Secret Manager...")
+    client = get_secret_manager_client()
+    secret_name = f"projects/{PROJECT_ID}/secrets/dataform-github-access-token/versions/latest"
+    try:
+        response = call_with_retries(
+            "secret_manager", "secret_manager_access",
+            lambda timeout: client.access_secret_version(request={"name": secret_name}, timeout=timeout),
+            SECRET_MANAGER_TIMEOUT_SECONDS
+        )
+        token = response.payload.data.decode("utf-8").strip()
+        print("[SUCCESS] GitHub token retrieved.")
+    except Exception as e:
+        raise Exception(f"[ERROR] Failed to access GitHub token from Secret Manager: {e}")
+
+    with _lock:
+        _github_token = token
+        _github_token_fetched_at = time.monotonic()
+    return token
+
+def get_oauth_token():
+    global _credentials
+    session = get_http_session()
+    with _credentials_lock:
+        if _credentials is None:
+            google_auth = timed_import("google.auth")
+            start = time.perf_counter()
+            _credentials, _ = google_auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+            record_init("google_auth_default", start)
+        creds = _credentials
+
+        # Refresh only when the token is missing or about to expire.
+        refresh_before = datetime.utcnow() + timedelta(seconds=OAUTH_TOKEN_REFRESH_MARGIN_SECONDS)
+        if not creds.token or creds.expiry is None or creds.expiry <= refresh_before:
+            print("[INFO] Refreshing OAuth access token...")
+            auth_transport = timed_import("google.auth.transport.requests")
+            creds.refresh(auth_transport.Request(session=session))
+        return creds.token
+
+def invalidate_github_token():
+    global _github_token
+    with _lock:
+        _github_token = None
@@ -1,179 +1,558 @@
+import time
 from google.cloud import bigquery
-from datetime import datetime, timedelta
-from google.api_core.exceptions import Conflict
+from datetime import datetime, timedelta, timezone
 from config import (
-    RAW_PROJECT_ID,
-    WRITE_PROJECT_ID,
-    RAW_DATASET,
-    RAW_TABLE_PATTERN,
-    PROCESSED_TABLE_ID,
-    TEMP_DATASET,
     TEMP_TABLE,
-    DAYS_TO_LOOK_BACK
+    DAYS_TO_LOOK_BACK,
+    RAW_AGGREGATION_MODE,
+    RAW_ROWS_READER,
+    INCREMENTAL_DISCOVERY,
+    FULL_RESCAN,
+    PERSIST_SCHEMA_DIFF,
+    SAMPLED_DISCOVERY,
+    DISCOVERY_SAMPLE_PERCENT,
+    SAMPLED_DISCOVERY_FULL_SCAN_WEEKDAY,
+    INTRADAY_DISCOVERY,
+    INTRADAY_DAYS,
+    INTRADAY_COMMIT_LAG_SECONDS,
+    PARAM_CATALOG_ENABLED,
+    PARAM_CATALOG_EXPIRE_DAYS,
+    TYPE_RESOLUTION_RULE,
+    TYPE_NOISE_SHARE,
+    PARAM_SOURCES_ENABLED
+)
+import metrics
+from clients import get_bigquery_client
+from scheduler import submit
+from properties import get_property, get_state_table_id
+from param_classifier import get_classifier
+from schema_cache import get_processed_fields
+from discovery_state import load_discovery_state, save_discovery_state
+from param_catalog import load_pending_params, merge_catalog_rows
+from raw_param_scan import (
+    INTRADAY_SUFFIX_PREFIX,
+    find_intraday_tables,
+    run_intraday_scan,
+    plan_raw_scan,
+    make_scan_plan,
+    run_raw_scan,
+    check_sampling_recall,
+    reduce_param_rows_arrow
 )
 
-def compare_event_params_and_store_schema_diff(request):
-    print("Initializing BigQuery clients.")
-    raw_client = bigquery.Client(project=RAW_PROJECT_ID)
-    write_client = bigquery.Client(project=WRITE_PROJECT_ID)
+# Inferred types from narrowest to widest. Every INT64 value fits FLOAT64 and
+# every value fits STRING.
+INFERRED_TYPE_ORDER = ["INT64", "FLOAT64", "STRING"]
 
-    # -------------------------------
-    # Delete Temp Table If Already Exists
-    # -------------------------------
-    table_id = f"{WRITE_PROJECT_ID}.{TEMP_DATASET}.{TEMP_TABLE}"
-    print(f"Deleting temp table (if exists): {table_id}")
-    write_client.delete_table(table_id, not_found_ok=True)
+# -------------------------------
+# Type Resolution
+# -------------------------------
+# Each key's type is resolved from its full histogram of inferred types, so
+# the result does not depend on row order. Types seen in fewer than
+# TYPE_NOISE_SHARE of a key's values are ignored first. The remaining types
+# are resolved with TYPE_RESOLUTION_RULE:
+#   majority - the most frequent type; ties go to the wider type
+#   widening - the widest type observed
+#   conflict - a single remaining type is used as-is; otherwise the key is
+#              flagged as a conflict and left out of the diff for review
+def resolve_inferred_type(type_counts, rule=TYPE_RESOLUTION_RULE):
+    total = sum(type_counts.get(t, 0) for t in INFERRED_TYPE_ORDER)
+    if not total:
+        return "STRING", False
+    observed = [
+        t for t in INFERRED_TYPE_ORDER
+        if type_counts.get(t, 0) and type_counts[t] / total >= TYPE_NOISE_SHARE
+    ]
+    if rule == "majority":
+        return max(observed, key=lambda t: (type_counts[t], INFERRED_TYPE_ORDER.index(t))), False
+    if rule == "widening":
+        return observed[-1], False
+    if rule == "conflict":
+        return observed[-1], len(observed) > 1
+    raise ValueError(f"Unknown TYPE_RESOLUTION_RULE: {rule}")
+
+def add_catalog_row(shard_catalog, row):
+    shard_catalog.setdefault(row.table_suffix, {}).setdefault(row.source, {})[row.param_key] = {
+        "STRING": row.string_count,
+        "INT64": row.int64_count,
+        "FLOAT64": row.float64_count,
+    }
+
+def shard_date(suffix):
+    # "20240101" or "intraday_20240101" -> "2024-01-01"
+    return datetime.strptime(suffix[-8:], "%Y%m%d").date().isoformat()
+
+def merge_shard_catalog(shard_catalog):
+    # Collapse {suffix: {source: {key: type_counts}}} into per-(source, key)
+    # totals with the first and last shard each key was seen in.
+    key_stats = {}
+    for suffix in sorted(shard_catalog, key=lambda s: (shard_date(s), s)):
+        date = shard_date(suffix)
+        for source, keys in shard_catalog[suffix].items():
+            for key, type_counts in keys.items():
+                stats = key_stats.setdefault((source, key), {
+                    "type_counts": {t: 0 for t in INFERRED_TYPE_ORDER},
+                    "first_seen": date,
+                })
+                for t in INFERRED_TYPE_ORDER:
+                    stats["type_counts"][t] += type_counts.get(t, 0)
+                stats["last_seen"] = date
+    return key_stats
+
+def scan_intraday_tables(raw_client, prop, shard_catalog, watermarks, dates):
+    # Adds the rows appended to each intraday table since its watermark to
+    # that table's catalog entry and advances the watermarks. A date whose
+    # daily shard is already cataloged is covered by the daily shard, so its
+    # intraday entry is dropped.
+    for date in dates:
+        if date in shard_catalog:
+            shard_catalog.pop(f"{INTRADAY_SUFFIX_PREFIX}{date}", None)
+            watermarks.pop(f"{INTRADAY_SUFFIX_PREFIX}{date}", None)
+    pending_dates = [date for date in dates if date not in shard_catalog]
+    with metrics.timed("find_intraday_tables"):
+        tables = find_intraday_tables(raw_client, prop, pending_dates) if pending_dates else {}
+
+    end_timestamp = datetime.now(timezone.utc) - timedelta(seconds=INTRADAY_COMMIT_LAG_SECONDS)
+    windows = {
+        suffix: (table_id, watermarks.get(suffix))
+        for suffix, table_id in tables.items()
+        if watermarks.get(suffix) is None or watermarks[suffix] < end_timestamp
+    }
+    summary = {
+        "scanned_suffixes": sorted(windows),
+        "windows": {
+            suffix: {"from": start.isoformat() if start else None, "to": end_timestamp.isoformat()}
+            for suffix, (_, start) in sorted(windows.items())
+        },
+        "row_count": 0,
+    }
+    if not windows:
+        print("No intraday tables with new rows to scan.")
+        return summary
+
+    print(f"Executing intraday raw event parameter query for {sorted(windows)} up to {end_timestamp.isoformat()}.")
+    appended = {}
+    for row in run_intraday_scan(raw_client, windows, end_timestamp):
+        summary["row_count"] += 1
+        add_catalog_row(appended, row)
+    for suffix, sources in appended.items():
+        for source, keys in sources.items():
+            for key, type_counts in keys.items():
+                totals = shard_catalog.setdefault(suffix, {}).setdefault(source, {}).setdefault(
+                    key, {t: 0 for t in INFERRED_TYPE_ORDER}
+                )
+                for t in INFERRED_TYPE_ORDER:
+                    totals[t] += type_counts[t]
+    for suffix in windows:
+        watermarks[suffix] = end_timestamp
+    return summary
+
+def group_by_source(keyed_values):
+    # {(source, key): value} -> {source: {key: value}} for JSON output.
+    grouped = {}
+    for (source, key), value in sorted(keyed_values.items()):
+        grouped.setdefault(source, {})[key] = value
+    return grouped
+
+def diff_with_param_catalog(write_client, prop, raw_key_stats, type_conflicts, observed_keys,
+                            processed_fields, classifier, scan_dates):
+    # Classifies this run's keys and the catalog's pending keys, writes them
+    # with one MERGE and returns the keys still pending. A key is excluded by
+    # a rule, added once the processed table has its column, expired when it
+    # stays pending without being seen for PARAM_CATALOG_EXPIRE_DAYS, and
+    # pending otherwise. Every key observed in the scanned shards is merged
+    # again, since its last_seen moves with each new shard; only pending keys
+    # that were not observed and whose status did not change are left out.
+    # The MERGE therefore grows with the distinct keys of the scanned shards:
+    # close to the new shard's keys on incremental runs, and every key in the
+    # window on a full rescan.
+    with metrics.timed("load_pending_params"):
+        pending, created = load_pending_params(write_client, prop)
+    if created:
+        # A new catalog is seeded from every key in the look-back window.
+        observed_keys = set(raw_key_stats)
+    expire_before = (datetime.utcnow().date() - timedelta(days=PARAM_CATALOG_EXPIRE_DAYS)).isoformat()
+
+    rows = {}
+    for source_key in observed_keys | set(pending):
+        source, key = source_key
+        if source not in PARAM_SOURCES_ENABLED:
+            # Left as they are while their source is disabled.
+            continue
+        stats = raw_key_stats.get(source_key)
+        if stats is not None:
+            row = {
+                "source": source,
+                "param_key": key,
+                "resolved_type": stats["resolved_type"],
+                "type_conflict": source_key in type_conflicts,
+                "first_seen": stats.get("first_seen", scan_dates[0]),
+                "last_seen": stats.get("last_seen", scan_dates[1]),
+            }
+        else:
+            row = dict(pending[source_key])
+        excluded_by = classifier.excluded_by(key)
+        if excluded_by is not None:
+            row.update(status="excluded", excluded_by=excluded_by)
+        elif key in processed_fields[source]:
+            row.update(status="added", excluded_by=None)
+        elif row["last_seen"] and row["last_seen"] < expire_before:
+            row.update(status="expired", excluded_by=None)
+        else:
+            row.update(status="pending", excluded_by=None)
+        rows[source_key] = row
+
+    changed_rows = [
+        row for source_key, row in sorted(rows.items())
+        if source_key in observed_keys or row["status"] != "pending"
+    ]
+    merge_job_id = merge_catalog_rows(write_client, prop, changed_rows)
+
+    still_pending = {source_key: row for source_key, row in rows.items() if row["status"] == "pending"}
+    expired = sorted(f"{source}.{key}" for (source, key), row in rows.items() if row["status"] == "expired")
+    if expired:
+        print(f"Expired {len(expired)} pending keys not seen since {expire_before}: {expired}")
+    missing_keys = [
+        (source, key, row["resolved_type"])
+        for (source, key), row in sorted(still_pending.items())
+        if not row["type_conflict"]
+    ]
+    candidate_conflicts = {
+        source_key: raw_key_stats[source_key]["type_counts"] if source_key in raw_key_stats else {}
+        for source_key, row in still_pending.items()
+        if row["type_conflict"]
+    }
+    catalog_summary = {
+        "created": created,
+        "merged_keys": len(changed_rows),
+        "pending_keys": len(still_pending),
+        "previously_pending_keys": len(pending),
+        "expired_keys": expired,
+        "merge_job_id": merge_job_id,
+    }
+    return missing_keys, candidate_conflicts, still_pending, catalog_summary
+
+def run_sampling_recall_check(suffix, sample_percent=None, prop=None):
+    prop = prop or get_property()
+    raw_client = get_bigquery_client(prop["raw_project_id"])
+    return check_sampling_recall(raw_client, prop, suffix, sample_percent or DISCOVERY_SAMPLE_PERCENT)
+
+def compare_event_params_and_store_schema_diff(request, full_rescan=None, prop=None, suffixes=None):
+    prop = prop or get_property()
+    raw_client = get_bigquery_client(prop["raw_project_id"])
+    write_client = get_bigquery_client(prop["write_project_id"])
 
     # -------------------------------
     # Generate List of Raw Table Suffixes
     # -------------------------------
+    # Explicit suffixes (from shard notifications) are always rescanned; the
+    # rest of the look-back window is still loaded from the discovery state
+    # so keys seen in other shards are not reported as new.
     today = datetime.utcnow().date()
+    target_suffixes = sorted(set(suffixes)) if suffixes else None
     suffixes = [(today - timedelta(days=i)).strftime("%Y%m%d") for i in range(DAYS_TO_LOOK_BACK)]
-    suffix_filter = ",".join([f"'{s}'" for s in suffixes])
-    print(f"Suffixes for raw table filtering: {suffix_filter}")
-
-    # -------------------------------
-    # Query Raw Event Params
-    # -------------------------------
-    raw_query = f"""
-        SELECT
-            param.key AS event_param_key,
-            CASE
-                WHEN param.value.string_value IS NOT NULL THEN 'STRING'
-                WHEN param.value.int_value IS NOT NULL THEN 'INT64'
-                WHEN param.value.double_value IS NOT NULL THEN 'FLOAT64'
-                WHEN param.value.float_value IS NOT NULL THEN 'FLOAT64'
-                ELSE 'STRING'
-            END AS inferred_type
-        FROM `{RAW_PROJECT_ID}.{RAW_DATASET}.{RAW_TABLE_PATTERN}`,
-             UNNEST(event_params) AS param
-        WHERE _TABLE_SUFFIX IN ({suffix_filter})
-    """
-    print("Executing raw event parameter query.")
-    try:
-        raw_keys_result = raw_client.query(raw_query)
-    except Exception as e:
-        print(f"BigQuery raw query failed: {e}")
-        raise
+    if target_suffixes:
+        suffixes = sorted(set(suffixes) | set(target_suffixes), reverse=True)
+
+    if full_rescan is None:
+        full_rescan = FULL_RESCAN
+    incremental = INCREMENTAL_DISCOVERY and RAW_AGGREGATION_MODE == "server"
+    intraday = INTRADAY_DISCOVERY and incremental
+    intraday_dates = [(today - timedelta(days=i)).strftime("%Y%m%d") for i in range(INTRADAY_DAYS)] if intraday else []
+    sampled_discovery = SAMPLED_DISCOVERY and RAW_AGGREGATION_MODE == "server"
+    # Sampling can miss rare keys, so shards that were only sampled get a full
+    # scan on the scheduled weekday.
+    sampled_full_scan_due = today.weekday() == SAMPLED_DISCOVERY_FULL_SCAN_WEEKDAY
 
     # -------------------------------
-    # Build Raw Key-Type Mapping
+    # Fetch Processed Table Schema
+    # -------------------------------
+    # The schema fetch does not depend on the raw scan, so it runs in the
+    # background and is only waited on when candidate keys are checked.
+    def fetch_processed_fields():
+        print("Fetching schema from processed table.")
+        fields = get_processed_fields(write_client, prop)
+        field_count = sum(len(names) for names in fields.values())
+        print(f"Found {field_count} processed parameter fields.")
+        metrics.record_row_count("processed_param_fields", field_count)
+        return fields
+
+    processed_fields_future = submit(fetch_processed_fields)
+
+    # -------------------------------
+    # Param Classification Rules
+    # -------------------------------
+    classifier = get_classifier(prop)
+
+    def is_candidate(source, key):
+        return key not in processed_fields_future.result()[source] and classifier.excluded_by(key) is None
+
+    # -------------------------------
+    # Load Previously Scanned Shards
+    # -------------------------------
+    shard_catalog = {}
+    sampled_suffixes = set()
+    watermarks = {}
+    if incremental and not full_rescan:
+        state_suffixes = suffixes + [f"{INTRADAY_SUFFIX_PREFIX}{date}" for date in intraday_dates]
+        with metrics.timed("load_discovery_state"):
+            shard_catalog, sampled_suffixes, watermarks = load_discovery_state(write_client, prop, state_suffixes)
+        print(f"Discovery state covers {sum(s in shard_catalog for s in suffixes)} of {len(suffixes)} shards "
+              f"({len(sampled_suffixes)} sampled).")
+        if sampled_suffixes and (sampled_full_scan_due or not sampled_discovery):
+            print(f"Scheduling full scan of previously sampled shards: {sorted(sampled_suffixes)}")
+            for suffix in sampled_suffixes:
+                shard_catalog.pop(suffix, None)
+            sampled_suffixes = set()
+    elif incremental:
+        print("Full rescan requested. Ignoring stored discovery state.")
+
+    if target_suffixes:
+        for suffix in target_suffixes:
+            shard_catalog.pop(suffix, None)
+            sampled_suffixes.discard(suffix)
+        suffixes_to_scan = target_suffixes
+    else:
+        suffixes_to_scan = [s for s in suffixes if s not in shard_catalog]
+    print(f"Suffixes to scan: {suffixes_to_scan}")
+
+    # -------------------------------
+    # Estimate and Query Raw Event Params
     # -------------------------------
     raw_key_type_map = {}
-    for row in raw_keys_result:
-        key = row.event_param_key
-        inferred_type = row.inferred_type
-        if key not in raw_key_type_map:
-            raw_key_type_map[key] = inferred_type
-    print(f"Extracted {len(raw_key_type_map)} unique keys from raw data.")
+    raw_key_stats = {}
+    raw_row_count = 0
+    raw_rows_per_second = None
+    scan_plan = None
+    sampling_summary = None
+    intraday_summary = None
+    # Shards read this run; their keys are what the param catalog merges.
+    scanned_this_run = set()
+
+    if suffixes_to_scan and sampled_discovery and not sampled_full_scan_due:
+        # Sample every new shard first. A key only has to show up once to be
+        # detected, so shards whose sample holds no candidate keys stop here
+        # and only shards with candidates get a full scan.
+        sample_plan = make_scan_plan(suffixes_to_scan, "sampled", DISCOVERY_SAMPLE_PERCENT)
+        print(f"Executing sampled raw event parameter query ({DISCOVERY_SAMPLE_PERCENT}% per shard).")
+        sampled_catalog = {}
+        try:
+            for row in run_raw_scan(raw_client, prop, sample_plan, step_name="raw_query_sampled"):
+                raw_row_count += 1
+                add_catalog_row(sampled_catalog, row)
+        except Exception as e:
+            print(f"BigQuery sampled raw query failed: {e}")
+            raise
+
+        candidate_suffixes = sorted(
+            suffix for suffix, sources in sampled_catalog.items()
+            if any(is_candidate(source, key) for source, keys in sources.items() for key in keys)
+        )
+        scanned_this_run.update(sampled_catalog)
+        for suffix, sources in sampled_catalog.items():
+            if suffix not in candidate_suffixes:
+                shard_catalog[suffix] = sources
+                sampled_suffixes.add(suffix)
+        sampling_summary = {
+            "sample_percent": DISCOVERY_SAMPLE_PERCENT,
+            "sampled_suffixes": sorted(sampled_catalog),
+            "full_scan_suffixes": candidate_suffixes,
+        }
+        print(f"Sampling found candidate keys in {len(candidate_suffixes)} of {len(sampled_catalog)} shards.")
+        suffixes_to_scan = candidate_suffixes
+
+    raw_keys_result = []
+    if suffixes_to_scan:
+        try:
+            scan_plan = plan_raw_scan(raw_client, prop, suffixes_to_scan)
+            print(f"Executing raw event parameter query (aggregation mode: {RAW_AGGREGATION_MODE}, "
+                  f"strategy: {scan_plan['strategy']}).")
+            raw_keys_result = run_raw_scan(raw_client, prop, scan_plan)
+        except Exception as e:
+            print(f"BigQuery raw query failed: {e}")
+            raise
+    elif sampling_summary is None:
+        print("All shards already scanned. Skipping raw event parameter query.")
 
     # -------------------------------
-    # Fetch Processed Table Schema
+    # Build Raw Key-Type Mapping
     # -------------------------------
-    print("Fetching schema from processed table.")
-    processed_table = write_client.get_table(PROCESSED_TABLE_ID)
-    processed_fields = set(
-        field.name.replace("_event_param", "")
-        for field in processed_table.schema
-        if field.name.endswith("_event_param")
-    )
-    print(f"Found {len(processed_fields)} processed parameter fields.")
-
-    # -------------------------------
-    # Core parameters that should not be added to custom array
-    # -------------------------------
-    core_params = {
-        # Batch parameters
-        'batch_ordering_id', 'batch_page_id',
-        # Page parameters  
-        'page_location', 'page_referrer', 'page_title',
-        # Session parameters
-        'ga_session_id', 'ga_session_number', 'engagement_time_msec', 'session_engaged',
-        'engaged_session_event', 'entrances', 'ignore_referrer', 'synthetic_bundle',
-        # Content parameters
-        'content_group', 'content_id', 'content_type', 'content',
-        # Traffic source parameters
-        'medium', 'campaign', 'source', 'term', 'campaign_info_source',
-        # Click IDs
-        'gclid', 'dclid', 'srsltid', 'aclid', 'cp1', 'anid', 'click_timestamp',
-        # Ecommerce parameters
-        'currency', 'shipping', 'tax', 'value', 'transaction_id', 'coupon', 
-        'payment_type', 'shipping_tier', 'item_list_id', 'item_list_name',
-        'creative_name', 'creative_slot', 'promotion_id', 'promotion_name', 'item_name',
-        # Link tracking
-        'link_classes', 'link_domain', 'link_id', 'link_text', 'link_url', 'outbound',
-        # Video tracking
-        'video_current_time', 'video_duration', 'video_percent', 'video_provider',
-        'video_title', 'video_url',
-        # App parameters
-        'app_version', 'method', 'fatal', 'timestamp',
-        # Other core parameters
-        'reward_type', 'reward_value', 'label', 'language', 'percent_scrolled',
-        'search_term', 'file_extension', 'file_name', 'screen_resolution'
+    if RAW_AGGREGATION_MODE == "server":
+        scanned_catalog = {}
+        for row in raw_keys_result:
+            raw_row_count += 1
+            add_catalog_row(scanned_catalog, row)
+        shard_catalog.update(scanned_catalog)
+        scanned_this_run.update(scanned_catalog)
+        if scan_plan is not None and scan_plan["strategy"] == "sampled":
+            sampled_suffixes.update(scanned_catalog)
+        else:
+            sampled_suffixes.difference_update(scanned_catalog)
+
+        if intraday:
+            try:
+                intraday_summary = scan_intraday_tables(raw_client, prop, shard_catalog, watermarks, intraday_dates)
+            except Exception as e:
+                print(f"BigQuery intraday raw query failed: {e}")
+                raise
+            raw_row_count += intraday_summary["row_count"]
+            scanned_this_run.update(intraday_summary["scanned_suffixes"])
+
+        raw_key_stats = merge_shard_catalog(shard_catalog)
+        if incremental:
+            # Shards outside the look-back window are dropped here. Shards that
+            # returned no rows (not exported yet) are rescanned next run.
+            with metrics.timed("save_discovery_state"):
+                save_discovery_state(write_client, prop, shard_catalog, sampled_suffixes, watermarks)
+    elif RAW_ROWS_READER == "arrow" and hasattr(raw_keys_result, "to_arrow_iterable"):
+        with metrics.timed("raw_rows_reduce"):
+            raw_key_stats, arrow_row_count, raw_rows_per_second = reduce_param_rows_arrow(
+                raw_keys_result, INFERRED_TYPE_ORDER
+            )
+        raw_row_count += arrow_row_count
+    else:
+        rows_start = time.perf_counter()
+        for row in raw_keys_result:
+            raw_row_count += 1
+            stats = raw_key_stats.setdefault((row.source, row.param_key), {
+                "type_counts": {t: 0 for t in INFERRED_TYPE_ORDER},
+            })
+            stats["type_counts"][row.inferred_type] += 1
+        rows_elapsed = time.perf_counter() - rows_start
+        if raw_row_count and rows_elapsed > 0:
+            raw_rows_per_second = round(raw_row_count / rows_elapsed)
+            print(f"Reduced {raw_row_count} raw param rows in {rows_elapsed:.2f}s ({raw_rows_per_second} rows/s).")
+
+    # Shards cataloged while another source was enabled can still hold its keys.
+    raw_key_stats = {
+        source_key: stats for source_key, stats in raw_key_stats.items()
+        if source_key[0] in PARAM_SOURCES_ENABLED
     }
-    
+    type_conflicts = set()
+    for source_key, stats in raw_key_stats.items():
+        resolved_type, conflict = resolve_inferred_type(stats["type_counts"])
+        stats["resolved_type"] = resolved_type
+        raw_key_type_map[source_key] = resolved_type
+        if conflict:
+            type_conflicts.add(source_key)
+    print(f"Extracted {len(raw_key_type_map)} unique keys from raw data.")
+    metrics.record_row_count("raw_rows", raw_row_count)
+    if raw_rows_per_second is not None:
+        metrics.record_row_count("raw_rows_per_second", raw_rows_per_second)
+    metrics.record_row_count("raw_keys", len(raw_key_type_map))
+
     # -------------------------------
-    # Identify Missing Keys (excluding core parameters)
+    # Identify Missing Keys (excluding classified params)
     # -------------------------------
-    missing_keys = [
-        (key, raw_key_type_map[key])
-        for key in raw_key_type_map
-        if key not in processed_fields and key not in core_params
-    ]
+    # Surface a failed schema fetch even when no raw keys were found.
+    processed_fields = processed_fields_future.result()
+    catalog_summary = None
+    catalog_pending = {}
+    if PARAM_CATALOG_ENABLED:
+        if RAW_AGGREGATION_MODE == "server":
+            observed_keys = {
+                (source, key)
+                for suffix in scanned_this_run if suffix in shard_catalog
+                for source, keys in shard_catalog[suffix].items()
+                for key in keys
+            }
+        else:
+            observed_keys = set(raw_key_stats)
+        scan_dates = [shard_date(s) for s in suffixes_to_scan] or [today.isoformat()]
+        missing_keys, candidate_conflicts, catalog_pending, catalog_summary = diff_with_param_catalog(
+            write_client, prop, raw_key_stats, type_conflicts, observed_keys,
+            processed_fields, classifier, (min(scan_dates), max(scan_dates))
+        )
+    else:
+        missing_keys = [
+            (source, key, raw_key_type_map[(source, key)])
+            for source, key in sorted(raw_key_type_map)
+            if is_candidate(source, key) and (source, key) not in type_conflicts
+        ]
+        candidate_conflicts = {
+            (source, key): raw_key_stats[(source, key)]["type_counts"]
+            for source, key in type_conflicts
+            if is_candidate(source, key)
+        }
+    if candidate_conflicts:
+        print(f"Held back {len(candidate_conflicts)} keys with conflicting types: {sorted(candidate_conflicts)}")
+    type_resolution = {"rule": TYPE_RESOLUTION_RULE, "conflicts": group_by_source(candidate_conflicts)}
     
-    # Log skipped core parameters
-    skipped_core = [key for key in raw_key_type_map if key in core_params]
-    if skipped_core:
-        print(f"Skipped {len(skipped_core)} core parameters: {skipped_core}")
+    # Log skipped params with the rule that excluded each one
+    skipped_params = {}
+    for source, key in raw_key_type_map:
+        rule = classifier.excluded_by(key)
+        if rule is not None:
+            skipped_params[(source, key)] = rule
+    if skipped_params:
+        print(f"Skipped {len(skipped_params)} excluded parameters: "
+              f"{sorted(f'{source}.{key} ({rule})' for (source, key), rule in skipped_params.items())}")
     
     print(f"Identified {len(missing_keys)} missing keys to be added.")
 
-    rows_to_insert = [
-        {"field_name": key, "field_type": dtype}
-        for key, dtype in missing_keys
+    missing_fields = [
+        {"field_name": key, "field_type": dtype, "source": source}
+        for source, key, dtype in missing_keys
     ]
 
     # -------------------------------
     # Handle Case: No Missing Fields
     # -------------------------------
-    if not rows_to_insert:
-        print("No missing fields to insert into temp table.")
+    if not missing_fields:
+        print("No missing fields found.")
         return {
-            "written_table": table_id,
+            "written_table": None,
             "missing_count": 0,
-            "fields": []
+            "fields": [],
+            "scanned_suffixes": suffixes_to_scan,
+            "scan_plan": scan_plan,
+            "sampling": sampling_summary,
+            "intraday": intraday_summary,
+            "param_catalog": catalog_summary,
+            "type_resolution": type_resolution,
+            "raw_rows_per_second": raw_rows_per_second
         }
 
     # -------------------------------
-    # Create Temp Table with found mismatches
-    # -------------------------------
-    table_schema = [
-        bigquery.SchemaField("field_name", "STRING"),
-        bigquery.SchemaField("field_type", "STRING"),
-    ]
-    print(f"Creating temp table: {table_id}")
-    table_ref = bigquery.Table(table_id, schema=table_schema)
-
-    try:
-        write_client.create_table(table_ref)
-        print(f"Created temp table: {table_id}")
-    except Conflict:
-        print(f"Temp table {table_id} already exists. Skipping creation.")
-    except Exception as e:
-        print(f"Failed to create temp table {table_id}: {e}")
-        raise
-
-    # -------------------------------
-    # Insert Missing Fields into Temp Table
+    # Persist Schema Diff for Auditing (optional)
     # -------------------------------
-    print(f"Inserting {len(rows_to_insert)} rows into temp table.")
-    errors = write_client.insert_rows_json(table_id, rows_to_insert)
-    if errors:
-        print("Insert errors:", errors)
+    # Later stages receive the diff in memory; the table is only an audit
+    # record, written with a single load job so there is no streaming buffer.
+    written_table = None
+    if PERSIST_SCHEMA_DIFF:
+        written_table = get_state_table_id(prop, TEMP_TABLE)
+        job_config = bigquery.LoadJobConfig(
+            schema=[
+                bigquery.SchemaField("field_name", "STRING"),
+                bigquery.SchemaField("field_type", "STRING"),
+                bigquery.SchemaField("source", "STRING"),
+            ],
+            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+        )
+        print(f"Writing {len(missing_fields)} missing fields to audit table: {written_table}")
+        try:
+            with metrics.timed("write_audit_table"):
+                write_client.load_table_from_json(missing_fields, written_table, job_config=job_config).result()
+        except Exception as e:
+            # The audit copy is not needed by later stages, so a failure
+            # here should not block the schema update.
+            print(f"Failed to write audit table {written_table}: {e}")
+            written_table = None
 
     return {
-        "written_table": table_id,
+        "written_table": written_table,
         "missing_count": len(missing_keys),
-        "fields": rows_to_insert,
-        "skipped_core_params": len([key for key in raw_key_type_map if key in core_params])
+        "fields": missing_fields,
+        "scanned_suffixes": suffixes_to_scan,
+        "scan_plan": scan_plan,
+        "sampling": sampling_summary,
+        "intraday": intraday_summary,
+        "param_catalog": catalog_summary,
+        "type_resolution": type_resolution,
+        "raw_rows_per_second": raw_rows_per_second,
+        "missing_key_stats": group_by_source({
+            (source, key): raw_key_stats.get((source, key)) or catalog_pending[(source, key)]
+            for source, key, _ in missing_keys
+        }),
+        "skipped_params": group_by_source(skipped_params)
     }
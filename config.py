@@ -9,8 +9,9 @@ REGION               = "us-west1"
 # -------------------------------
 # Raw Table Configuration
 # -------------------------------
-RAW_DATASET          = "analytics_374935609"
-RAW_TABLE_PATTERN    = "events_*"
+RAW_DATASET            = "analytics_374935609"
+RAW_TABLE_PATTERN      = "events_*"
+INTRADAY_TABLE_PATTERN = "events_intraday_*"
 
 # -------------------------------
 # Processed Table (Dataform)
@@ -21,12 +22,156 @@ PROCESSED_TABLE_ID   = "ga4-dataform.GA4Dataform_374935609.ga4_events"
 # Temporary Output Table
 # -------------------------------
 TEMP_DATASET         = "GA4Dataform_374935609"
-TEMP_TABLE           = "missing_event_params_schema"
+TEMP_TABLE           = "missing_event_params_schema"   # Suffixed with _<property_id>
+PERSIST_SCHEMA_DIFF  = True                            # Write the diff to TEMP_TABLE as an audit record
 
 # -------------------------------
 # Schema Comparison Settings
 # -------------------------------
 DAYS_TO_LOOK_BACK    = 7
+RAW_AGGREGATION_MODE = "server"                  # "server" (GROUP BY in BigQuery) or "rows" (stream every param row)
+RAW_ROWS_READER      = "arrow"                   # Rows mode reader: "arrow" (record batches, vectorized) or "rows" (Row iterator)
+TYPE_RESOLUTION_RULE = "majority"                # "majority", "widening" or "conflict" (see compare_event_params.py)
+TYPE_NOISE_SHARE     = 0.001                     # Inferred types below this share of a key's values are ignored
+
+# -------------------------------
+# Param Sources
+# -------------------------------
+# Repeated key/value fields discovered in one raw scan. Each source gets its
+# own column suffix in the processed table and its own array in config.js.
+# A source with a "record" repeats once per element of that record, so its
+# params are fields of the record (built by Dataform from config.js) rather
+# than top-level columns added with ALTER TABLE.
+PARAM_SOURCES = {
+    "event_params": {
+        "column_suffix": "_event_param",
+        "config_array": "CUSTOM_EVENT_PARAMS_ARRAY",
+    },
+    "user_properties": {
+        "column_suffix": "_user_property",
+        "config_array": "CUSTOM_USER_PROPERTIES_ARRAY",
+    },
+    "items": {
+        "column_suffix": "_item_param",
+        "config_array": "CUSTOM_ITEM_PARAMS_ARRAY",
+        "record": "items",
+    },
+}
+PARAM_SOURCES_ENABLED = ["event_params"]        # Add "user_properties" and "items" once config.js has their arrays
+
+# -------------------------------
+# Raw Scan Cost Guardrails
+# -------------------------------
+RAW_SCAN_BYTES_BUDGET            = 200 * 1024 ** 3   # Dry-run estimate above this triggers a cheaper strategy
+RAW_SCAN_MAX_BYTES_BILLED        = 500 * 1024 ** 3   # Hard cap passed to BigQuery as maximum_bytes_billed
+RAW_SCAN_MIN_DAYS                = 1                 # Fewest shards the reduced_days fallback will scan
+RAW_SCAN_FALLBACK_SAMPLE_PERCENT = 10                # TABLESAMPLE percentage used when fewer days are still over budget
+
+# -------------------------------
+# Sampled Discovery
+# -------------------------------
+SAMPLED_DISCOVERY                   = False      # Sample new shards first, full-scan only shards with candidate keys
+DISCOVERY_SAMPLE_PERCENT            = 5          # TABLESAMPLE SYSTEM percentage for the sampling pass
+SAMPLED_DISCOVERY_FULL_SCAN_WEEKDAY = 6          # UTC weekday (Mon=0) on which sampled shards are fully rescanned
+
+# -------------------------------
+# Incremental Discovery State
+# -------------------------------
+INCREMENTAL_DISCOVERY      = True                # Only scan shards not already in the discovery state
+FULL_RESCAN                = False               # Ignore the stored state and rescan every shard
+DISCOVERY_STATE_BACKEND    = "bigquery"          # "bigquery" or "local"
+DISCOVERY_STATE_TABLE      = "param_discovery_state"   # Suffixed with _<property_id>
+DISCOVERY_STATE_LOCAL_PATH = "/tmp/param_discovery_state_{property_id}.json"
+
+# -------------------------------
+# Intraday Detection
+# -------------------------------
+# Also scans the streaming `events_intraday_*` tables, reading only rows
+# appended since each table's watermark. Keys land in the same discovery
+# state as the daily shards, so schedule a trigger every few minutes to
+# promote new params the same day. Needs INCREMENTAL_DISCOVERY and
+# RAW_AGGREGATION_MODE = "server".
+INTRADAY_DISCOVERY            = False
+INTRADAY_DAYS                 = 2                # Intraday tables checked: today and yesterday (until its daily export lands)
+INTRADAY_COMMIT_LAG_SECONDS   = 120              # Watermark trails now by this much so rows still being committed are not skipped
+
+# -------------------------------
+# Param Catalog
+# -------------------------------
+# Every key seen in the raw export, with its status (pending, added, excluded
+# or expired) and the ALTER job and commit that added it. Each run merges the
+# keys of the shards it scanned and reads the diff from the pending rows.
+PARAM_CATALOG_ENABLED     = True
+PARAM_CATALOG_TABLE       = "event_param_catalog"     # Suffixed with _<property_id>
+PARAM_CATALOG_EXPIRE_DAYS = 30                   # Pending keys not seen for this long are marked expired and never added
+
+# -------------------------------
+# Param Classification
+# -------------------------------
+# Keys matching these rules are never added, on top of the core GA4 params in
+# param_classifier.py. Example: {"exact": [], "prefix": ["gtm."], "regex": ["^debug_"]}.
+# Properties can add "param_deny" rules of the same shape, and "param_allow"
+# rules that override every exclusion.
+PARAM_EXCLUDE_RULES = {"exact": [], "prefix": [], "regex": []}
+
+# -------------------------------
+# Processed Table Schema Cache
+# -------------------------------
+SCHEMA_CACHE_BACKEND     = "memory"            # "memory", "local" or "gcs"; snapshots are always kept in memory too
+SCHEMA_CACHE_LOCAL_PATH  = "/tmp/processed_schema_{property_id}.json"
+SCHEMA_CACHE_GCS_BUCKET  = f"{WRITE_PROJECT_ID}-param-discovery"
+SCHEMA_CACHE_GCS_OBJECT  = "schema_cache/{property_id}.json"
+
+# -------------------------------
+# ALTER TABLE Execution
+# -------------------------------
+# BigQuery allows about 5 table metadata updates per 10 seconds per table.
+ALTER_MAX_COLUMNS_PER_STATEMENT = 100            # ADD COLUMN clauses per ALTER TABLE statement
+ALTER_MIN_INTERVAL_SECONDS      = 2              # Minimum spacing between chunk submissions
+ALTER_MAX_ATTEMPTS              = 5              # Attempts per chunk on rate-limit and 5xx errors
+ALTER_BACKOFF_BASE_SECONDS      = 2              # First retry delay, doubled per attempt (with jitter)
+ALTER_BACKOFF_MAX_SECONDS       = 60
+
+# -------------------------------
+# Backfill of New Columns
+# -------------------------------
+# Partitions are not backfilled while a Dataform invocation recorded by
+# DATAFORM_TRACK_INVOCATIONS is still running.
+BACKFILL_ENABLED               = False             # Fill new param columns on past partitions from the raw shards
+BACKFILL_MAX_DAYS              = 30                # Only partitions from the last N days are backfilled
+BACKFILL_MAX_CONCURRENT_JOBS   = 2                 # Concurrent partition UPDATE jobs
+BACKFILL_MAX_BYTES_BILLED      = 100 * 1024 ** 3   # maximum_bytes_billed per partition UPDATE
+BACKFILL_PARTITION_COLUMN      = "event_date"      # DATE partition column of the processed table
+BACKFILL_JOIN_KEYS             = ["user_pseudo_id", "event_timestamp", "event_name"]  # Columns matching processed rows to raw events
+BACKFILL_STATE_TABLE           = "param_backfill_state"   # Suffixed with _<property_id>
+BACKFILL_MIN_REMAINING_SECONDS = 120               # No partition job is started with less of the run deadline left
+
+# -------------------------------
+# Trigger Dedupe and Coalescing
+# -------------------------------
+# The GCS bucket is created by cloudbuild.yaml; see trigger_control.py for
+# the objects kept in it.
+TRIGGER_STATE_BACKEND                   = "gcs"  # "gcs", or "local" for an in-process stand-in
+TRIGGER_STATE_GCS_BUCKET                = SCHEMA_CACHE_GCS_BUCKET
+TRIGGER_COALESCE_WINDOW_SECONDS         = 15     # Lease holder waits this long so a burst of pushes lands in one run
+TRIGGER_MAX_FOLLOW_UP_RUNS              = 2      # Extra runs for triggers that arrived during a run
+TRIGGER_FOLLOW_UP_MIN_REMAINING_SECONDS = 300    # A follow-up run only starts with this much of the run deadline left
+TRIGGER_LEASE_TTL_SECONDS               = 600    # Just above the 540s function timeout; older leases are abandoned
+TRIGGER_SEEN_MESSAGE_CACHE_SIZE         = 10000  # Message IDs remembered by the local backend
+
+# -------------------------------
+# Pull Worker
+# -------------------------------
+# Ack deadlines of messages in a running batch are extended as soon as they
+# are pulled and then on a timer, so a batch may run longer than the
+# subscription's own ack deadline (cloudbuild.yaml sets it to
+# PULL_ACK_DEADLINE_SECONDS as well).
+PULL_SUBSCRIPTION                    = f"projects/{PROJECT_ID}/subscriptions/ga4-param-discovery-pull"
+PULL_MAX_MESSAGES                    = 100       # Messages merged into one batch run
+PULL_BATCH_WINDOW_SECONDS            = 30        # Keep pulling this long after the first message of a batch
+PULL_WAIT_TIMEOUT_SECONDS            = 60        # Longest single pull while waiting for work
+PULL_ACK_DEADLINE_SECONDS            = 120       # Ack deadline set on each extension (Pub/Sub max 600)
+PULL_ACK_EXTENSION_FRACTION          = 0.5       # Re-extend after this fraction of PULL_ACK_DEADLINE_SECONDS
 
 # -------------------------------
 # GitHub Configuration
@@ -36,9 +181,57 @@ FILE_PATH            = "includes/custom/config.js"
 BRANCH               = "main"
 COMMIT_MESSAGE       = "Update CUSTOM_EVENT_PARAMS_ARRAY in config.js"
 
+# -------------------------------
+# Client and Credential Reuse
+# -------------------------------
+GITHUB_TOKEN_TTL_SECONDS           = 3600        # Re-read the GitHub token from Secret Manager after this
+OAUTH_TOKEN_REFRESH_MARGIN_SECONDS = 300         # Refresh the OAuth token this long before it expires
+HTTP_POOL_MAXSIZE                  = 10          # Keep-alive connections per host
+
+# -------------------------------
+# External Call Resilience
+# -------------------------------
+# GitHub, Secret Manager and Dataform calls share one run deadline, kept
+# under the 540s function timeout so a slow dependency fails the run cleanly.
+RUN_DEADLINE_SECONDS               = 480           # Budget for retries and timeouts across one invocation or batch
+HTTP_CONNECT_TIMEOUT_SECONDS       = 5
+HTTP_READ_TIMEOUT_SECONDS          = 30            # Per attempt; shortened to the time left before the deadline
+SECRET_MANAGER_TIMEOUT_SECONDS     = 10
+EXTERNAL_CALL_MAX_ATTEMPTS         = 4             # Attempts on timeouts, connection errors, 429 and 5xx
+EXTERNAL_CALL_BACKOFF_BASE_SECONDS = 0.5           # Full-jitter backoff, doubled per attempt
+EXTERNAL_CALL_BACKOFF_MAX_SECONDS  = 8
+HTTP_HEDGE_AFTER_SECONDS           = 2.0           # A GET still pending after this gets a second, racing request; 0 disables
+CIRCUIT_FAILURE_THRESHOLD          = 5             # Consecutive failed attempts that open a dependency's circuit
+CIRCUIT_OPEN_SECONDS               = 60            # Calls fail fast for this long before one trial call is let through
+GITHUB_CONFLICT_MAX_ATTEMPTS       = 3             # config.js re-fetch and re-apply rounds on a 409 (stale sha)
+
 # -------------------------------
 # Dataform API Execution Constants
 # -------------------------------
 REPO_ID              = "OneOrigin-GA4-Dataform"      # Repository ID in Dataform
 RELEASE_ID           = "custom_event_params_1"             # Release config name
 WORKFLOW_ID          = "automation_test"                 # Workflow config name
+
+DATAFORM_INVOCATION_MODE           = "compilation_result"  # "compilation_result" (compile the pushed commit) or "workflow_config"
+DATAFORM_TRACK_INVOCATIONS         = True        # Record invocations and poll them from later runs and scheduled polls
+DATAFORM_INVOCATION_TABLE          = "dataform_invocations"   # Suffixed with _<property_id>
+DATAFORM_POLL_TIMEOUT_SECONDS      = 6 * 3600    # Give up and record POLL_TIMEOUT after this
+
+# -------------------------------
+# Property Registry
+# -------------------------------
+# One entry per GA4 property. Keys left out fall back to the single-property
+# constants above (see properties.py).
+PROPERTIES = [
+    {
+        "property_id":        "374935609",
+        "raw_dataset":        RAW_DATASET,
+        "processed_table_id": PROCESSED_TABLE_ID,
+        "temp_dataset":       TEMP_DATASET,
+        "repo":               REPO,
+        "repo_id":            REPO_ID,
+        "workflow_id":        WORKFLOW_ID,
+    },
+]
+PROPERTY_MAX_WORKERS = 4                         # Properties processed concurrently per invocation
+PIPELINE_MAX_WORKERS = 4                         # Concurrent I/O calls within one property's pipeline
@@ -0,0 +1,183 @@
+import re
+
+# -------------------------------
+# config.js tokenizer
+# -------------------------------
+# Just enough of JavaScript to find a `KEY: [ {...}, ... ]` array in the
+# Dataform config and locate its entries: identifiers, string literals and
+# punctuation, with whitespace and comments skipped. Comments, including
+# commented-out arrays and entries, are never matched and never rewritten.
+
+CLOSING = {"[": "]", "{": "}", "(": ")"}
+
+class ConfigParseError(Exception):
+    pass
+
+def tokenize(content):
+    tokens = []
+    i, n = 0, len(content)
+    while i < n:
+        ch = content[i]
+        if ch.isspace():
+            i += 1
+        elif content.startswith("//", i):
+            end = content.find("\n", i)
+            i = n if end == -1 else end
+        elif content.startswith("/*", i):
+            end = content.find("*/", i + 2)
+            if end == -1:
+                raise ConfigParseError("Unterminated block comment.")
+            i = end + 2
+        elif ch in "\"'`":
+            j = i + 1
+            value = []
+            while j < n and content[j] != ch:
+                if content[j] == "\\" and j + 1 < n:
+                    value.append(content[j + 1])
+                    j += 2
+                else:
+                    value.append(content[j])
+                    j += 1
+            if j >= n:
+                raise ConfigParseError(f"Unterminated string starting at offset {i}.")
+            tokens.append(("string", "".join(value), i, j + 1))
+            i = j + 1
+        elif ch.isalnum() or ch in "_$":
+            j = i
+            while j < n and (content[j].isalnum() or content[j] in "_$"):
+                j += 1
+            tokens.append(("ident", content[i:j], i, j))
+            i = j
+        else:
+            tokens.append(("punct", ch, i, i + 1))
+            i += 1
+    return tokens
+
+# -------------------------------
+# Array parsing
+# -------------------------------
+def find_array(content, array_name, tokens=None):
+    # Returns {"open", "close", "entries"} for the first `array_name: [...]`
+    # outside comments. Each entry has its span, a trailing-comma flag and the
+    # string-valued fields of its object literal. The historical CUSTM_
+    # misspelling of the array names is accepted.
+    tokens = tokens if tokens is not None else tokenize(content)
+    name_pattern = re.compile(re.escape(array_name).replace("CUSTOM", "CUSTO?M", 1))
+    for k in range(len(tokens) - 2):
+        kind, value = tokens[k][0], tokens[k][1]
+        if (kind in ("ident", "string") and name_pattern.fullmatch(value)
+                and tokens[k + 1][1] == ":" and tokens[k + 1][0] == "punct"
+                and tokens[k + 2][1] == "[" and tokens[k + 2][0] == "punct"):
+            return _parse_array(tokens, k + 2)
+    return None
+
+def _parse_array(tokens, open_index):
+    stack = []
+    entries = []
+    element = None
+    for k in range(open_index, len(tokens)):
+        kind, value, start, end = tokens[k]
+        if kind == "punct" and value in CLOSING:
+            stack.append(CLOSING[value])
+            if len(stack) == 2 and element is None:
+                element = {"start": start, "first": k}
+            continue
+        if kind == "punct" and value in CLOSING.values():
+            if not stack or stack.pop() != value:
+                raise ConfigParseError(f"Unbalanced '{value}' at offset {start}.")
+            if not stack:
+                if element is not None:
+                    entries.append(_close_element(tokens, element, k - 1, trailing_comma=False))
+                return {"open": tokens[open_index][3], "close": start, "entries": entries}
+            continue
+        if len(stack) == 1:
+            if kind == "punct" and value == ",":
+                if element is not None:
+                    entries.append(_close_element(tokens, element, k - 1, trailing_comma=True))
+                    element = None
+            elif element is None:
+                element = {"start": start, "first": k}
+    raise ConfigParseError("Unterminated array.")
+
+def _close_element(tokens, element, last, trailing_comma):
+    fields = {}
+    body = tokens[element["first"]:last + 1]
+    if body and body[0][1] == "{":
+        # Top-level `key: "string"` pairs of the object literal.
+        depth = 0
+        for k, (kind, value, _, _) in enumerate(body):
+            if kind == "punct" and value in CLOSING:
+                depth += 1
+            elif kind == "punct" and value in CLOSING.values():
+                depth -= 1
+            elif (depth == 1 and kind in ("ident", "string") and k + 2 < len(body)
+                    and body[k + 1][1] == ":" and body[k + 2][0] == "string"):
+                fields[value] = body[k + 2][1]
+    return {
+        "start": element["start"],
+        "end": tokens[last][3],
+        "trailing_comma": trailing_comma,
+        "fields": fields,
+    }
+
+def _insert_point(content, entry):
+    # An entry that starts its line (after any leading block comment) gets new
+    # entries inserted at the line's indentation, so the comment stays with
+    # the entry it annotates.
+    line_start = content.rfind("\n", 0, entry["start"]) + 1
+    prefix = content[line_start:entry["start"]]
+    stripped = prefix.strip()
+    if not stripped or (stripped.startswith("/*") and stripped.endswith("*/")):
+        return line_start + len(prefix) - len(prefix.lstrip())
+    return entry["start"]
+
+def _line_indent(content, pos):
+    line_start = content.rfind("\n", 0, pos) + 1
+    indent = content[line_start:pos]
+    return indent if not indent.strip() else re.match(r"\s*", indent).group(0)
+
+# -------------------------------
+# Entry insertion
+# -------------------------------
+def render_entry(param):
+    return f'{{ name: "{param["name"]}", type: "{param["type"]}", renameTo: "{param["renameTo"]}" }}'
+
+def insert_entries(content, array, new_params):
+    # Inserts rendered entries in name order relative to the existing entries
+    # and leaves every other byte of the file untouched.
+    if not new_params:
+        return content
+    entries = array["entries"]
+    new_params = sorted(new_params, key=lambda p: p["name"])
+
+    if not entries:
+        base_indent = _line_indent(content, array["close"])
+        indent = base_indent + "    "
+        body = ",\n".join(indent + render_entry(p) for p in new_params)
+        return content[:array["open"]] + "\n" + body + "\n" + base_indent + content[array["close"]:]
+
+    indent = _line_indent(content, entries[0]["start"])
+    same_line = "\n" not in content[entries[0]["start"]:entries[-1]["end"]] and len(entries) > 1
+    separator = ", " if same_line else ",\n" + indent
+
+    insertions = {}
+    for param in new_params:
+        before = next(
+            (e for e in entries if e["fields"].get("name", "") > param["name"]),
+            None
+        )
+        if before is not None:
+            insertions.setdefault(_insert_point(content, before), []).append(render_entry(param) + separator)
+        else:
+            last = entries[-1]
+            if last["trailing_comma"]:
+                pos = content.index(",", last["end"]) + 1
+                text = separator[1:] + render_entry(param) + ","
+            else:
+                pos = last["end"]
+                text = separator + render_entry(param)
+            insertions.setdefault(pos, []).append(text)
+
+    for pos in sorted(insertions, reverse=True):
+        content = content[:pos] + "".join(insertions[pos]) + content[pos:]
+    return content
@@ -0,0 +1,139 @@
+import json
+import os
+from datetime import datetime
+from google.cloud import bigquery
+from google.api_core.exceptions import NotFound
+import metrics
+from properties import get_state_table_id
+from config import (
+    DISCOVERY_STATE_BACKEND,
+    DISCOVERY_STATE_TABLE,
+    DISCOVERY_STATE_LOCAL_PATH
+)
+
+# -------------------------------
+# Per-shard key catalog
+# -------------------------------
+# The state maps each scanned `events_YYYYMMDD` suffix to the keys found in it
+# per param source, with their per-type counts:
+#     {"20240101": {"event_params": {"my_param": {"STRING": 10, "INT64": 0, "FLOAT64": 0}}}}
+# A suffix present in the state is treated as already scanned. Suffixes whose
+# counts came from a TABLESAMPLE scan are tracked separately so they can be
+# fully scanned later.
+#
+# Intraday tables are cataloged under their `events_*` wildcard suffix
+# (`intraday_YYYYMMDD`) with the counts of every row read so far, plus a
+# watermark: the change timestamp up to which appended rows have been read.
+
+STATE_TABLE_SCHEMA = [
+    bigquery.SchemaField("table_suffix", "STRING"),
+    bigquery.SchemaField("source", "STRING"),
+    bigquery.SchemaField("param_key", "STRING"),
+    bigquery.SchemaField("string_count", "INT64"),
+    bigquery.SchemaField("int64_count", "INT64"),
+    bigquery.SchemaField("float64_count", "INT64"),
+    bigquery.SchemaField("sampled", "BOOL"),
+    bigquery.SchemaField("appended_until", "TIMESTAMP"),
+]
+
+def load_discovery_state(client, prop, suffixes):
+    # Returns (state, sampled_suffixes, watermarks), where watermarks maps
+    # intraday suffixes to their appended_until datetime.
+    if DISCOVERY_STATE_BACKEND == "local":
+        return _load_local_state(prop, suffixes)
+
+    table_id = get_state_table_id(prop, DISCOVERY_STATE_TABLE)
+    suffix_filter = ",".join([f"'{s}'" for s in suffixes])
+    # SELECT * so a state table written before appended_until existed still loads.
+    query = f"""
+        SELECT *
+        FROM `{table_id}`
+        WHERE table_suffix IN ({suffix_filter})
+    """
+    print(f"Loading discovery state from: {table_id}")
+    try:
+        job = client.query(query)
+        result = job.result()
+    except NotFound:
+        print(f"Discovery state table not found: {table_id}. Starting from empty state.")
+        return {}, set(), {}
+
+    metrics.record_query_job("load_discovery_state", job)
+    state = {}
+    sampled_suffixes = set()
+    watermarks = {}
+    for row in result:
+        state.setdefault(row.table_suffix, {}).setdefault(row.source, {})[row.param_key] = {
+            "STRING": row.string_count,
+            "INT64": row.int64_count,
+            "FLOAT64": row.float64_count,
+        }
+        if row.sampled:
+            sampled_suffixes.add(row.table_suffix)
+        appended_until = getattr(row, "appended_until", None)
+        if appended_until is not None:
+            watermarks[row.table_suffix] = appended_until
+    return state, sampled_suffixes, watermarks
+
+def save_discovery_state(client, prop, state, sampled_suffixes=(), watermarks=None):
+    watermarks = {suffix: ts for suffix, ts in (watermarks or {}).items() if suffix in state}
+    if DISCOVERY_STATE_BACKEND == "local":
+        return _save_local_state(prop, state, sampled_suffixes, watermarks)
+
+    table_id = get_state_table_id(prop, DISCOVERY_STATE_TABLE)
+    rows = [
+        {
+            "table_suffix": suffix,
+            "source": source,
+            "param_key": key,
+            "string_count": type_counts["STRING"],
+            "int64_count": type_counts["INT64"],
+            "float64_count": type_counts["FLOAT64"],
+            "sampled": suffix in sampled_suffixes,
+            "appended_until": watermarks[suffix].isoformat() if suffix in watermarks else None,
+        }
+        for suffix, sources in state.items()
+        for source, keys in sources.items()
+        for key, type_counts in keys.items()
+    ]
+    # The state only ever holds the current look-back window, so it is
+    # rewritten with a single load job rather than appended to.
+    job_config = bigquery.LoadJobConfig(
+        schema=STATE_TABLE_SCHEMA,
+        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+    )
+    print(f"Saving discovery state for {len(state)} shards to: {table_id}")
+    client.load_table_from_json(rows, table_id, job_config=job_config).result()
+
+# -------------------------------
+# Local-file stand-in
+# -------------------------------
+def _local_state_path(prop):
+    return DISCOVERY_STATE_LOCAL_PATH.format(property_id=prop["property_id"])
+
+def _load_local_state(prop, suffixes):
+    path = _local_state_path(prop)
+    if not os.path.exists(path):
+        print(f"Discovery state file not found: {path}. Starting from empty state.")
+        return {}, set(), {}
+    with open(path) as f:
+        state = json.load(f)
+    shards = {suffix: keys for suffix, keys in state["shards"].items() if suffix in suffixes}
+    sampled_suffixes = {suffix for suffix in state["sampled_suffixes"] if suffix in shards}
+    watermarks = {
+        suffix: datetime.fromisoformat(ts)
+        for suffix, ts in state.get("watermarks", {}).items() if suffix in shards
+    }
+    return shards, sampled_suffixes, watermarks
+
+def _save_local_state(prop, state, sampled_suffixes, watermarks):
+    path = _local_state_path(prop)
+    print(f"Saving discovery state for {len(state)} shards to: {path}")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({
+            "shards": state,
+            "sampled_suffixes": sorted(s for s in sampled_suffixes if s in state),
+            "watermarks": {suffix: ts.isoformat() for suffix, ts in watermarks.items()},
+        }, f)
+    os.replace(tmp_path, path)
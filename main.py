@@ -1,12 +1,22 @@
+import re
 import traceback
 import base64
 from flask import Request, jsonify
 
-from compare_event_params import compare_event_params_and_store_schema_diff
-from alter_table_event_params import alter_processed_table_with_missing_event_params
-from update_dataform_config import update_config_file_with_new_params
+import metrics
+from resilience import start_deadline
+from startup_timing import log_startup_report_if_changed
+from properties import select_properties
+from pipeline import load_stage, run_coalesced_pipelines, poll_dataform_invocations
+from trigger_control import is_message_processed, mark_message_processed
+
+# A `recall_check` attribute names one daily shard and ends up in SQL, so it
+# must be a bare YYYYMMDD suffix.
+RECALL_CHECK_SUFFIX_PATTERN = re.compile(r"\d{8}")
 
 def app(request: Request):
+    run_metrics = metrics.start_run()
+    start_deadline()
     try:
         print("Incoming request to Cloud Run function.")
 
@@ -33,49 +43,102 @@ def app(request: Request):
             traceback.print_exc()
             return "Bad Request: Failed to decode Pub/Sub message.", 400
 
-        # -----------------------
-        # Step 1: Compare Schemas
-        # -----------------------
-        print("Starting schema comparison...")
-        compare_result = compare_event_params_and_store_schema_diff(request)
-        print(f"Schema comparison result:\n{compare_result}")
+        message_attributes = request_json['message'].get('attributes') or {}
+
+        # A `recall_check=YYYYMMDD` message attribute only measures how many of
+        # that shard's keys the sampling pass finds, without changing anything.
+        recall_check_suffix = message_attributes.get('recall_check')
+        if recall_check_suffix and not RECALL_CHECK_SUFFIX_PATTERN.fullmatch(str(recall_check_suffix)):
+            print(f"Invalid recall_check attribute: {recall_check_suffix!r}")
+            return "Bad Request: recall_check must be a YYYYMMDD shard suffix.", 400
 
-        # Exit if no mismatches found
-        if compare_result["missing_count"] == 0:
-            print("No mismatches found. The processed Dataform table is up-to-date.")
+        # Pub/Sub delivers at least once, so a message that was already handled
+        # successfully is acknowledged without running again.
+        message_id = request_json['message'].get('messageId') or request_json['message'].get('message_id')
+        if is_message_processed(message_id):
+            print(f"Message {message_id} already processed. Skipping.")
+            return jsonify({"status": "Duplicate", "message_id": message_id}), 200
+
+        # A `full_rescan=true` message attribute bypasses the incremental
+        # discovery state and rescans every shard in the look-back window.
+        full_rescan = str(message_attributes.get('full_rescan', '')).lower() == 'true' or None
+
+        try:
+            properties = select_properties(message_data, message_attributes)
+        except KeyError as e:
+            print(f"Invalid property_id attribute: {e}")
+            return "Bad Request: Unknown property.", 400
+        print(f"Selected properties: {[p['property_id'] for p in properties]}")
+
+        # A `poll_dataform=true` message attribute only polls the tracked
+        # Dataform invocations. Cloud Scheduler sends one periodically
+        # (cloudbuild.yaml), so a finished run is recorded without waiting
+        # for the next export trigger.
+        if str(message_attributes.get('poll_dataform', '')).lower() == 'true':
+            poll_results = {}
+            for prop in properties:
+                try:
+                    poll_results[prop["property_id"]] = poll_dataform_invocations(prop)
+                except Exception as e:
+                    print(f"[{prop['property_id']}] Dataform poll failed: {e}")
+                    traceback.print_exc()
+                    poll_results[prop["property_id"]] = {"status": "Error", "error": str(e)}
             return jsonify({
-                "status": "No Action Needed",
-                "message": "The processed Dataform table already contains all event parameters.",
-                "compare_result": compare_result
+                "status": "Dataform Poll",
+                "properties": poll_results,
+                "metrics": run_metrics.to_dict()
             }), 200
 
-        # -----------------------
-        # Step 2: Alter Table
-        # -----------------------
-        print("Starting table alteration...")
-        alter_result = alter_processed_table_with_missing_event_params()
-        print(f"Table alteration result:\n{alter_result}")
+        if recall_check_suffix:
+            run_sampling_recall_check = load_stage("compare_event_params", "run_sampling_recall_check")
+            with metrics.stage("recall_check"):
+                recall_result = run_sampling_recall_check(recall_check_suffix, prop=properties[0])
+            return jsonify({
+                "status": "Recall Check",
+                "recall_result": recall_result,
+                "metrics": run_metrics.to_dict()
+            }), 200
 
         # -----------------------
-        # Step 3: Update Config
+        # Run Compare, Alter and Config Update per Property
         # -----------------------
-        print("Starting config update...")
-        config_update_result = update_config_file_with_new_params()
-        print(f"Config update result:\n{config_update_result}")
+        property_results = run_coalesced_pipelines(
+            request, properties, full_rescan=full_rescan,
+            message_ids={prop["property_id"]: [message_id] for prop in properties}
+        )
 
+        statuses = {result["status"] for result in property_results.values()}
+        failed = "Error" in statuses or "Partial Failure" in statuses
+        # A coalesced trigger is redelivered until a run is known to cover it.
+        coalesced = "Coalesced" in statuses
+        if failed:
+            status = "Error" if statuses == {"Error"} else "Partial Failure"
+        elif coalesced:
+            status = "Coalesced"
+        elif statuses <= {"No Action Needed", "Covered"}:
+            status = "No Action Needed"
+        else:
+            status = "Success"
+        if not failed and not coalesced:
+            mark_message_processed(message_id)
 
         # -----------------------
-        # Step 4: Print pushed from git
+        # Print pushed from git
         # -----------------------
         print("Build test: This log is pushed from git!")
 
+        # A non-2xx response makes Pub/Sub redeliver, which retries any
+        # property that failed or was coalesced.
         return jsonify({
-            "compare_result": compare_result,
-            "alter_result": alter_result,
-            "config_update_result": config_update_result
-        }), 200
+            "status": status,
+            "properties": property_results,
+            "metrics": run_metrics.to_dict()
+        }), 500 if failed else 429 if coalesced else 200
 
     except Exception as e:
         print(f"Unhandled exception occurred: {e}")
         traceback.print_exc()
-        return jsonify({"error": str(e)}), 500
+        return jsonify({"error": str(e), "metrics": run_metrics.to_dict()}), 500
+
+    finally:
+        log_startup_report_if_changed()
@@ -0,0 +1,136 @@
+import contextvars
+import json
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+# -------------------------------
+# Per-run performance metrics
+# -------------------------------
+# main.app starts a RunMetrics for each invocation and wraps every stage in
+# metrics.stage(). Stage code records BigQuery jobs, sub-step timings and row
+# counts through the module-level helpers below, which are no-ops when no run
+# is active. HTTP latencies are recorded by a response hook on the shared
+# session. Each finished stage is logged as one structured JSON entry.
+
+_current_run = contextvars.ContextVar("current_run", default=None)
+_current_stage = contextvars.ContextVar("current_stage", default=None)
+
+class RunMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self.stages = {}
+
+    def _stage_entry(self, stage_name):
+        return self.stages.setdefault(stage_name, {
+            "wall_ms": None,
+            "timings_ms": {},
+            "bigquery_jobs": [],
+            "http_calls": [],
+            "row_counts": {},
+            "external_calls": [],
+        })
+
+    def add(self, section, value, key=None):
+        stage_name = _current_stage.get() or "unscoped"
+        with self._lock:
+            entry = self._stage_entry(stage_name)
+            if key is None:
+                entry[section].append(value)
+            else:
+                entry[section][key] = value
+
+    def to_dict(self):
+        with self._lock:
+            jobs = [job for stage in self.stages.values() for job in stage["bigquery_jobs"]]
+            return {
+                "total_ms": round((time.perf_counter() - self._start) * 1000, 2),
+                "stages": json.loads(json.dumps(self.stages)),
+                "totals": {
+                    "bytes_processed": sum(job["bytes_processed"] or 0 for job in jobs),
+                    "bytes_billed": sum(job["bytes_billed"] or 0 for job in jobs),
+                    "slot_ms": sum(job["slot_ms"] or 0 for job in jobs),
+                    "http_calls": sum(len(stage["http_calls"]) for stage in self.stages.values()),
+                },
+            }
+
+def start_run():
+    run = RunMetrics()
+    _current_run.set(run)
+    return run
+
+def get_run():
+    return _current_run.get()
+
+@contextmanager
+def stage(stage_name):
+    run = _current_run.get()
+    token = _current_stage.set(stage_name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _current_stage.reset(token)
+        if run is not None:
+            with run._lock:
+                entry = run._stage_entry(stage_name)
+                entry["wall_ms"] = round((time.perf_counter() - start) * 1000, 2)
+                log_entry = {"severity": "INFO", "message": "stage_metrics", "stage": stage_name, **entry}
+            print(json.dumps(log_entry, default=str))
+
+@contextmanager
+def timed(step_name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        run = _current_run.get()
+        if run is not None:
+            run.add("timings_ms", round((time.perf_counter() - start) * 1000, 2), key=step_name)
+
+def record_query_job(step_name, job):
+    run = _current_run.get()
+    if run is None or job is None:
+        return
+    elapsed_ms = None
+    if job.started and job.ended:
+        elapsed_ms = round((job.ended - job.started).total_seconds() * 1000, 2)
+    run.add("bigquery_jobs", {
+        "step": step_name,
+        "job_id": job.job_id,
+        "bytes_processed": getattr(job, "total_bytes_processed", None),
+        "bytes_billed": getattr(job, "total_bytes_billed", None),
+        "slot_ms": getattr(job, "slot_millis", None),
+        "elapsed_ms": elapsed_ms,
+    })
+
+def record_row_count(name, count):
+    run = _current_run.get()
+    if run is not None:
+        run.add("row_counts", count, key=name)
+
+def record_external_call(dependency, label, attempts, outcome):
+    run = _current_run.get()
+    if run is not None:
+        run.add("external_calls", {
+            "dependency": dependency,
+            "call": label,
+            "attempts": attempts,
+            "outcome": outcome,
+        })
+
+def record_http_response(response, *args, **kwargs):
+    # requests response hook, registered on the shared HTTP session.
+    run = _current_run.get()
+    if run is not None:
+        url = urlparse(response.url)
+        run.add("http_calls", {
+            "method": response.request.method,
+            "host": url.netloc,
+            "path": url.path,
+            "status": response.status_code,
+            "latency_ms": round(response.elapsed.total_seconds() * 1000, 2),
+        })
+    return response
@@ -0,0 +1,165 @@
+import json
+from google.cloud import bigquery
+from google.api_core.exceptions import NotFound
+import metrics
+from clients import get_bigquery_client
+from properties import get_property, get_state_table_id
+from config import PARAM_CATALOG_TABLE
+
+# -------------------------------
+# Param catalog table
+# -------------------------------
+# One row per (source, param_key) seen in the raw export:
+#     pending  - a candidate whose column is not in the processed table yet
+#     added    - the column exists; added_by_job and added_commit name the
+#                ALTER job and config.js commit when this pipeline added it
+#     excluded - matched a classification rule (excluded_by)
+#     expired  - stayed pending without being seen for PARAM_CATALOG_EXPIRE_DAYS
+# The table is clustered on status, so reading the pending rows only touches
+# a small slice of it.
+
+def get_catalog_table_id(prop):
+    return get_state_table_id(prop, PARAM_CATALOG_TABLE)
+
+def ensure_catalog_table(client, table_id):
+    print(f"Creating param catalog table: {table_id}")
+    client.query(f"""
+        CREATE TABLE IF NOT EXISTS `{table_id}` (
+            source STRING NOT NULL,
+            param_key STRING NOT NULL,
+            resolved_type STRING,
+            type_conflict BOOL,
+            first_seen DATE,
+            last_seen DATE,
+            status STRING NOT NULL,
+            excluded_by STRING,
+            added_by_job STRING,
+            added_commit STRING,
+            added_at TIMESTAMP,
+            updated_at TIMESTAMP
+        )
+        CLUSTER BY status, source, param_key
+    """).result()
+
+def load_pending_params(client, prop):
+    # Returns ({(source, key): row}, created); created is True when the
+    # catalog did not exist yet, so the caller can seed it from every key in
+    # the look-back window instead of only the shards scanned this run.
+    table_id = get_catalog_table_id(prop)
+    query = f"""
+        SELECT source, param_key, resolved_type, type_conflict, first_seen, last_seen
+        FROM `{table_id}`
+        WHERE status = 'pending'
+    """
+    try:
+        job = client.query(query)
+        result = job.result()
+    except NotFound:
+        ensure_catalog_table(client, table_id)
+        return {}, True
+
+    metrics.record_query_job("load_pending_params", job)
+    return {
+        (row.source, row.param_key): {
+            "source": row.source,
+            "param_key": row.param_key,
+            "resolved_type": row.resolved_type,
+            "type_conflict": bool(row.type_conflict),
+            "first_seen": row.first_seen.isoformat() if row.first_seen else None,
+            "last_seen": row.last_seen.isoformat() if row.last_seen else None,
+        }
+        for row in result
+    }, False
+
+# The rows are passed as one JSON string parameter and unnested in the query,
+# so a run's changes are applied by a single DML statement.
+JSON_ROWS_SQL = """
+            SELECT
+                JSON_VALUE(r, '$.source') AS source,
+                JSON_VALUE(r, '$.param_key') AS param_key,
+                JSON_VALUE(r, '$.resolved_type') AS resolved_type,
+                CAST(JSON_VALUE(r, '$.type_conflict') AS BOOL) AS type_conflict,
+                CAST(JSON_VALUE(r, '$.first_seen') AS DATE) AS first_seen,
+                CAST(JSON_VALUE(r, '$.last_seen') AS DATE) AS last_seen,
+                JSON_VALUE(r, '$.status') AS status,
+                JSON_VALUE(r, '$.excluded_by') AS excluded_by,
+                JSON_VALUE(r, '$.job_id') AS job_id
+            FROM UNNEST(JSON_QUERY_ARRAY(@rows)) AS r"""
+
+def merge_catalog_rows(client, prop, rows):
+    # rows: dicts with source, param_key, resolved_type, type_conflict,
+    # first_seen, last_seen (ISO dates), status and excluded_by.
+    if not rows:
+        return None
+    table_id = get_catalog_table_id(prop)
+    query = f"""
+        MERGE `{table_id}` T
+        USING ({JSON_ROWS_SQL}
+        ) S
+        ON T.source = S.source AND T.param_key = S.param_key
+        WHEN MATCHED THEN UPDATE SET
+            resolved_type = IF(T.status = 'added', T.resolved_type, S.resolved_type),
+            type_conflict = S.type_conflict,
+            first_seen = LEAST(COALESCE(T.first_seen, S.first_seen), COALESCE(S.first_seen, T.first_seen)),
+            last_seen = GREATEST(COALESCE(T.last_seen, S.last_seen), COALESCE(S.last_seen, T.last_seen)),
+            status = S.status,
+            excluded_by = S.excluded_by,
+            added_at = IF(S.status = 'added', COALESCE(T.added_at, CURRENT_TIMESTAMP()), T.added_at),
+            updated_at = CURRENT_TIMESTAMP()
+        WHEN NOT MATCHED THEN INSERT (
+            source, param_key, resolved_type, type_conflict, first_seen, last_seen,
+            status, excluded_by, added_at, updated_at
+        ) VALUES (
+            S.source, S.param_key, S.resolved_type, S.type_conflict, S.first_seen, S.last_seen,
+            S.status, S.excluded_by, IF(S.status = 'added', CURRENT_TIMESTAMP(), NULL), CURRENT_TIMESTAMP()
+        )
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("rows", "STRING", json.dumps(rows)),
+    ])
+    print(f"Merging {len(rows)} keys into param catalog: {table_id}")
+    with metrics.timed("merge_param_catalog"):
+        job = client.query(query, job_config=job_config)
+        job.result()
+    metrics.record_query_job("merge_param_catalog", job)
+    return job.job_id
+
+def mark_params_added(fields, job_ids_by_field=None, commit_sha=None, prop=None):
+    # Records the ALTER job and config.js commit that added each field's
+    # column. job_ids_by_field maps "source.field_name" to the ALTER job id.
+    prop = prop or get_property()
+    if not fields:
+        return {"status": "No changes", "marked": 0}
+    client = get_bigquery_client(prop["write_project_id"])
+    table_id = get_catalog_table_id(prop)
+    rows = []
+    for field in fields:
+        source = field.get("source") or "event_params"
+        rows.append({
+            "source": source,
+            "param_key": field["field_name"],
+            "job_id": (job_ids_by_field or {}).get(f"{source}.{field['field_name']}"),
+        })
+    query = f"""
+        UPDATE `{table_id}` T
+        SET
+            status = 'added',
+            excluded_by = NULL,
+            added_by_job = S.job_id,
+            added_commit = @commit_sha,
+            added_at = CURRENT_TIMESTAMP(),
+            updated_at = CURRENT_TIMESTAMP()
+        FROM ({JSON_ROWS_SQL}
+        ) S
+        WHERE T.source = S.source AND T.param_key = S.param_key
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("rows", "STRING", json.dumps(rows)),
+        bigquery.ScalarQueryParameter("commit_sha", "STRING", commit_sha),
+    ])
+    print(f"Marking {len(rows)} params as added in param catalog: {table_id}")
+    with metrics.timed("mark_params_added"):
+        job = client.query(query, job_config=job_config)
+        job.result()
+    metrics.record_query_job("mark_params_added", job)
+    return {"status": "Success", "marked": len(rows), "job_id": job.job_id}
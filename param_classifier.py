@@ -0,0 +1,135 @@
+import re
+from config import PARAM_EXCLUDE_RULES
+from properties import REGISTERED_PROPERTIES
+
+# -------------------------------
+# Core parameters that should not be added to custom array
+# -------------------------------
+CORE_PARAMS = [
+    # Batch parameters
+    'batch_ordering_id', 'batch_page_id',
+    # Page parameters
+    'page_location', 'page_referrer', 'page_title',
+    # Session parameters
+    'ga_session_id', 'ga_session_number', 'engagement_time_msec', 'session_engaged',
+    'engaged_session_event', 'entrances', 'ignore_referrer', 'synthetic_bundle',
+    # Content parameters
+    'content_group', 'content_id', 'content_type', 'content',
+    # Traffic source parameters
+    'medium', 'campaign', 'source', 'term', 'campaign_info_source',
+    # Click IDs
+    'gclid', 'dclid', 'srsltid', 'aclid', 'cp1', 'anid', 'click_timestamp',
+    # Ecommerce parameters
+    'currency', 'shipping', 'tax', 'value', 'transaction_id', 'coupon',
+    'payment_type', 'shipping_tier', 'item_list_id', 'item_list_name',
+    'creative_name', 'creative_slot', 'promotion_id', 'promotion_name', 'item_name',
+    # Link tracking
+    'link_classes', 'link_domain', 'link_id', 'link_text', 'link_url', 'outbound',
+    # Video tracking
+    'video_current_time', 'video_duration', 'video_percent', 'video_provider',
+    'video_title', 'video_url',
+    # App parameters
+    'app_version', 'method', 'fatal', 'timestamp',
+    # Other core parameters
+    'reward_type', 'reward_value', 'label', 'language', 'percent_scrolled',
+    'search_term', 'file_extension', 'file_name', 'screen_resolution'
+]
+
+# -------------------------------
+# Rule Matching
+# -------------------------------
+# A rule set has the shape {"exact": [...], "prefix": [...], "regex": [...]}.
+# Exact names go into one dict lookup; prefixes and regexes are folded into a
+# single alternation of named groups, so a key is classified with at most one
+# dict lookup and one regex match. A regex that cannot be folded without
+# changing its meaning (inline global flags, its own groups or
+# backreferences) is compiled on its own and searched after the
+# alternation. Each rule is labelled "<origin>:<kind>:<value>" (e.g.
+# "core:exact:page_location", "property:prefix:gtm.") so skipped keys can be
+# traced back to their rule.
+
+class RuleMatcher:
+    def __init__(self, rule_sets):
+        self.exact = {}
+        self.labels = []
+        self.standalone = []
+        alternatives = []
+        for origin, rules in rule_sets:
+            for name in rules.get("exact", ()):
+                self.exact.setdefault(name, f"{origin}:exact:{name}")
+            for prefix in rules.get("prefix", ()):
+                alternatives.append(re.escape(prefix))
+                self.labels.append(f"{origin}:prefix:{prefix}")
+            for pattern in rules.get("regex", ()):
+                label = f"{origin}:regex:{pattern}"
+                try:
+                    compiled = re.compile(pattern)
+                except re.error as e:
+                    raise ValueError(f"Invalid param rule {label}: {e}") from e
+                alternative = f".*?(?:{pattern})"
+                if compiled.groups == 0 and _compiles(alternative):
+                    alternatives.append(alternative)
+                    self.labels.append(label)
+                else:
+                    self.standalone.append((compiled, label))
+        self.pattern = None
+        if alternatives:
+            self.pattern = re.compile(
+                "|".join(f"(?P<r{i}>{alt})" for i, alt in enumerate(alternatives)),
+                re.DOTALL
+            )
+
+    def match(self, key):
+        label = self.exact.get(key)
+        if label is not None:
+            return label
+        if self.pattern is not None:
+            m = self.pattern.match(key)
+            if m is not None:
+                # lastgroup is the outermost rule group, since it closes last.
+                return self.labels[int(m.lastgroup[1:])]
+        for compiled, label in self.standalone:
+            if compiled.search(key):
+                return label
+        return None
+
+def _compiles(pattern):
+    try:
+        re.compile(pattern)
+    except re.error:
+        return False
+    return True
+
+class ParamClassifier:
+    def __init__(self, deny_rule_sets, allow_rules=None):
+        self.deny = RuleMatcher(deny_rule_sets)
+        self.allow = RuleMatcher([("property", allow_rules or {})])
+
+    def excluded_by(self, key):
+        # Returns the label of the rule that excludes the key, or None.
+        label = self.deny.match(key)
+        if label is None or self.allow.match(key) is not None:
+            return None
+        return label
+
+def build_classifier(prop):
+    return ParamClassifier(
+        [
+            ("core", {"exact": CORE_PARAMS}),
+            ("global", PARAM_EXCLUDE_RULES),
+            ("property", prop.get("param_deny") or {}),
+        ],
+        prop.get("param_allow")
+    )
+
+# Compiled once per registered property at import time.
+_classifiers = {
+    property_id: build_classifier(prop)
+    for property_id, prop in REGISTERED_PROPERTIES.items()
+}
+
+def get_classifier(prop):
+    classifier = _classifiers.get(prop["property_id"])
+    if classifier is None:
+        classifier = _classifiers[prop["property_id"]] = build_classifier(prop)
+    return classifier
@@ -0,0 +1,346 @@
+import contextvars
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+from startup_timing import timed_import
+from scheduler import run_task_graph, submit
+from resilience import remaining_seconds
+from trigger_control import (
+    new_holder_id,
+    acquire_lease,
+    release_lease,
+    mark_pending,
+    consume_pending,
+    is_pending,
+    mark_coalesced,
+    is_coalesced,
+    clear_coalesced
+)
+from config import (
+    PROPERTY_MAX_WORKERS,
+    BACKFILL_ENABLED,
+    DATAFORM_TRACK_INVOCATIONS,
+    PARAM_CATALOG_ENABLED,
+    TRIGGER_COALESCE_WINDOW_SECONDS,
+    TRIGGER_MAX_FOLLOW_UP_RUNS,
+    TRIGGER_FOLLOW_UP_MIN_REMAINING_SECONDS
+)
+
+# Stage modules pull in the BigQuery, Secret Manager and google-auth SDKs, so
+# they are imported on first use. Invalid payloads never load them and the
+# no-op path never loads the config-update stage.
+def load_stage(module_name, function_name):
+    return getattr(timed_import(module_name), function_name)
+
+# -------------------------------
+# Single Property Pipeline
+# -------------------------------
+def run_property_pipeline(request, prop, full_rescan=None, suffixes=None):
+    property_id = prop["property_id"]
+
+    # Dataform invocations started by earlier runs are polled while the
+    # schemas are compared.
+    tracking_future = None
+    if DATAFORM_TRACK_INVOCATIONS:
+        poll_tracked_invocations = load_stage("workflow_tracker", "poll_tracked_invocations")
+        tracking_future = submit(poll_tracked_invocations, prop)
+
+    def dataform_tracking():
+        if tracking_future is None:
+            return None
+        try:
+            return tracking_future.result()
+        except Exception as e:
+            print(f"[{property_id}] Failed to poll tracked Dataform invocations: {e}")
+            return {"error": str(e)}
+
+    def dataform_in_flight():
+        # An invocation whose state is unknown is treated as still running.
+        tracking = dataform_tracking()
+        return tracking is not None and ("error" in tracking or bool(tracking["running"]))
+
+    # -----------------------
+    # Step 1: Compare Schemas
+    # -----------------------
+    print(f"[{property_id}] Starting schema comparison...")
+    compare_event_params_and_store_schema_diff = load_stage(
+        "compare_event_params", "compare_event_params_and_store_schema_diff"
+    )
+    with metrics.stage(f"{property_id}.compare"):
+        compare_result = compare_event_params_and_store_schema_diff(
+            request, full_rescan=full_rescan, prop=prop, suffixes=suffixes
+        )
+    print(f"[{property_id}] Schema comparison result:\n{compare_result}")
+
+    # Exit if no mismatches found
+    if compare_result["missing_count"] == 0:
+        print(f"[{property_id}] No mismatches found. The processed Dataform table is up-to-date.")
+        result = {
+            "status": "No Action Needed",
+            "message": "The processed Dataform table already contains all event parameters.",
+            "compare_result": compare_result
+        }
+        if BACKFILL_ENABLED:
+            # Resume partitions left pending by an earlier run.
+            backfill_new_columns = load_stage("backfill", "backfill_new_columns")
+            with metrics.stage(f"{property_id}.backfill"):
+                result["backfill_result"] = backfill_new_columns(
+                    [], prop=prop, dataform_running=dataform_in_flight()
+                )
+        result["dataform_tracking"] = dataform_tracking()
+        return result
+
+    # -----------------------
+    # Step 2 and 3: Alter Table and Update Config
+    # -----------------------
+    # The config.js fetch and the OAuth token refresh only need the diff, so
+    # they run concurrently. The ALTER waits for the fetch so params whose
+    # config.js array is missing get no column Dataform would never fill.
+    # Pushing config.js and invoking Dataform wait for the ALTER, so Dataform
+    # never sees params whose columns do not exist yet.
+    alter_processed_table_with_missing_event_params = load_stage(
+        "alter_table_event_params", "alter_processed_table_with_missing_event_params"
+    )
+    prepare_config_update = load_stage("update_dataform_config", "prepare_config_update")
+    commit_config_update = load_stage("update_dataform_config", "commit_config_update")
+    get_oauth_token = load_stage("clients", "get_oauth_token")
+    fields = compare_result["fields"]
+
+    def alter(deps):
+        skipped_fields = deps["prepare_config"].get("skipped_fields", [])
+        alter_fields = [field for field in fields if field not in skipped_fields]
+        print(f"[{property_id}] Starting table alteration...")
+        with metrics.stage(f"{property_id}.alter"):
+            return alter_processed_table_with_missing_event_params(alter_fields, prop=prop)
+
+    def prepare_config(_):
+        print(f"[{property_id}] Preparing config update...")
+        with metrics.stage(f"{property_id}.config_prepare"):
+            return prepare_config_update(fields, prop=prop)
+
+    def prefetch_oauth_token(_):
+        with metrics.stage(f"{property_id}.oauth_token"):
+            get_oauth_token()
+
+    def commit_config(deps):
+        prepared = deps["prepare_config"]
+        if deps["alter"]["status"] == "Partial":
+            # Only push params whose columns made it into the table; the rest
+            # are picked up again by the next run's diff.
+            print(f"[{property_id}] ALTER was partial. Re-preparing config for applied fields only...")
+            with metrics.stage(f"{property_id}.config_prepare"):
+                prepared = prepare_config_update(deps["alter"]["applied_fields"], prop=prop)
+        if prepared["status"] != "READY_TO_COMMIT":
+            return prepared
+        print(f"[{property_id}] Committing config update...")
+        with metrics.stage(f"{property_id}.config_commit"):
+            return commit_config_update(prepared, prop=prop)
+
+    def backfill(deps):
+        print(f"[{property_id}] Backfilling new columns...")
+        with metrics.stage(f"{property_id}.backfill"):
+            return backfill_new_columns(
+                deps["alter"].get("applied_fields", []), prop=prop,
+                dataform_running=bool(deps["commit_config"].get("dataform_sync")) or dataform_in_flight()
+            )
+
+    def record_in_catalog(deps):
+        alter_result = deps["alter"]
+        commit_sha = (deps["commit_config"].get("dataform_sync") or {}).get("commit_sha")
+        with metrics.stage(f"{property_id}.param_catalog"):
+            return mark_params_added(
+                alter_result.get("applied_fields", []),
+                job_ids_by_field=alter_result.get("job_ids_by_field"),
+                commit_sha=commit_sha,
+                prop=prop
+            )
+
+    tasks = {
+        "alter": (alter, ["prepare_config"]),
+        "prepare_config": (prepare_config, []),
+        "oauth_token": (prefetch_oauth_token, []),
+        "commit_config": (commit_config, ["alter", "prepare_config", "oauth_token"]),
+    }
+    if BACKFILL_ENABLED:
+        # Partition DML conflicts with Dataform's writes to the same table, so
+        # a run that invokes Dataform, or finds an earlier invocation still
+        # running, only registers the new columns and a later run backfills
+        # them.
+        backfill_new_columns = load_stage("backfill", "backfill_new_columns")
+        tasks["backfill"] = (backfill, ["alter", "commit_config"])
+    if PARAM_CATALOG_ENABLED:
+        # Records which ALTER job and config.js commit added each key, once
+        # both are known.
+        mark_params_added = load_stage("param_catalog", "mark_params_added")
+        tasks["param_catalog"] = (record_in_catalog, ["alter", "commit_config"])
+    results = run_task_graph(tasks)
+    alter_result = results["alter"]
+    config_update_result = results["commit_config"]
+    print(f"[{property_id}] Table alteration result:\n{alter_result}")
+    print(f"[{property_id}] Config update result:\n{config_update_result}")
+
+    return {
+        # A partial ALTER is reported as a failure so Pub/Sub redelivers and
+        # the remaining columns are retried.
+        "status": "Partial Failure" if alter_result["status"] == "Partial" else "Success",
+        "compare_result": compare_result,
+        "alter_result": alter_result,
+        "config_update_result": config_update_result,
+        "backfill_result": results.get("backfill"),
+        "param_catalog_result": results.get("param_catalog"),
+        "dataform_tracking": dataform_tracking()
+    }
+
+# -------------------------------
+# Scheduled Dataform Poll
+# -------------------------------
+def poll_dataform_invocations(prop):
+    # Poll-only run for a scheduler, so a tracked invocation is recorded even
+    # when no export trigger follows it. Once the last running invocation
+    # finishes, backfill deferred while Dataform was writing is resumed, under
+    # the property lease so it cannot overlap a pipeline run.
+    property_id = prop["property_id"]
+    poll_tracked_invocations = load_stage("workflow_tracker", "poll_tracked_invocations")
+    resumed = {}
+
+    def resume_backfill(outcome, still_running):
+        if not BACKFILL_ENABLED or still_running or resumed:
+            return
+        token = acquire_lease(property_id, new_holder_id())
+        if token is None:
+            print(f"[{property_id}] A pipeline run holds the lease and will resume backfill itself.")
+            resumed["backfill"] = {"status": "Deferred", "partitions": []}
+            return
+        try:
+            backfill_new_columns = load_stage("backfill", "backfill_new_columns")
+            with metrics.stage(f"{property_id}.backfill"):
+                resumed["backfill"] = backfill_new_columns([], prop=prop)
+        finally:
+            release_lease(property_id, token)
+
+    with metrics.stage(f"{property_id}.dataform_poll"):
+        tracking = poll_tracked_invocations(prop, on_complete=resume_backfill)
+    return {
+        "status": "Polled",
+        "dataform_tracking": tracking,
+        "backfill": resumed.get("backfill"),
+    }
+
+# -------------------------------
+# Multi-Property Fan-Out
+# -------------------------------
+def run_pipelines(request, properties, full_rescan=None, suffixes=None):
+    # Each property runs on its own worker so total wall time tracks the
+    # slowest property. A failure is recorded against that property only.
+    # full_rescan may be a single flag or a {property_id: flag} dict, and
+    # suffixes a {property_id: [shard suffixes]} dict.
+    def run_isolated(prop):
+        try:
+            return run_property_pipeline(
+                request, prop,
+                full_rescan=full_rescan.get(prop["property_id"]) if isinstance(full_rescan, dict) else full_rescan,
+                suffixes=(suffixes or {}).get(prop["property_id"])
+            )
+        except Exception as e:
+            print(f"[{prop['property_id']}] Pipeline failed: {e}")
+            traceback.print_exc()
+            return {"status": "Error", "error": str(e)}
+
+    max_workers = max(1, min(PROPERTY_MAX_WORKERS, len(properties)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Each task gets its own copy of the context so stage metrics land in
+        # this invocation's run.
+        futures = {
+            prop["property_id"]: executor.submit(contextvars.copy_context().run, run_isolated, prop)
+            for prop in properties
+        }
+    return {property_id: future.result() for property_id, future in futures.items()}
+
+# -------------------------------
+# Leased and Coalesced Runs
+# -------------------------------
+def run_coalesced_pipelines(request, properties, full_rescan=None, message_ids=None, suffixes=None):
+    # Only one run per property at a time. A trigger for a property whose
+    # lease is held flags it as pending and returns Coalesced, so its message
+    # is redelivered; the holder reruns once per flag it finds after
+    # finishing, up to TRIGGER_MAX_FOLLOW_UP_RUNS times and only while
+    # TRIGGER_FOLLOW_UP_MIN_REMAINING_SECONDS of the run deadline are left.
+    # message_ids maps property IDs to the messages that triggered them.
+    # suffixes narrows the first run only; follow-up runs cover the whole
+    # window since the coalesced triggers may name any shard.
+    holder = new_holder_id()
+    leases = {}
+    results = {}
+    for prop in properties:
+        property_id = prop["property_id"]
+        ids = [message_id for message_id in (message_ids or {}).get(property_id, []) if message_id]
+        token = acquire_lease(property_id, holder)
+        if token is None:
+            print(f"[{property_id}] Another run holds the lease. Coalescing this trigger into it.")
+            # A redelivered trigger does not flag the property again; the
+            # holder may already have consumed its flag.
+            if not ids or [message_id for message_id in ids if mark_coalesced(property_id, message_id)]:
+                mark_pending(property_id)
+            results[property_id] = {
+                "status": "Coalesced",
+                "message": "A run for this property is already in progress and will pick up this trigger."
+            }
+        elif ids and all(is_coalesced(property_id, message_id) for message_id in ids) and not is_pending(property_id):
+            # These triggers were coalesced earlier and a follow-up run has
+            # consumed their flag since, so that run covered them.
+            release_lease(property_id, token)
+            for message_id in ids:
+                clear_coalesced(property_id, message_id)
+            print(f"[{property_id}] Trigger already covered by a follow-up run.")
+            results[property_id] = {
+                "status": "Covered",
+                "message": "A follow-up run that started after this trigger has already covered it."
+            }
+        else:
+            leases[property_id] = token
+
+    to_run = [prop for prop in properties if prop["property_id"] in leases]
+    try:
+        if to_run and TRIGGER_COALESCE_WINDOW_SECONDS > 0:
+            print(f"Waiting {TRIGGER_COALESCE_WINDOW_SECONDS}s for further triggers before running.")
+            time.sleep(TRIGGER_COALESCE_WINDOW_SECONDS)
+        # Triggers that arrived during the window are covered by this run.
+        for prop in to_run:
+            consume_pending(prop["property_id"])
+
+        runs = 0
+        while to_run:
+            batch = run_pipelines(
+                request, to_run,
+                full_rescan=full_rescan if runs == 0 else None,
+                suffixes=suffixes if runs == 0 else None
+            )
+            runs += 1
+            for property_id, result in batch.items():
+                result["runs"] = runs
+                if result["status"] != "Error":
+                    for message_id in (message_ids or {}).get(property_id, []):
+                        if message_id:
+                            clear_coalesced(property_id, message_id)
+            results.update(batch)
+            if runs > TRIGGER_MAX_FOLLOW_UP_RUNS:
+                break
+            remaining = remaining_seconds()
+            if remaining is not None and remaining < TRIGGER_FOLLOW_UP_MIN_REMAINING_SECONDS:
+                # Pending flags stay set; the coalesced triggers are
+                # redelivered and run once the lease is released.
+                print(f"Only {remaining:.0f}s left before the run deadline. Leaving pending triggers to redelivery.")
+                break
+            # A failed property is retried by Pub/Sub redelivery instead, and
+            # keeps its pending flag for that run.
+            to_run = [
+                prop for prop in to_run
+                if batch[prop["property_id"]]["status"] != "Error" and consume_pending(prop["property_id"])
+            ]
+            if to_run:
+                print(f"Triggers arrived during the run. Running again for {[p['property_id'] for p in to_run]}.")
+    finally:
+        for property_id, token in leases.items():
+            release_lease(property_id, token)
+    return results
@@ -0,0 +1,78 @@
+import re
+from config import (
+    PROPERTIES,
+    RAW_PROJECT_ID,
+    WRITE_PROJECT_ID,
+    RAW_DATASET,
+    PROCESSED_TABLE_ID,
+    TEMP_DATASET,
+    REPO,
+    FILE_PATH,
+    BRANCH,
+    REPO_ID,
+    RELEASE_ID,
+    WORKFLOW_ID
+)
+
+# -------------------------------
+# Property Defaults
+# -------------------------------
+PROPERTY_DEFAULTS = {
+    "raw_project_id":     RAW_PROJECT_ID,
+    "write_project_id":   WRITE_PROJECT_ID,
+    "raw_dataset":        RAW_DATASET,
+    "processed_table_id": PROCESSED_TABLE_ID,
+    "temp_dataset":       TEMP_DATASET,
+    "repo":               REPO,
+    "file_path":          FILE_PATH,
+    "branch":             BRANCH,
+    "repo_id":            REPO_ID,
+    "release_id":         RELEASE_ID,
+    "workflow_id":        WORKFLOW_ID,
+    "param_allow":        {},
+    "param_deny":         {},
+}
+
+REGISTERED_PROPERTIES = {
+    prop["property_id"]: {**PROPERTY_DEFAULTS, **prop}
+    for prop in PROPERTIES
+}
+
+def get_property(property_id=None):
+    if property_id is None:
+        return next(iter(REGISTERED_PROPERTIES.values()))
+    if property_id not in REGISTERED_PROPERTIES:
+        raise KeyError(f"Unknown property: {property_id}")
+    return REGISTERED_PROPERTIES[property_id]
+
+def get_state_table_id(prop, table_name):
+    # Tables holding per-property state carry the property ID, since
+    # properties on default settings share one temp dataset.
+    return f"{prop['write_project_id']}.{prop['temp_dataset']}.{table_name}_{prop['property_id']}"
+
+def get_properties(property_ids=None):
+    if not property_ids:
+        return list(REGISTERED_PROPERTIES.values())
+    return [get_property(property_id) for property_id in property_ids]
+
+def find_property_by_raw_dataset(raw_dataset):
+    for prop in REGISTERED_PROPERTIES.values():
+        if prop["raw_dataset"] == raw_dataset:
+            return prop
+    return None
+
+# Matches the GA4 export dataset in BigQuery audit-log messages.
+RAW_DATASET_PATTERN = re.compile(r"analytics_\d+")
+
+def select_properties(message_data, message_attributes):
+    # An explicit `property_id` attribute (comma-separated) wins. Otherwise a
+    # message naming a registered GA4 dataset only runs that property, and
+    # anything else runs every registered property.
+    property_ids = message_attributes.get('property_id')
+    if property_ids:
+        return get_properties([p.strip() for p in property_ids.split(',') if p.strip()])
+    for raw_dataset in RAW_DATASET_PATTERN.findall(message_data):
+        prop = find_property_by_raw_dataset(raw_dataset)
+        if prop is not None:
+            return [prop]
+    return get_properties()
@@ -0,0 +1,314 @@
+import collections
+import json
+import re
+import threading
+import time
+import traceback
+import uuid
+import metrics
+from clients import get_subscriber_client
+from properties import select_properties
+from pipeline import run_coalesced_pipelines
+from resilience import start_deadline
+from startup_timing import log_startup_report_if_changed
+from trigger_control import is_message_processed, mark_message_processed
+from config import (
+    PULL_SUBSCRIPTION,
+    PULL_MAX_MESSAGES,
+    PULL_BATCH_WINDOW_SECONDS,
+    PULL_WAIT_TIMEOUT_SECONDS,
+    PULL_ACK_DEADLINE_SECONDS,
+    PULL_ACK_EXTENSION_FRACTION
+)
+
+# Matches the daily shard named in GA4 export notifications.
+SHARD_SUFFIX_PATTERN = re.compile(r"\bevents_(\d{8})\b")
+
+# -------------------------------
+# Message Queues
+# -------------------------------
+# Both queues hand out messages as
+#     {"ack_id": ..., "message_id": ..., "data": bytes, "attributes": {...}}
+
+class PubSubQueue:
+    def __init__(self, subscription=PULL_SUBSCRIPTION):
+        self.subscription = subscription
+        self.subscriber = get_subscriber_client()
+
+    def pull(self, max_messages, timeout):
+        try:
+            response = self.subscriber.pull(
+                request={"subscription": self.subscription, "max_messages": max_messages},
+                timeout=timeout
+            )
+        except Exception as e:
+            # Pull returns DeadlineExceeded when nothing arrives in time.
+            if type(e).__name__ == "DeadlineExceeded":
+                return []
+            raise
+        return [
+            {
+                "ack_id": received.ack_id,
+                "message_id": received.message.message_id,
+                "data": received.message.data,
+                "attributes": dict(received.message.attributes),
+            }
+            for received in response.received_messages
+        ]
+
+    def acknowledge(self, ack_ids):
+        if ack_ids:
+            self.subscriber.acknowledge(request={"subscription": self.subscription, "ack_ids": ack_ids})
+
+    def nack(self, ack_ids):
+        self.extend(ack_ids, 0)
+
+    def extend(self, ack_ids, seconds):
+        if ack_ids:
+            self.subscriber.modify_ack_deadline(request={
+                "subscription": self.subscription, "ack_ids": ack_ids, "ack_deadline_seconds": seconds
+            })
+
+class InMemoryQueue:
+    # Local stand-in for a subscription. Nacked messages go back to the end
+    # of the queue; acknowledged ones are kept in `acked` for inspection.
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._ready = collections.deque()
+        self._outstanding = {}
+        self.acked = []
+
+    def publish(self, data, attributes=None):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        message = {"message_id": uuid.uuid4().hex, "data": data, "attributes": dict(attributes or {})}
+        with self._cond:
+            self._ready.append(message)
+            self._cond.notify()
+        return message["message_id"]
+
+    def pull(self, max_messages, timeout):
+        with self._cond:
+            if not self._ready:
+                self._cond.wait(timeout=timeout)
+            messages = []
+            while self._ready and len(messages) < max_messages:
+                message = {**self._ready.popleft(), "ack_id": uuid.uuid4().hex}
+                self._outstanding[message["ack_id"]] = message
+                messages.append(message)
+            return messages
+
+    def acknowledge(self, ack_ids):
+        with self._cond:
+            for ack_id in ack_ids:
+                self.acked.append(self._outstanding.pop(ack_id))
+
+    def nack(self, ack_ids):
+        with self._cond:
+            for ack_id in ack_ids:
+                message = self._outstanding.pop(ack_id)
+                self._ready.append({k: v for k, v in message.items() if k != "ack_id"})
+            self._cond.notify()
+
+    def extend(self, ack_ids, seconds):
+        # Outstanding messages never expire here.
+        pass
+
+# -------------------------------
+# Ack Deadline Extension
+# -------------------------------
+class AckDeadlineExtender:
+    # Extends the ack deadline of every message as soon as it is handed over,
+    # then again on a timer until the message is released, so a batch that
+    # runs longer than the subscription's ack deadline is not redelivered
+    # while it is still running. The timer fires at a fixed fraction of the
+    # deadline it sets.
+    def __init__(self, queue, deadline=PULL_ACK_DEADLINE_SECONDS):
+        self.queue = queue
+        self.deadline = deadline
+        self.interval = deadline * PULL_ACK_EXTENSION_FRACTION
+        self._lock = threading.Lock()
+        self._ack_ids = set()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="ack-extender", daemon=True)
+        self._thread.start()
+
+    def hold(self, ack_ids):
+        ack_ids = list(ack_ids)
+        with self._lock:
+            self._ack_ids.update(ack_ids)
+        self._extend(ack_ids)
+
+    def release(self, ack_ids):
+        with self._lock:
+            self._ack_ids.difference_update(ack_ids)
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                ack_ids = sorted(self._ack_ids)
+            self._extend(ack_ids)
+
+    def _extend(self, ack_ids):
+        if not ack_ids:
+            return
+        try:
+            self.queue.extend(ack_ids, self.deadline)
+        except Exception as e:
+            print(f"[WARN] Failed to extend ack deadlines for {len(ack_ids)} messages: {e}")
+
+# -------------------------------
+# Batching
+# -------------------------------
+def collect_batch(queue, wait_timeout=PULL_WAIT_TIMEOUT_SECONDS, extender=None):
+    # Blocks for the first message, then keeps pulling until the batch window
+    # closes or the batch is full. Pulled messages are handed to the extender
+    # straight away.
+    batch = queue.pull(PULL_MAX_MESSAGES, timeout=wait_timeout)
+    if not batch:
+        return []
+    if extender is not None:
+        extender.hold(m["ack_id"] for m in batch)
+    deadline = time.monotonic() + PULL_BATCH_WINDOW_SECONDS
+    while len(batch) < PULL_MAX_MESSAGES:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        pulled = queue.pull(PULL_MAX_MESSAGES - len(batch), timeout=remaining)
+        if extender is not None:
+            extender.hold(m["ack_id"] for m in pulled)
+        batch.extend(pulled)
+    return batch
+
+def plan_batch(messages):
+    # Merges the batch into one run per property. A property whose messages
+    # all name shards only rescans those shards; any message without a shard
+    # runs the property over the whole look-back window. Messages naming an
+    # unknown property are returned separately.
+    plan = {}
+    rejected = []
+    for message in messages:
+        data = message["data"].decode("utf-8", errors="replace")
+        attributes = message["attributes"]
+        message_suffixes = set(SHARD_SUFFIX_PATTERN.findall(data))
+        full_rescan = str(attributes.get("full_rescan", "")).lower() == "true"
+        try:
+            properties = select_properties(data, attributes)
+        except KeyError as e:
+            print(f"[WARN] Dropping message {message['message_id']}: {e}")
+            rejected.append(message)
+            continue
+        for prop in properties:
+            entry = plan.setdefault(prop["property_id"], {
+                "prop": prop, "suffixes": set(), "whole_window": False, "full_rescan": False,
+                "ack_ids": [], "message_ids": []
+            })
+            entry["suffixes"] |= message_suffixes
+            entry["whole_window"] = entry["whole_window"] or not message_suffixes
+            entry["full_rescan"] = entry["full_rescan"] or full_rescan
+            entry["ack_ids"].append(message["ack_id"])
+            entry["message_ids"].append(message["message_id"])
+    return plan, rejected
+
+def process_batch(queue, messages):
+    run_metrics = metrics.start_run()
+    start_deadline()
+    duplicates = [m for m in messages if is_message_processed(m["message_id"])]
+    fresh = [m for m in messages if m not in duplicates]
+    queue.acknowledge([m["ack_id"] for m in duplicates])
+    if not fresh:
+        return {"status": "Duplicate", "messages": len(messages)}
+
+    plan, rejected = plan_batch(fresh)
+    # A message naming an unknown property can never succeed, so it is
+    # acknowledged rather than redelivered forever.
+    for message in rejected:
+        mark_message_processed(message["message_id"])
+    queue.acknowledge([m["ack_id"] for m in rejected])
+    fresh = [m for m in fresh if m not in rejected]
+    if not fresh:
+        return {"status": "Rejected", "messages": len(messages), "rejected": len(rejected)}
+
+    print(f"Processing batch of {len(fresh)} messages for properties {sorted(plan)}.")
+    try:
+        # Takes the same per-property leases as the push path, so a pushed
+        # trigger and a batch never run one property at the same time.
+        property_results = run_coalesced_pipelines(
+            None,
+            [entry["prop"] for entry in plan.values()],
+            full_rescan={pid: entry["full_rescan"] or None for pid, entry in plan.items()},
+            message_ids={pid: entry["message_ids"] for pid, entry in plan.items()},
+            suffixes={
+                pid: None if entry["whole_window"] else sorted(entry["suffixes"])
+                for pid, entry in plan.items()
+            }
+        )
+    except Exception as e:
+        print(f"Batch run failed: {e}")
+        traceback.print_exc()
+        queue.nack([m["ack_id"] for m in fresh])
+        return {"status": "Error", "error": str(e), "metrics": run_metrics.to_dict()}
+
+    # A message is acknowledged only if every property it touched succeeded
+    # or was covered by another run. Failed messages, and messages coalesced
+    # into a run still in progress elsewhere, are redelivered into a later
+    # batch.
+    failed_ack_ids = set()
+    coalesced_ack_ids = set()
+    for property_id, result in property_results.items():
+        if result["status"] in ("Error", "Partial Failure"):
+            failed_ack_ids.update(plan[property_id]["ack_ids"])
+        elif result["status"] == "Coalesced":
+            coalesced_ack_ids.update(plan[property_id]["ack_ids"])
+    redelivered = failed_ack_ids | coalesced_ack_ids
+    acked = [m for m in fresh if m["ack_id"] not in redelivered]
+    for message in acked:
+        mark_message_processed(message["message_id"])
+    queue.acknowledge([m["ack_id"] for m in acked])
+    queue.nack(sorted(redelivered))
+
+    status = "Success"
+    if failed_ack_ids:
+        status = "Partial Failure"
+    elif coalesced_ack_ids:
+        status = "Coalesced"
+    summary = {
+        "status": status,
+        "messages": len(messages),
+        "acknowledged": len(acked) + len(duplicates) + len(rejected),
+        "rejected": len(rejected),
+        "redelivered": len(redelivered),
+        "properties": property_results,
+        "metrics": run_metrics.to_dict(),
+    }
+    print(json.dumps({"event": "pull_batch_complete", **{k: v for k, v in summary.items() if k != "properties"}}))
+    return summary
+
+# -------------------------------
+# Worker Loop
+# -------------------------------
+def run_pull_worker(queue=None, max_batches=None, wait_timeout=PULL_WAIT_TIMEOUT_SECONDS):
+    queue = queue or PubSubQueue()
+    extender = AckDeadlineExtender(queue)
+    batches = 0
+    print("Pull worker started.")
+    try:
+        while max_batches is None or batches < max_batches:
+            messages = collect_batch(queue, wait_timeout, extender)
+            if not messages:
+                continue
+            try:
+                process_batch(queue, messages)
+            finally:
+                extender.release(m["ack_id"] for m in messages)
+            log_startup_report_if_changed()
+            batches += 1
+    finally:
+        extender.stop()
+
+if __name__ == "__main__":
+    run_pull_worker()
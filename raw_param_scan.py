@@ -0,0 +1,306 @@
+import re
+import time
+from google.cloud import bigquery
+from google.api_core.exceptions import NotFound
+import metrics
+from clients import get_bigquery_storage_client
+from startup_timing import timed_import
+from config import (
+    RAW_TABLE_PATTERN,
+    INTRADAY_TABLE_PATTERN,
+    RAW_AGGREGATION_MODE,
+    RAW_SCAN_BYTES_BUDGET,
+    RAW_SCAN_MAX_BYTES_BILLED,
+    RAW_SCAN_MIN_DAYS,
+    RAW_SCAN_FALLBACK_SAMPLE_PERCENT,
+    PARAM_SOURCES_ENABLED
+)
+
+INFERRED_TYPE_SQL = """
+                        CASE
+                            WHEN param.value.string_value IS NOT NULL THEN 'STRING'
+                            WHEN param.value.int_value IS NOT NULL THEN 'INT64'
+                            WHEN param.value.double_value IS NOT NULL THEN 'FLOAT64'
+                            WHEN param.value.float_value IS NOT NULL THEN 'FLOAT64'
+                            ELSE 'STRING'
+                        END"""
+
+# How each param source is unnested from an `events_*` row aliased as `e`.
+# Every source exposes its key/value struct as `param`.
+SOURCE_UNNEST_SQL = {
+    "event_params": "UNNEST(e.event_params) AS param",
+    "user_properties": "UNNEST(e.user_properties) AS param",
+    "items": "UNNEST(e.items) AS item, UNNEST(item.item_params) AS param",
+}
+
+# Intraday tables also match the daily wildcard, as `intraday_YYYYMMDD`.
+INTRADAY_SUFFIX_PREFIX = INTRADAY_TABLE_PATTERN.rstrip("*")[len(RAW_TABLE_PATTERN.rstrip("*")):]
+
+# Suffixes end up in table names and string literals, so anything that is not
+# a daily (YYYYMMDD) or intraday shard suffix is rejected before building SQL.
+SHARD_SUFFIX_PATTERN = re.compile(rf"(?:{re.escape(INTRADAY_SUFFIX_PREFIX)})?\d{{8}}")
+
+def validate_shard_suffixes(suffixes):
+    for suffix in suffixes:
+        if not isinstance(suffix, str) or not SHARD_SUFFIX_PATTERN.fullmatch(suffix):
+            raise ValueError(f"Invalid shard suffix: {suffix!r}")
+
+# -------------------------------
+# Query Builders
+# -------------------------------
+def _source_params_sql():
+    # All enabled sources are folded into one array per event row, so the
+    # raw table is read once no matter how many sources are discovered.
+    arrays = ",".join(
+        f"""
+                    ARRAY(
+                        SELECT AS STRUCT
+                            '{source}' AS source,
+                            param.key AS param_key,{INFERRED_TYPE_SQL} AS inferred_type
+                        FROM {SOURCE_UNNEST_SQL[source]}
+                    )"""
+        for source in PARAM_SOURCES_ENABLED
+    )
+    return f"UNNEST(ARRAY_CONCAT({arrays}\n                )) AS p"
+
+def _param_rows_sql(prop, suffixes, sample_percent=None):
+    validate_shard_suffixes(suffixes)
+    raw_dataset_ref = f"{prop['raw_project_id']}.{prop['raw_dataset']}"
+    source_params_sql = _source_params_sql()
+    if not sample_percent:
+        suffix_filter = ",".join([f"'{s}'" for s in suffixes])
+        return f"""
+                SELECT
+                    _TABLE_SUFFIX AS table_suffix,
+                    p.source,
+                    p.param_key,
+                    p.inferred_type
+                FROM `{raw_dataset_ref}.{RAW_TABLE_PATTERN}` AS e,
+                     {source_params_sql}
+                WHERE _TABLE_SUFFIX IN ({suffix_filter})"""
+
+    # TABLESAMPLE is applied to each daily shard by name rather than to the
+    # wildcard table.
+    table_prefix = RAW_TABLE_PATTERN.rstrip("*")
+    return "\n                UNION ALL".join(
+        f"""
+                SELECT
+                    '{suffix}' AS table_suffix,
+                    p.source,
+                    p.param_key,
+                    p.inferred_type
+                FROM `{raw_dataset_ref}.{table_prefix}{suffix}` AS e
+                     TABLESAMPLE SYSTEM ({sample_percent} PERCENT),
+                     {source_params_sql}"""
+        for suffix in suffixes
+    )
+
+def _aggregated_sql(param_rows_sql):
+    # One row per shard, source and key with per-type counts, so only a few
+    # thousand rows come back instead of every UNNESTed param row.
+    return f"""
+            SELECT
+                table_suffix,
+                source,
+                param_key,
+                COUNTIF(inferred_type = 'STRING') AS string_count,
+                COUNTIF(inferred_type = 'INT64') AS int64_count,
+                COUNTIF(inferred_type = 'FLOAT64') AS float64_count
+            FROM ({param_rows_sql}
+            )
+            GROUP BY table_suffix, source, param_key
+        """
+
+def build_raw_param_query(prop, suffixes, sample_percent=None):
+    param_rows_sql = _param_rows_sql(prop, suffixes, sample_percent)
+    if RAW_AGGREGATION_MODE == "server":
+        return _aggregated_sql(param_rows_sql)
+    return f"""
+            SELECT source, param_key, inferred_type
+            FROM ({param_rows_sql}
+            )
+        """
+
+# -------------------------------
+# Cost Estimation
+# -------------------------------
+def estimate_query_bytes(client, query):
+    job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+    job = client.query(query, job_config=job_config)
+    return job.total_bytes_processed or 0
+
+def plan_raw_scan(client, prop, suffixes):
+    # Pick the cheapest acceptable strategy for the raw scan:
+    #   full         - every requested shard, when the estimate fits the budget
+    #   reduced_days - the most recent shards that fit, down to RAW_SCAN_MIN_DAYS
+    #   sampled      - TABLESAMPLE over every requested shard
+    # Shards left out by reduced_days are not recorded as scanned, so they are
+    # picked up by a later run.
+    suffixes = sorted(suffixes, reverse=True)
+    with metrics.timed("raw_query_dry_run"):
+        estimated_bytes = estimate_query_bytes(client, build_raw_param_query(prop, suffixes))
+    print(f"Estimated raw scan: {estimated_bytes} bytes for {len(suffixes)} shards "
+          f"(budget: {RAW_SCAN_BYTES_BUDGET} bytes).")
+    plan = {
+        "strategy": "full",
+        "suffixes": suffixes,
+        "sample_percent": None,
+        "estimated_bytes": estimated_bytes,
+        "full_estimated_bytes": estimated_bytes,
+        "budget_bytes": RAW_SCAN_BYTES_BUDGET,
+    }
+    if estimated_bytes <= RAW_SCAN_BYTES_BUDGET:
+        return plan
+
+    for day_count in range(len(suffixes) - 1, RAW_SCAN_MIN_DAYS - 1, -1):
+        reduced_suffixes = suffixes[:day_count]
+        with metrics.timed("raw_query_dry_run"):
+            reduced_bytes = estimate_query_bytes(client, build_raw_param_query(prop, reduced_suffixes))
+        if reduced_bytes <= RAW_SCAN_BYTES_BUDGET:
+            print(f"Raw scan over budget. Reducing to the {day_count} most recent shards.")
+            plan.update(strategy="reduced_days", suffixes=reduced_suffixes, estimated_bytes=reduced_bytes)
+            return plan
+
+    # Dry runs report the unsampled size for TABLESAMPLE, so the sampled
+    # estimate is scaled from the full one.
+    sampled_bytes = int(estimated_bytes * RAW_SCAN_FALLBACK_SAMPLE_PERCENT / 100)
+    if sampled_bytes <= RAW_SCAN_BYTES_BUDGET:
+        print(f"Raw scan over budget. Sampling {RAW_SCAN_FALLBACK_SAMPLE_PERCENT}% of each shard.")
+        plan.update(strategy="sampled", sample_percent=RAW_SCAN_FALLBACK_SAMPLE_PERCENT, estimated_bytes=sampled_bytes)
+        return plan
+
+    raise Exception(
+        f"Raw scan estimate of {estimated_bytes} bytes exceeds the budget of "
+        f"{RAW_SCAN_BYTES_BUDGET} bytes even with {RAW_SCAN_FALLBACK_SAMPLE_PERCENT}% sampling."
+    )
+
+def make_scan_plan(suffixes, strategy="full", sample_percent=None):
+    # A plan for a scan that skips the dry-run guardrails.
+    return {
+        "strategy": strategy,
+        "suffixes": sorted(suffixes, reverse=True),
+        "sample_percent": sample_percent,
+        "estimated_bytes": None,
+        "full_estimated_bytes": None,
+        "budget_bytes": RAW_SCAN_BYTES_BUDGET,
+    }
+
+def run_raw_scan(client, prop, plan, step_name="raw_query"):
+    query = build_raw_param_query(prop, plan["suffixes"], plan["sample_percent"])
+    job_config = bigquery.QueryJobConfig(maximum_bytes_billed=RAW_SCAN_MAX_BYTES_BILLED)
+    with metrics.timed(step_name):
+        job = client.query(query, job_config=job_config)
+        result = job.result()
+    metrics.record_query_job(step_name, job)
+    return result
+
+# -------------------------------
+# Intraday Scan
+# -------------------------------
+# Intraday tables are streamed into and not partitioned, so a filter on
+# event_timestamp would still read the whole table. APPENDS() reads only the
+# rows committed in [start, end), so each scan costs about as much as the
+# events that arrived since the previous one.
+def find_intraday_tables(client, prop, dates):
+    # {intraday suffix: table_id} for the intraday tables of `dates`
+    # (YYYYMMDD) that exist. Yesterday's table is deleted once its daily
+    # export is complete.
+    table_prefix = INTRADAY_TABLE_PATTERN.rstrip("*")
+    tables = {}
+    for date in dates:
+        table_id = f"{prop['raw_project_id']}.{prop['raw_dataset']}.{table_prefix}{date}"
+        try:
+            client.get_table(table_id)
+        except NotFound:
+            continue
+        tables[f"{INTRADAY_SUFFIX_PREFIX}{date}"] = table_id
+    return tables
+
+def _timestamp_sql(ts):
+    return "NULL" if ts is None else f"TIMESTAMP '{ts.isoformat()}'"
+
+def build_intraday_param_query(windows, end_timestamp):
+    # windows: {intraday suffix: (table_id, start datetime or None)}. A None
+    # start reads every row appended since the table was created.
+    validate_shard_suffixes(windows)
+    source_params_sql = _source_params_sql()
+    param_rows_sql = "\n                UNION ALL".join(
+        f"""
+                SELECT
+                    '{suffix}' AS table_suffix,
+                    p.source,
+                    p.param_key,
+                    p.inferred_type
+                FROM APPENDS(TABLE `{table_id}`, {_timestamp_sql(start)}, {_timestamp_sql(end_timestamp)}) AS e,
+                     {source_params_sql}"""
+        for suffix, (table_id, start) in sorted(windows.items())
+    )
+    return _aggregated_sql(param_rows_sql)
+
+def run_intraday_scan(client, windows, end_timestamp, step_name="raw_query_intraday"):
+    query = build_intraday_param_query(windows, end_timestamp)
+    job_config = bigquery.QueryJobConfig(maximum_bytes_billed=RAW_SCAN_MAX_BYTES_BILLED)
+    with metrics.timed(step_name):
+        job = client.query(query, job_config=job_config)
+        result = job.result()
+    metrics.record_query_job(step_name, job)
+    return result
+
+# -------------------------------
+# Arrow Row Reduction
+# -------------------------------
+def reduce_param_rows_arrow(result, inferred_types):
+    # Reduces a rows-mode result (source, param_key, inferred_type) to per-key
+    # type counts one Arrow record batch at a time. Each batch is grouped with
+    # vectorized kernels and dropped, so memory is bounded by the batch size
+    # and the number of distinct keys, not by the row count.
+    pa = timed_import("pyarrow")
+    key_stats = {}
+    row_count = 0
+    start = time.perf_counter()
+    for batch in result.to_arrow_iterable(bqstorage_client=get_bigquery_storage_client()):
+        row_count += batch.num_rows
+        grouped = pa.Table.from_batches([batch]).group_by(
+            ["source", "param_key", "inferred_type"]
+        ).aggregate([("param_key", "count")])
+        for source, key, inferred_type, count in zip(
+            grouped.column("source").to_pylist(),
+            grouped.column("param_key").to_pylist(),
+            grouped.column("inferred_type").to_pylist(),
+            grouped.column("param_key_count").to_pylist()
+        ):
+            if inferred_type not in inferred_types:
+                continue
+            stats = key_stats.setdefault((source, key), {
+                "type_counts": {t: 0 for t in inferred_types},
+            })
+            stats["type_counts"][inferred_type] += count
+    elapsed = time.perf_counter() - start
+    rows_per_second = round(row_count / elapsed) if elapsed > 0 else None
+    print(f"Reduced {row_count} raw param rows from Arrow batches in {elapsed:.2f}s ({rows_per_second} rows/s).")
+    return key_stats, row_count, rows_per_second
+
+# -------------------------------
+# Sampling Recall Check
+# -------------------------------
+def check_sampling_recall(client, prop, suffix, sample_percent):
+    # Compare the keys found by a sampled scan of one shard with a full scan of
+    # the same shard, to tune DISCOVERY_SAMPLE_PERCENT.
+    sampled_keys = {
+        (row.source, row.param_key)
+        for row in run_raw_scan(client, prop, make_scan_plan([suffix], "sampled", sample_percent), step_name="recall_sampled")
+    }
+    full_keys = {
+        (row.source, row.param_key)
+        for row in run_raw_scan(client, prop, make_scan_plan([suffix]), step_name="recall_full")
+    }
+    recall = len(sampled_keys & full_keys) / len(full_keys) if full_keys else 1.0
+    print(f"Sampling recall for shard {suffix} at {sample_percent}%: {recall:.4f}")
+    return {
+        "suffix": suffix,
+        "sample_percent": sample_percent,
+        "sampled_key_count": len(sampled_keys),
+        "full_key_count": len(full_keys),
+        "recall": recall,
+        "missed_keys": [f"{source}.{key}" for source, key in sorted(full_keys - sampled_keys)],
+    }
@@ -0,0 +1,249 @@
+import contextvars
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import metrics
+from startup_timing import timed_import
+from config import (
+    RUN_DEADLINE_SECONDS,
+    HTTP_CONNECT_TIMEOUT_SECONDS,
+    HTTP_READ_TIMEOUT_SECONDS,
+    HTTP_POOL_MAXSIZE,
+    EXTERNAL_CALL_MAX_ATTEMPTS,
+    EXTERNAL_CALL_BACKOFF_BASE_SECONDS,
+    EXTERNAL_CALL_BACKOFF_MAX_SECONDS,
+    HTTP_HEDGE_AFTER_SECONDS,
+    CIRCUIT_FAILURE_THRESHOLD,
+    CIRCUIT_OPEN_SECONDS
+)
+
+# -------------------------------
+# External call resilience
+# -------------------------------
+# Calls to GitHub, Secret Manager and Dataform go through call_with_retries()
+# or http_request(). Each attempt gets a timeout no longer than the time left
+# before the run deadline, failed attempts are retried with full-jitter
+# exponential backoff, and every dependency has a circuit breaker that fails
+# calls fast after repeated failures instead of waiting out each timeout.
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+# Statuses that mean the request was not acted on, so a non-idempotent POST
+# can be sent again.
+NOT_PROCESSED_STATUS_CODES = {429, 503}
+
+class DeadlineExceeded(Exception):
+    pass
+
+class CircuitOpenError(Exception):
+    pass
+
+class RetryableResponse(Exception):
+    def __init__(self, response):
+        super().__init__(f"HTTP {response.status_code} from {response.url}")
+        self.response = response
+
+# -------------------------------
+# Run deadline
+# -------------------------------
+_deadline = contextvars.ContextVar("run_deadline", default=None)
+
+def start_deadline(seconds=RUN_DEADLINE_SECONDS):
+    # Called at the start of each invocation or batch. Worker threads started
+    # with a copy of the context share it.
+    _deadline.set(time.monotonic() + seconds)
+
+def remaining_seconds():
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+def _attempt_timeout(timeout, label):
+    remaining = remaining_seconds()
+    if remaining is None:
+        return timeout
+    if remaining <= 0:
+        raise DeadlineExceeded(f"Run deadline passed before {label}.")
+    return min(timeout, remaining)
+
+# -------------------------------
+# Circuit breakers
+# -------------------------------
+class CircuitBreaker:
+    # closed: calls pass. open: calls fail fast until CIRCUIT_OPEN_SECONDS
+    # pass. half-open: one trial call passes; its outcome closes or reopens
+    # the circuit.
+    def __init__(self, name, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, open_seconds=CIRCUIT_OPEN_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self._lock = threading.Lock()
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+
+    def before_call(self, label):
+        with self._lock:
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < self.open_seconds:
+                    raise CircuitOpenError(
+                        f"Circuit for {self.name} is open after {self.failures} consecutive failures. "
+                        f"Not calling {label}."
+                    )
+                self.state = "half-open"
+                self._trial_in_flight = False
+            if self.state == "half-open":
+                if self._trial_in_flight:
+                    raise CircuitOpenError(f"Circuit for {self.name} is half-open with a trial call in flight.")
+                self._trial_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                print(f"[INFO] Circuit for {self.name} closed.")
+            self.state = "closed"
+            self.failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.state == "half-open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    print(f"[WARN] Circuit for {self.name} opened after {self.failures} consecutive failures.")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+_breakers_lock = threading.Lock()
+_breakers = {}
+
+def get_circuit_breaker(dependency):
+    with _breakers_lock:
+        if dependency not in _breakers:
+            _breakers[dependency] = CircuitBreaker(dependency)
+        return _breakers[dependency]
+
+# -------------------------------
+# Retries
+# -------------------------------
+def is_retryable_error(error):
+    if isinstance(error, RetryableResponse):
+        return True
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    # google.api_core exceptions carry the HTTP status as `code`.
+    return getattr(error, "code", None) in RETRYABLE_STATUS_CODES
+
+def _backoff_delay(attempt, error):
+    delay = random.uniform(0, min(EXTERNAL_CALL_BACKOFF_MAX_SECONDS, EXTERNAL_CALL_BACKOFF_BASE_SECONDS * 2 ** (attempt - 1)))
+    if isinstance(error, RetryableResponse):
+        retry_after = error.response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            delay = max(delay, min(int(retry_after), EXTERNAL_CALL_BACKOFF_MAX_SECONDS))
+    return delay
+
+def call_with_retries(dependency, label, attempt_fn, timeout, is_retryable=is_retryable_error,
+                      max_attempts=EXTERNAL_CALL_MAX_ATTEMPTS, is_failure=is_retryable_error):
+    # attempt_fn(timeout) makes one attempt and returns its result or raises.
+    # An error for which is_failure() holds (no answer, or an error status)
+    # counts against the dependency's circuit even when it is not retried;
+    # any other outcome means the dependency answered and closes it.
+    breaker = get_circuit_breaker(dependency)
+    for attempt in range(1, max_attempts + 1):
+        attempt_timeout = _attempt_timeout(timeout, label)
+        try:
+            breaker.before_call(label)
+        except CircuitOpenError:
+            metrics.record_external_call(dependency, label, attempt - 1, "circuit_open")
+            raise
+        try:
+            result = attempt_fn(attempt_timeout)
+        except Exception as e:
+            retryable = is_retryable(e)
+            if retryable or is_failure(e):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            if not retryable:
+                metrics.record_external_call(dependency, label, attempt, "error")
+                raise
+            delay = _backoff_delay(attempt, e)
+            remaining = remaining_seconds()
+            if (attempt == max_attempts or breaker.state == "open"
+                    or (remaining is not None and delay >= remaining)):
+                metrics.record_external_call(dependency, label, attempt, "exhausted")
+                raise
+            print(f"[WARN] {label} failed (attempt {attempt}/{max_attempts}): {e}. Retrying in {delay:.2f}s.")
+            time.sleep(delay)
+            continue
+        breaker.record_success()
+        metrics.record_external_call(dependency, label, attempt, "ok")
+        return result
+
+# -------------------------------
+# HTTP
+# -------------------------------
+_hedge_executor = ThreadPoolExecutor(max_workers=HTTP_POOL_MAXSIZE, thread_name_prefix="hedge")
+
+def _hedged(send, label):
+    # Sends a second, identical request when the first has not answered
+    # within HTTP_HEDGE_AFTER_SECONDS and returns whichever answers first.
+    first = _hedge_executor.submit(contextvars.copy_context().run, send)
+    done, _ = wait([first], timeout=HTTP_HEDGE_AFTER_SECONDS)
+    if done:
+        return first.result()
+    print(f"[INFO] {label} has not answered after {HTTP_HEDGE_AFTER_SECONDS}s. Sending a hedged request.")
+    futures = {first, _hedge_executor.submit(contextvars.copy_context().run, send)}
+    error = None
+    while futures:
+        done, futures = wait(futures, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+    raise error
+
+def http_request(session, method, url, dependency, label, idempotent=None, hedge=False,
+                 max_attempts=EXTERNAL_CALL_MAX_ATTEMPTS, **kwargs):
+    # Returns the response like session.get() and friends. A retryable status that
+    # persists through every attempt is returned as-is, so callers keep their
+    # own status handling. Non-idempotent requests are only sent again when
+    # they cannot have been acted on: connect timeouts, 429 and 503.
+    requests = timed_import("requests")
+    if idempotent is None:
+        idempotent = method in ("GET", "HEAD", "PUT", "DELETE")
+    retry_statuses = RETRYABLE_STATUS_CODES if idempotent else NOT_PROCESSED_STATUS_CODES
+
+    def is_retryable(error):
+        if isinstance(error, RetryableResponse):
+            return True
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+        if idempotent and isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+            return True
+        return False
+
+    def is_failure(error):
+        # Timeouts and connection errors count against the circuit even on a
+        # non-idempotent request that is not sent again.
+        return is_retryable(error) or isinstance(
+            error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)
+        )
+
+    def attempt(timeout):
+        def send():
+            send_fn = getattr(session, method.lower())
+            return send_fn(url, timeout=(min(HTTP_CONNECT_TIMEOUT_SECONDS, timeout), timeout), **kwargs)
+        response = _hedged(send, label) if hedge and method == "GET" and HTTP_HEDGE_AFTER_SECONDS > 0 else send()
+        if response.status_code in retry_statuses:
+            raise RetryableResponse(response)
+        return response
+
+    try:
+        return call_with_retries(
+            dependency, label, attempt, HTTP_READ_TIMEOUT_SECONDS,
+            is_retryable=is_retryable, max_attempts=max_attempts, is_failure=is_failure
+        )
+    except RetryableResponse as e:
+        return e.response
@@ -0,0 +1,62 @@
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from config import PIPELINE_MAX_WORKERS
+
+# -------------------------------
+# Dependency-aware task runner
+# -------------------------------
+# Tasks are given as {name: (fn, [dependency names])}. Each fn is called with
+# a dict of its dependencies' results and starts as soon as those are done, so
+# independent I/O overlaps. When a task fails, tasks that depend on it are
+# never started. Tasks already running are allowed to finish, and then the
+# first failure is raised.
+
+_background_executor = ThreadPoolExecutor(max_workers=PIPELINE_MAX_WORKERS, thread_name_prefix="background")
+
+def submit(fn, *args, **kwargs):
+    # Start fn on the shared pool in a copy of the caller's context, so
+    # metrics recorded by fn land in the current stage.
+    return _background_executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+def run_task_graph(tasks, max_workers=PIPELINE_MAX_WORKERS):
+    for name, (_, deps) in tasks.items():
+        unknown = [dep for dep in deps if dep not in tasks]
+        if unknown:
+            raise ValueError(f"Task {name} depends on unknown tasks: {unknown}")
+
+    results = {}
+    failures = {}
+    running = {}
+    pending = dict(tasks)
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pipeline") as executor:
+        while pending or running:
+            for name, (fn, deps) in list(pending.items()):
+                if any(dep in failures for dep in deps):
+                    print(f"Skipping task {name}: a dependency failed.")
+                    failures[name] = None
+                    del pending[name]
+                elif all(dep in results for dep in deps):
+                    dep_results = {dep: results[dep] for dep in deps}
+                    future = executor.submit(contextvars.copy_context().run, fn, dep_results)
+                    running[future] = name
+                    del pending[name]
+
+            if not running:
+                if pending:
+                    raise ValueError(f"Task graph has a cycle: {sorted(pending)}")
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    print(f"Task {name} failed: {e}")
+                    failures[name] = e
+
+    first_failure = next((e for e in failures.values() if e is not None), None)
+    if first_failure is not None:
+        raise first_failure
+    return results
@@ -0,0 +1,156 @@
+import json
+import os
+import threading
+from google.api_core.exceptions import NotFound
+import metrics
+from clients import get_storage_client
+from config import (
+    PARAM_SOURCES,
+    PARAM_SOURCES_ENABLED,
+    SCHEMA_CACHE_BACKEND,
+    SCHEMA_CACHE_LOCAL_PATH,
+    SCHEMA_CACHE_GCS_BUCKET,
+    SCHEMA_CACHE_GCS_OBJECT
+)
+
+# -------------------------------
+# Processed table schema snapshots
+# -------------------------------
+# The processed table has thousands of columns, so the param field sets parsed
+# from its schema are cached per processed table:
+#     {"etag": "...", "modified_ms": 1700000000000, "sources": [...],
+#      "fields": {"event_params": ["my_param", ...]}, "altered_at_ms": None}
+# A snapshot is reused while the table's etag and modification time match.
+# After our own ALTER the new columns are added to the snapshot in place and
+# altered_at_ms is set; the next lookup adopts the new etag without re-parsing
+# as long as the table has not been modified since that ALTER finished.
+
+_lock = threading.Lock()
+_snapshots = {}
+
+def _modified_ms(table):
+    return int(table.modified.timestamp() * 1000) if table.modified else None
+
+def parse_param_fields(schema):
+    fields = {}
+    for source in PARAM_SOURCES_ENABLED:
+        column_suffix = PARAM_SOURCES[source]["column_suffix"]
+        columns = schema
+        record_name = PARAM_SOURCES[source].get("record")
+        if record_name:
+            # Record params are fields of the repeated record, not columns.
+            record = next((field for field in schema if field.name == record_name), None)
+            columns = record.fields if record is not None else []
+        fields[source] = set(
+            field.name[:-len(column_suffix)]
+            for field in columns
+            if field.name.endswith(column_suffix)
+        )
+    return fields
+
+def _is_current(snapshot, etag, modified_ms):
+    if snapshot.get("sources") != list(PARAM_SOURCES_ENABLED):
+        return False
+    if snapshot["etag"] == etag and snapshot["modified_ms"] == modified_ms:
+        return True
+    altered_at_ms = snapshot.get("altered_at_ms")
+    return altered_at_ms is not None and modified_ms is not None and modified_ms <= altered_at_ms
+
+def get_processed_fields(client, prop):
+    table_id = prop["processed_table_id"]
+    with metrics.timed("get_table"):
+        table = client.get_table(table_id)
+    etag, modified_ms = table.etag, _modified_ms(table)
+
+    snapshot = _get_snapshot(prop)
+    if snapshot and _is_current(snapshot, etag, modified_ms):
+        print(f"Processed table schema unchanged for {table_id}; using cached snapshot.")
+        metrics.record_row_count("schema_cache_hit", 1)
+        if snapshot["etag"] != etag or snapshot.get("altered_at_ms") is not None:
+            snapshot = {**snapshot, "etag": etag, "modified_ms": modified_ms, "altered_at_ms": None}
+            _put_snapshot(prop, snapshot)
+        return {source: set(names) for source, names in snapshot["fields"].items()}
+
+    metrics.record_row_count("schema_cache_hit", 0)
+    with metrics.timed("parse_schema"):
+        fields = parse_param_fields(table.schema)
+    _put_snapshot(prop, {
+        "etag": etag,
+        "modified_ms": modified_ms,
+        "sources": list(PARAM_SOURCES_ENABLED),
+        "fields": {source: sorted(names) for source, names in fields.items()},
+        "altered_at_ms": None,
+    })
+    return fields
+
+def record_added_columns(prop, added_columns, altered_at):
+    # added_columns: iterable of (source, param_name) just added by ALTER TABLE.
+    snapshot = _get_snapshot(prop)
+    if not snapshot:
+        return
+    fields = {source: set(names) for source, names in snapshot["fields"].items()}
+    for source, name in added_columns:
+        fields.setdefault(source, set()).add(name)
+    altered_at_ms = int(altered_at.timestamp() * 1000) if altered_at else None
+    _put_snapshot(prop, {
+        **snapshot,
+        "fields": {source: sorted(names) for source, names in fields.items()},
+        # Without the job end time the snapshot cannot be revalidated cheaply,
+        # so the next lookup re-parses.
+        "altered_at_ms": altered_at_ms,
+        "etag": snapshot["etag"] if altered_at_ms else None,
+    })
+
+# -------------------------------
+# Snapshot storage
+# -------------------------------
+def _get_snapshot(prop):
+    table_id = prop["processed_table_id"]
+    with _lock:
+        if table_id in _snapshots:
+            return _snapshots[table_id]
+    snapshot = _load_persisted_snapshot(prop)
+    if snapshot:
+        with _lock:
+            _snapshots.setdefault(table_id, snapshot)
+    return snapshot
+
+def _put_snapshot(prop, snapshot):
+    with _lock:
+        _snapshots[prop["processed_table_id"]] = snapshot
+    try:
+        _persist_snapshot(prop, snapshot)
+    except Exception as e:
+        # The in-memory snapshot is still valid; only cold starts lose it.
+        print(f"[WARN] Failed to persist schema snapshot: {e}")
+
+def _load_persisted_snapshot(prop):
+    try:
+        if SCHEMA_CACHE_BACKEND == "local":
+            path = SCHEMA_CACHE_LOCAL_PATH.format(property_id=prop["property_id"])
+            if not os.path.exists(path):
+                return None
+            with open(path) as f:
+                return json.load(f)
+        if SCHEMA_CACHE_BACKEND == "gcs":
+            blob = _gcs_blob(prop)
+            return json.loads(blob.download_as_text())
+    except NotFound:
+        return None
+    except Exception as e:
+        print(f"[WARN] Ignoring unreadable schema snapshot: {e}")
+    return None
+
+def _persist_snapshot(prop, snapshot):
+    if SCHEMA_CACHE_BACKEND == "local":
+        path = SCHEMA_CACHE_LOCAL_PATH.format(property_id=prop["property_id"])
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, path)
+    elif SCHEMA_CACHE_BACKEND == "gcs":
+        _gcs_blob(prop).upload_from_string(json.dumps(snapshot), content_type="application/json")
+
+def _gcs_blob(prop):
+    bucket = get_storage_client().bucket(SCHEMA_CACHE_GCS_BUCKET)
+    return bucket.blob(SCHEMA_CACHE_GCS_OBJECT.format(property_id=prop["property_id"]))
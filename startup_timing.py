@@ -0,0 +1,57 @@
+import importlib
+import json
+import os
+import sys
+import threading
+import time
+
+# -------------------------------
+# Cold-start timing
+# -------------------------------
+# Heavy modules are imported through timed_import() the first time they are
+# needed, and client construction is recorded with record_init(). The
+# collected timings are logged as a single JSON entry whenever an invocation
+# added new ones, so cold-start cost can be compared between deploys.
+
+PROCESS_START = time.perf_counter()
+
+_lock = threading.Lock()
+_import_timings_ms = {}
+_init_timings_ms = {}
+_logged_entry_count = 0
+
+def timed_import(module_name):
+    module = sys.modules.get(module_name)
+    if module is not None:
+        return module
+    start = time.perf_counter()
+    module = importlib.import_module(module_name)
+    elapsed_ms = round((time.perf_counter() - start) * 1000, 2)
+    with _lock:
+        _import_timings_ms.setdefault(module_name, elapsed_ms)
+    return module
+
+def record_init(name, start):
+    elapsed_ms = round((time.perf_counter() - start) * 1000, 2)
+    with _lock:
+        _init_timings_ms.setdefault(name, elapsed_ms)
+
+def get_startup_report():
+    with _lock:
+        return {
+            "revision": os.environ.get("K_REVISION"),
+            "process_uptime_ms": round((time.perf_counter() - PROCESS_START) * 1000, 2),
+            "imports_ms": dict(_import_timings_ms),
+            "total_import_ms": round(sum(_import_timings_ms.values()), 2),
+            "init_ms": dict(_init_timings_ms),
+            "total_init_ms": round(sum(_init_timings_ms.values()), 2),
+        }
+
+def log_startup_report_if_changed():
+    global _logged_entry_count
+    with _lock:
+        entry_count = len(_import_timings_ms) + len(_init_timings_ms)
+        if entry_count == _logged_entry_count:
+            return
+        _logged_entry_count = entry_count
+    print(json.dumps({"severity": "INFO", "message": "startup_timing_report", **get_startup_report()}))
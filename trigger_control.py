@@ -0,0 +1,187 @@
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from clients import get_storage_client
+from startup_timing import timed_import
+from config import (
+    TRIGGER_STATE_BACKEND,
+    TRIGGER_STATE_GCS_BUCKET,
+    TRIGGER_LEASE_TTL_SECONDS,
+    TRIGGER_SEEN_MESSAGE_CACHE_SIZE
+)
+
+# -------------------------------
+# Trigger dedupe, leases and coalescing
+# -------------------------------
+# Shared state, kept in GCS (or in process for local testing):
+#   triggers/messages/<message_id>                  a Pub/Sub message that was fully handled
+#   triggers/leases/<property_id>                   the run currently holding the property
+#   triggers/pending/<property_id>                  a trigger arrived while the lease was held
+#   triggers/coalesced/<property_id>/<message_id>   that trigger was folded into the pending flag
+# A trigger that finds the lease held sets the pending flag and is nacked.
+# The lease holder picks the flag up and runs once more, so a burst of
+# notifications collapses into at most one follow-up run. When the redelivered
+# trigger later gets the lease and finds the flag already consumed, it was
+# covered by that follow-up and is acknowledged without running. If the holder
+# died or ran out of time, the flag is still set and the redelivered trigger
+# runs. The bucket is created by cloudbuild.yaml with a lifecycle rule that
+# expires triggers/messages/ and triggers/coalesced/ after a few days.
+
+_local_lock = threading.Lock()
+_local_seen = OrderedDict()
+_local_leases = {}
+_local_pending = set()
+_local_coalesced = set()
+
+def new_holder_id():
+    return uuid.uuid4().hex
+
+def _blob(name):
+    return get_storage_client().bucket(TRIGGER_STATE_GCS_BUCKET).blob(f"triggers/{name}")
+
+# -------------------------------
+# Message dedupe
+# -------------------------------
+def is_message_processed(message_id):
+    if not message_id:
+        return False
+    if TRIGGER_STATE_BACKEND == "local":
+        with _local_lock:
+            return message_id in _local_seen
+    return _blob(f"messages/{message_id}").exists()
+
+def mark_message_processed(message_id):
+    # Only called once the message was handled successfully, so a failed run
+    # is still redelivered and retried.
+    if not message_id:
+        return
+    if TRIGGER_STATE_BACKEND == "local":
+        with _local_lock:
+            _local_seen[message_id] = time.time()
+            while len(_local_seen) > TRIGGER_SEEN_MESSAGE_CACHE_SIZE:
+                _local_seen.popitem(last=False)
+        return
+    _blob(f"messages/{message_id}").upload_from_string("")
+
+# -------------------------------
+# Per-property lease
+# -------------------------------
+def acquire_lease(property_id, holder):
+    # Returns a lease token, or None if another run holds an unexpired lease.
+    now = time.time()
+    if TRIGGER_STATE_BACKEND == "local":
+        with _local_lock:
+            current = _local_leases.get(property_id)
+            if current and current["expires_at"] > now:
+                return None
+            _local_leases[property_id] = {"holder": holder, "expires_at": now + TRIGGER_LEASE_TTL_SECONDS}
+            return holder
+
+    exceptions = timed_import("google.api_core.exceptions")
+    NotFound, PreconditionFailed = exceptions.NotFound, exceptions.PreconditionFailed
+    blob = _blob(f"leases/{property_id}")
+    payload = json.dumps({"holder": holder, "expires_at": now + TRIGGER_LEASE_TTL_SECONDS})
+    for _ in range(2):
+        try:
+            # Creation only succeeds if the object does not exist yet.
+            blob.upload_from_string(payload, if_generation_match=0)
+            return blob.generation
+        except PreconditionFailed:
+            pass
+        try:
+            blob.reload()
+            current = json.loads(blob.download_as_text(if_generation_match=blob.generation))
+        except (NotFound, PreconditionFailed):
+            continue
+        if current.get("expires_at", 0) > now:
+            return None
+        # The previous holder died without releasing; take the lease over.
+        print(f"[WARN] Breaking expired lease on property {property_id} held by {current.get('holder')}.")
+        try:
+            blob.delete(if_generation_match=blob.generation)
+        except (NotFound, PreconditionFailed):
+            pass
+    return None
+
+def release_lease(property_id, token):
+    if TRIGGER_STATE_BACKEND == "local":
+        with _local_lock:
+            current = _local_leases.get(property_id)
+            if current and current["holder"] == token:
+                del _local_leases[property_id]
+        return
+    exceptions = timed_import("google.api_core.exceptions")
+    try:
+        _blob(f"leases/{property_id}").delete(if_generation_match=token)
+    except (exceptions.NotFound, exceptions.PreconditionFailed):
+        # Expired and taken over by another run; that run owns it now.
+        pass
+
+# -------------------------------
+# Pending-trigger flag
+# -------------------------------
+def mark_pending(property_id):
+    if TRIGGER_STATE_BACKEND == "local":
+        with _local_lock:
+            _local_pending.add(property_id)
+        return
+    _blob(f"pending/{property_id}").upload_from_string("")
+
+def consume_pending(property_id):
+    # Clears the flag and reports whether it was set.
+    if TRIGGER_STATE_BACKEND == "local":
+        with _local_lock:
+            if property_id in _local_pending:
+                _local_pending.discard(property_id)
+                return True
+            return False
+    exceptions = timed_import("google.api_core.exceptions")
+    try:
+        _blob(f"pending/{property_id}").delete()
+        return True
+    except exceptions.NotFound:
+        return False
+
+def is_pending(property_id):
+    if TRIGGER_STATE_BACKEND == "local":
+        with _local_lock:
+            return property_id in _local_pending
+    return _blob(f"pending/{property_id}").exists()
+
+# -------------------------------
+# Coalesced triggers
+# -------------------------------
+def mark_coalesced(property_id, message_id):
+    # Records that the message was folded into the pending flag. Returns False
+    # if it already was on an earlier delivery.
+    if TRIGGER_STATE_BACKEND == "local":
+        with _local_lock:
+            if (property_id, message_id) in _local_coalesced:
+                return False
+            _local_coalesced.add((property_id, message_id))
+            return True
+    exceptions = timed_import("google.api_core.exceptions")
+    try:
+        _blob(f"coalesced/{property_id}/{message_id}").upload_from_string("", if_generation_match=0)
+        return True
+    except exceptions.PreconditionFailed:
+        return False
+
+def is_coalesced(property_id, message_id):
+    if TRIGGER_STATE_BACKEND == "local":
+        with _local_lock:
+            return (property_id, message_id) in _local_coalesced
+    return _blob(f"coalesced/{property_id}/{message_id}").exists()
+
+def clear_coalesced(property_id, message_id):
+    if TRIGGER_STATE_BACKEND == "local":
+        with _local_lock:
+            _local_coalesced.discard((property_id, message_id))
+        return
+    exceptions = timed_import("google.api_core.exceptions")
+    try:
+        _blob(f"coalesced/{property_id}/{message_id}").delete()
+    except exceptions.NotFound:
+        pass
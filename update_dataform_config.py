@@ -1,121 +1,154 @@
 import requests
 import base64
-import re
-from google.cloud import secretmanager, bigquery
-from google.auth import default
-from google.auth.transport.requests import Request as AuthRequest
-from google.api_core.exceptions import NotFound, GoogleAPICallError
+import threading
+import metrics
+from config_js import find_array, insert_entries
+from clients import get_github_token, get_http_session, get_oauth_token, invalidate_github_token
+from properties import get_property
+from resilience import http_request
+from workflow_tracker import track_invocation
 from config import (
+    DATAFORM_INVOCATION_MODE,
+    DATAFORM_TRACK_INVOCATIONS,
+    PARAM_SOURCES,
+    PARAM_SOURCES_ENABLED,
     PROJECT_ID,
-    WRITE_PROJECT_ID,
-    TEMP_DATASET,
-    TEMP_TABLE,
-    REPO,
-    FILE_PATH,
-    BRANCH,
     COMMIT_MESSAGE,
-    REGION,
-    REPO_ID,
-    RELEASE_ID,
-    WORKFLOW_ID
+    GITHUB_CONFLICT_MAX_ATTEMPTS,
+    REGION
 )
 
-def get_github_token():
-    print("[INFO] Accessing GitHub token from Secret Manager...")
-    client = secretmanager.SecretManagerServiceClient()
-    secret_name = f"projects/{PROJECT_ID}/secrets/dataform-github-access-token/versions/latest"
-    try:
-        response = client.access_secret_version(request={"name": secret_name})
-        token = response.payload.data.decode("utf-8").strip()
-        print("[SUCCESS] GitHub token retrieved.")
-        return token
-    except Exception as e:
-        raise Exception(f"[ERROR] Failed to access GitHub token from Secret Manager: {e}")
-
-def fetch_missing_event_params():
-    print("[INFO] Fetching missing event parameters from BigQuery...")
-    client = bigquery.Client(project=WRITE_PROJECT_ID)
-    query = f"""
-        SELECT DISTINCT field_name, field_type
-        FROM `{WRITE_PROJECT_ID}.{TEMP_DATASET}.{TEMP_TABLE}`
-        WHERE field_type IS NOT NULL AND UPPER(field_type) != 'UNKNOWN'
-    """
-    try:
-        result = client.query(query).result()
-        params = [{"name": row["field_name"], "type": row["field_type"]} for row in result]
-        print(f"[SUCCESS] Retrieved {len(params)} missing params.")
-        return params
-    except NotFound:
-        raise Exception(f"[ERROR] Temp table `{TEMP_TABLE}` not found in dataset `{TEMP_DATASET}`.")
-    except GoogleAPICallError as api_err:
-        raise Exception(f"[ERROR] BigQuery API error: {api_err}")
-    except Exception as e:
-        raise Exception(f"[ERROR] General exception while fetching missing params: {e}")
+# Type mapping from BigQuery to Dataform
+DATAFORM_TYPE_MAPPING = {
+    "STRING": "string",
+    "INT64": "int",
+    "INTEGER": "int",
+    "FLOAT64": "decimal",
+    "FLOAT": "decimal",
+    "BOOL": "string",
+    "BOOLEAN": "string"
+}
+
+def merge_params_into_array(content, array_name, fields):
+    array = find_array(content, array_name)
+    if array is None:
+        raise Exception(f"[ERROR] {array_name} not found in config.js.")
+
+    existing_names = {entry["fields"]["name"] for entry in array["entries"] if "name" in entry["fields"]}
+    added_params = []
+    for field in fields:
+        p_name, p_type = field["field_name"], field["field_type"]
+        if not p_name or not p_type or p_type.strip().upper() == "UNKNOWN":
+            continue
+        if p_name in existing_names:
+            continue
+
+        # Convert BigQuery type to Dataform type
+        dataform_type = DATAFORM_TYPE_MAPPING.get(p_type.upper(), "string")
+
+        # Use parameter name as-is for extraction, no column suffix in renameTo
+        existing_names.add(p_name)
+        added_params.append({"name": p_name, "type": dataform_type, "renameTo": p_name})
+
+    # Only the new entries are inserted; existing entries, comments and
+    # formatting are left as they are.
+    updated_content = insert_entries(content, array, added_params)
+    return updated_content, added_params, len(existing_names)
+
+# -------------------------------
+# Conditional GET cache
+# -------------------------------
+# config.js responses are cached per URL with their ETag. A 304 answer to
+# If-None-Match reuses the cached body and does not count against the GitHub
+# rate limit. Entries are dropped after a PUT so the next fetch is fresh.
+_contents_cache_lock = threading.Lock()
+_contents_cache = {}
+
+def fetch_config_file(session, url, headers):
+    with _contents_cache_lock:
+        cached = _contents_cache.get(url)
+    request_headers = dict(headers)
+    if cached:
+        request_headers["If-None-Match"] = cached["etag"]
+    with metrics.timed("github_get_config"):
+        resp = http_request(session, "GET", url, "github", "github_get_config", hedge=True, headers=request_headers)
+    if resp.status_code == 304 and cached:
+        print("[INFO] config.js unchanged since last fetch (304). Using cached copy.")
+        return cached["file_info"]
+    if resp.status_code == 401:
+        # The cached token may have been rotated; fetch it again next run.
+        invalidate_github_token()
+    resp.raise_for_status()
+    file_info = resp.json()
+    etag = resp.headers.get("ETag")
+    if etag:
+        with _contents_cache_lock:
+            _contents_cache[url] = {"etag": etag, "file_info": file_info}
+    return file_info
 
-def update_config_file_with_new_params():
-    token = get_github_token()
-    headers = {
+def invalidate_config_cache(url):
+    with _contents_cache_lock:
+        _contents_cache.pop(url, None)
+
+def get_github_headers():
+    with metrics.timed("get_github_token"):
+        token = get_github_token()
+    return {
         "Authorization": f"token {token}",
         "Accept": "application/vnd.github.v3+json"
     }
 
-    get_url = f"https://api.github.com/repos/{REPO}/contents/{FILE_PATH}?ref={BRANCH}"
+def update_config_file_with_new_params(missing_fields, prop=None):
+    prop = prop or get_property()
+    prepared = prepare_config_update(missing_fields, prop)
+    if prepared["status"] != "READY_TO_COMMIT":
+        return prepared
+    return commit_config_update(prepared, prop)
+
+def prepare_config_update(missing_fields, prop=None):
+    # Fetches config.js and builds the updated content. Only needs the diff,
+    # so it can run while the processed table is being altered.
+    prop = prop or get_property()
+    session = get_http_session()
+    headers = get_github_headers()
+
+    get_url = f"https://api.github.com/repos/{prop['repo']}/contents/{prop['file_path']}?ref={prop['branch']}"
     print(f"[INFO] Fetching config.js from GitHub: {get_url}")
 
     try:
-        resp = requests.get(get_url, headers=headers)
-        resp.raise_for_status()
+        file_info = fetch_config_file(session, get_url, headers)
     except requests.exceptions.RequestException as e:
         raise Exception(f"[ERROR] Failed to fetch config.js: {e}")
 
-    file_info = resp.json()
     sha = file_info["sha"]
     content = base64.b64decode(file_info["content"]).decode("utf-8")
 
-    match = re.search(
-        r'^(?!\s*//)\s*CUSTO?M_EVENT_PARAMS_ARRAY:\s*\[(.*?)\](\s*,)',
-        content,
-        re.DOTALL | re.MULTILINE
-    )
-    if not match:
-        raise Exception("[ERROR] CUSTOM_EVENT_PARAMS_ARRAY not found in config.js.")
-
-    existing_array_content = match.group(1)
-    param_map = {}
-    for entry in re.findall(
-        r'\{\s*name:\s*"(.*?)"\s*,\s*type:\s*"(.*?)"(?:\s*,\s*renameTo:\s*"(.*?)")?\s*\}',
-        existing_array_content
-    ):
-        name, p_type, rename_to = entry if len(entry) == 3 else (entry[0], entry[1], None)
-        param_map[name] = {"name": name, "type": p_type, "renameTo": rename_to or name}
-
-    new_params = fetch_missing_event_params()
+    # -------------------------------
+    # Merge New Params into Each Source's Array
+    # -------------------------------
+    updated_content = content
     added_params = []
-
-    # Type mapping from BigQuery to Dataform
-    DATAFORM_TYPE_MAPPING = {
-        "STRING": "string",
-        "INT64": "int", 
-        "INTEGER": "int",
-        "FLOAT64": "decimal",
-        "FLOAT": "decimal",
-        "BOOL": "string",
-        "BOOLEAN": "string"
-    }
-    
-    for param in new_params:
-        p_name, p_type = param["name"], param["type"]
-        if not p_name or not p_type or p_type.strip().upper() == "UNKNOWN":
+    skipped_fields = []
+    total_unique_params = 0
+    for source in PARAM_SOURCES_ENABLED:
+        source_fields = [
+            field for field in missing_fields
+            if (field.get("source") or "event_params") == source
+        ]
+        if not source_fields:
             continue
-        if p_name in param_map:
+        array_name = PARAM_SOURCES[source]["config_array"]
+        if find_array(updated_content, array_name) is None:
+            # Dataform would never fill these columns, so the pipeline leaves
+            # them out of the ALTER as well.
+            print(f"[WARN] {array_name} not found in config.js. Skipping {len(source_fields)} {source} params.")
+            skipped_fields.extend(source_fields)
             continue
-        
-        # Convert BigQuery type to Dataform type
-        dataform_type = DATAFORM_TYPE_MAPPING.get(p_type.upper(), "string")
-        
-        # Use parameter name as-is for extraction, no _event_param suffix in renameTo
-        param_map[p_name] = {"name": p_name, "type": dataform_type, "renameTo": p_name}
-        added_params.append(param_map[p_name])
+        updated_content, source_added, source_total = merge_params_into_array(
+            updated_content, array_name, source_fields
+        )
+        added_params.extend({**param, "source": source} for param in source_added)
+        total_unique_params += source_total
 
     if not added_params:
         print("[INFO] No new parameters to add.")
@@ -123,24 +156,10 @@ def update_config_file_with_new_params():
             "status": "NO_CHANGE",
             "message": "No updates made. Config is already up-to-date.",
             "new_params_added_count": 0,
-            "total_unique_params_in_config": len(param_map)
+            "total_unique_params_in_config": total_unique_params,
+            "skipped_fields": skipped_fields
         }
 
-    sorted_params = sorted(param_map.values(), key=lambda x: x["name"])
-    formatted = [
-        f'    {{ name: "{p["name"]}", type: "{p["type"]}", renameTo: "{p["renameTo"]}" }}'
-        for p in sorted_params
-    ]
-    new_array_block = f'CUSTOM_EVENT_PARAMS_ARRAY: [\n' + ",\n".join(formatted) + "\n],"
-
-    updated_content, count = re.subn(
-        r'^(?!\s*//)\s*CUSTO?M_EVENT_PARAMS_ARRAY:\s*\[.*?\](\s*,)',
-        new_array_block,
-        content,
-        count=1,
-        flags=re.DOTALL | re.MULTILINE
-    )
-
     if updated_content == content:
         print("[INFO] Content unchanged after processing.")
         return {
@@ -148,27 +167,64 @@ def update_config_file_with_new_params():
             "message": "Config unchanged. Format remained the same.",
             "new_params_added_count": 0,
             "new_params_added": [],
-            "total_unique_params_in_config": len(sorted_params)
+            "total_unique_params_in_config": total_unique_params,
+            "skipped_fields": skipped_fields
         }
 
-    updated_b64 = base64.b64encode(updated_content.encode("utf-8")).decode("utf-8")
+    return {
+        "status": "READY_TO_COMMIT",
+        "url": get_url,
+        "sha": sha,
+        "fields": missing_fields,
+        "updated_content": updated_content,
+        "added_params": added_params,
+        "total_unique_params_in_config": total_unique_params,
+        "skipped_fields": skipped_fields
+    }
+
+def commit_config_update(prepared, prop=None):
+    # Pushes the prepared config.js and triggers Dataform. Must run after the
+    # processed table has the new columns.
+    prop = prop or get_property()
+    session = get_http_session()
+    headers = get_github_headers()
+    get_url = prepared["url"]
 
     try:
-        print("[INFO] Committing updated config.js to GitHub...")
-        put_resp = requests.put(get_url, headers=headers, json={
-            "message": COMMIT_MESSAGE,
-            "content": updated_b64,
-            "sha": sha,
-            "branch": BRANCH
-        })
+        for attempt in range(1, GITHUB_CONFLICT_MAX_ATTEMPTS + 1):
+            print("[INFO] Committing updated config.js to GitHub...")
+            updated_b64 = base64.b64encode(prepared["updated_content"].encode("utf-8")).decode("utf-8")
+            with metrics.timed("github_put_config"):
+                # Not resent after a read timeout: if the first PUT landed,
+                # the resend would get a 409 and Dataform would not be invoked.
+                put_resp = http_request(
+                    session, "PUT", get_url, "github", "github_put_config", idempotent=False,
+                    headers=headers, json={
+                        "message": COMMIT_MESSAGE,
+                        "content": updated_b64,
+                        "sha": prepared["sha"],
+                        "branch": prop["branch"]
+                    }
+                )
+            invalidate_config_cache(get_url)
+            if put_resp.status_code != 409 or attempt == GITHUB_CONFLICT_MAX_ATTEMPTS:
+                break
+            # config.js changed since it was fetched. Merge the same fields
+            # into the current version instead of failing after the ALTER.
+            print(f"[WARN] config.js changed since it was fetched (409, attempt {attempt}). Re-fetching and re-applying...")
+            prepared = prepare_config_update(prepared["fields"], prop)
+            if prepared["status"] != "READY_TO_COMMIT":
+                print("[INFO] The current config.js already contains the new params.")
+                return {**prepared, "sha_conflicts": attempt}
         put_resp.raise_for_status()
-        print("[SUCCESS] GitHub config.js updated.")
+        commit_sha = put_resp.json().get("commit", {}).get("sha")
+        print(f"[SUCCESS] GitHub config.js updated (commit {commit_sha}).")
     except requests.exceptions.RequestException as e:
         raise Exception(f"[ERROR] GitHub PUT request failed: {e}")
 
     try:
         print("[INFO] Syncing and invoking Dataform workflow...")
-        sync_result = sync_and_execute_dataform()
+        sync_result = sync_and_execute_dataform(prop, commit_sha=commit_sha)
         print("[SUCCESS] Dataform sync and workflow execution complete.")
     except Exception as sync_error:
         raise Exception(f"[ERROR] Config updated but Dataform sync failed: {sync_error}")
@@ -176,43 +232,91 @@ def update_config_file_with_new_params():
     return {
         "status": "SUCCESS",
         "message": "Config updated successfully and Dataform workflow triggered.",
-        "new_params_added_count": len(added_params),
-        "new_params_added": [p["name"] for p in added_params],
-        "total_unique_params_in_config": len(sorted_params),
+        "new_params_added_count": len(prepared["added_params"]),
+        "new_params_added": [p["name"] for p in prepared["added_params"]],
+        "total_unique_params_in_config": prepared["total_unique_params_in_config"],
+        "sha_conflicts": attempt - 1,
         "dataform_sync": sync_result
     }
 
-def sync_and_execute_dataform():
+def sync_and_execute_dataform(prop=None, commit_sha=None):
     print("[DEBUG] Starting sync_and_execute_dataform()")
+    prop = prop or get_property()
+    repo_id = prop["repo_id"]
+    session = get_http_session()
 
     try:
-        creds, _ = default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
-        creds.refresh(AuthRequest())
-        token = creds.token
+        with metrics.timed("get_oauth_token"):
+            token = get_oauth_token()
 
-        base_url = f"https://dataform.googleapis.com/v1beta1/projects/{PROJECT_ID}/locations/{REGION}/repositories/{REPO_ID}"
+        base_url = f"https://dataform.googleapis.com/v1beta1/projects/{PROJECT_ID}/locations/{REGION}/repositories/{repo_id}"
         headers = {
             "Authorization": f"Bearer {token}",
             "Content-Type": "application/json"
         }
-        
-        # Invoke workflow with fresh config
-        print("[INFO] Invoking Dataform workflow using workflowInvocations API...")
-        workflow_payload = {
-            "workflowConfig": f"projects/{PROJECT_ID}/locations/{REGION}/repositories/{REPO_ID}/workflowConfigs/{WORKFLOW_ID}"
-        }
+        workflow_config_name = f"projects/{PROJECT_ID}/locations/{REGION}/repositories/{repo_id}/workflowConfigs/{prop['workflow_id']}"
+
+        compilation_result = None
+        if DATAFORM_INVOCATION_MODE == "compilation_result" and commit_sha:
+            # Compile the exact commit that was just pushed, then run the
+            # workflow config's targets from that compilation.
+            print(f"[INFO] Compiling Dataform repository at {commit_sha}...")
+            with metrics.timed("dataform_compile"):
+                # A repeated compilation is harmless, so any failure is retried.
+                compile_resp = http_request(
+                    session, "POST", f"{base_url}/compilationResults", "dataform", "dataform_compile",
+                    idempotent=True, headers=headers, json={"gitCommitish": commit_sha}
+                )
+            if compile_resp.status_code != 200:
+                raise Exception(f"[ERROR] Compilation failed: {compile_resp.status_code} - {compile_resp.text}")
+            compilation_result = compile_resp.json()
+            if compilation_result.get("compilationErrors"):
+                raise Exception(f"[ERROR] Compilation has errors: {compilation_result['compilationErrors']}")
+
+            with metrics.timed("dataform_get_workflow_config"):
+                config_resp = http_request(
+                    session, "GET", f"https://dataform.googleapis.com/v1beta1/{workflow_config_name}",
+                    "dataform", "dataform_get_workflow_config", hedge=True, headers=headers
+                )
+            if config_resp.status_code != 200:
+                raise Exception(f"[ERROR] Failed to read workflow config: {config_resp.status_code} - {config_resp.text}")
+            workflow_payload = {
+                "compilationResult": compilation_result["name"],
+                "invocationConfig": config_resp.json().get("invocationConfig", {})
+            }
+            print(f"[INFO] Invoking Dataform workflow from compilation result {compilation_result['name']}...")
+        else:
+            print("[INFO] Invoking Dataform workflow using workflowInvocations API...")
+            workflow_payload = {"workflowConfig": workflow_config_name}
 
         workflow_url = f"{base_url}/workflowInvocations"
-        workflow_resp = requests.post(workflow_url, headers=headers, json=workflow_payload)
+        with metrics.timed("dataform_invoke_workflow"):
+            workflow_resp = http_request(
+                session, "POST", workflow_url, "dataform", "dataform_invoke_workflow",
+                headers=headers, json=workflow_payload
+            )
         print(f"[DEBUG] Workflow invocation status: {workflow_resp.status_code}")
         print(f"[DEBUG] Response: {workflow_resp.text}")
 
         if workflow_resp.status_code != 200:
             raise Exception(f"[ERROR] Workflow invocation failed: {workflow_resp.status_code} - {workflow_resp.text}")
 
+        invocation = workflow_resp.json()
+        tracked = False
+        if DATAFORM_TRACK_INVOCATIONS and invocation.get("name"):
+            try:
+                track_invocation(invocation["name"], prop, commit_sha=commit_sha)
+                tracked = True
+            except Exception as e:
+                # The workflow is already running; only its tracking is lost.
+                print(f"[WARN] Failed to record Dataform invocation {invocation['name']}: {e}")
+
         return {
             "workflow_invocation_status": workflow_resp.status_code,
-            "workflow_invocation_response": workflow_resp.json()
+            "workflow_invocation_response": invocation,
+            "compilation_result": compilation_result["name"] if compilation_result else None,
+            "commit_sha": commit_sha,
+            "tracked": tracked
         }
 
     except Exception as e:
@@ -0,0 +1,155 @@
+import json
+from datetime import datetime, timezone
+from google.cloud import bigquery
+from google.api_core.exceptions import NotFound
+import metrics
+from clients import get_bigquery_client, get_http_session, get_oauth_token
+from properties import get_state_table_id
+from resilience import http_request
+from config import (
+    DATAFORM_INVOCATION_TABLE,
+    DATAFORM_POLL_TIMEOUT_SECONDS
+)
+
+# -------------------------------
+# Dataform invocation tracking
+# -------------------------------
+# Cloud Functions throttles an instance's CPU once the response is sent and
+# may shut it down, so nothing polls in the background. Each invocation is
+# appended to a per-property log table as RUNNING when it is started. Every
+# later pipeline run for the property polls its running invocations once, as
+# does a scheduled poll-only message (poll_dataform=true, see main.py), and
+# appends the new state when it changes. The latest row per invocation wins.
+# The final state and Dataform's own start and end times are also logged as
+# one JSON line and passed to the on_complete hook. An invocation still
+# running after DATAFORM_POLL_TIMEOUT_SECONDS is recorded as POLL_TIMEOUT.
+
+TERMINAL_STATES = {"SUCCEEDED", "FAILED", "CANCELLED", "POLL_TIMEOUT"}
+DATAFORM_API = "https://dataform.googleapis.com/v1beta1"
+
+STATE_TABLE_SCHEMA = [
+    bigquery.SchemaField("invocation", "STRING"),
+    bigquery.SchemaField("property_id", "STRING"),
+    bigquery.SchemaField("state", "STRING"),
+    bigquery.SchemaField("commit_sha", "STRING"),
+    bigquery.SchemaField("submitted_at", "TIMESTAMP"),
+    bigquery.SchemaField("start_time", "STRING"),
+    bigquery.SchemaField("end_time", "STRING"),
+    bigquery.SchemaField("duration_seconds", "FLOAT64"),
+    bigquery.SchemaField("updated_at", "TIMESTAMP"),
+]
+
+def _append_rows(client, prop, rows):
+    now = datetime.now(timezone.utc).isoformat()
+    job_config = bigquery.LoadJobConfig(
+        schema=STATE_TABLE_SCHEMA,
+        write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+    )
+    client.load_table_from_json(
+        [{**row, "updated_at": now} for row in rows],
+        get_state_table_id(prop, DATAFORM_INVOCATION_TABLE),
+        job_config=job_config
+    ).result()
+
+def track_invocation(invocation_name, prop, commit_sha=None):
+    client = get_bigquery_client(prop["write_project_id"])
+    _append_rows(client, prop, [{
+        "invocation": invocation_name,
+        "property_id": prop["property_id"],
+        "state": "RUNNING",
+        "commit_sha": commit_sha,
+        "submitted_at": datetime.now(timezone.utc).isoformat(),
+        "start_time": None,
+        "end_time": None,
+        "duration_seconds": None,
+    }])
+    print(f"[INFO] Tracking Dataform invocation: {invocation_name}")
+
+def _load_running(client, prop):
+    query = f"""
+        SELECT invocation, property_id, state, commit_sha, submitted_at
+        FROM `{get_state_table_id(prop, DATAFORM_INVOCATION_TABLE)}`
+        WHERE TRUE
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY invocation ORDER BY updated_at DESC) = 1
+            AND state NOT IN ({", ".join(f"'{state}'" for state in sorted(TERMINAL_STATES))})
+    """
+    try:
+        job = client.query(query)
+        rows = list(job.result())
+    except NotFound:
+        return []
+    metrics.record_query_job("load_dataform_invocations", job)
+    return [dict(row.items()) for row in rows]
+
+def _parse_time(value):
+    # Dataform timestamps carry nanoseconds; whole seconds are enough here.
+    return datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S") if value else None
+
+def poll_tracked_invocations(prop, on_complete=None):
+    # Polls each running invocation of the property once. Returns the ones
+    # still running and the outcomes of the ones that finished. Once the new
+    # states are saved, on_complete(outcome, still_running) is called for each
+    # finished invocation.
+    client = get_bigquery_client(prop["write_project_id"])
+    with metrics.timed("load_dataform_invocations"):
+        running = _load_running(client, prop)
+    still_running = []
+    completed = []
+    updates = []
+    for entry in running:
+        try:
+            # One attempt per run; the next run is the retry.
+            resp = http_request(
+                get_http_session(), "GET", f"{DATAFORM_API}/{entry['invocation']}",
+                "dataform", "dataform_poll_invocation", max_attempts=1,
+                headers={"Authorization": f"Bearer {get_oauth_token()}"}
+            )
+            resp.raise_for_status()
+            invocation = resp.json()
+            state = invocation.get("state", "STATE_UNSPECIFIED")
+        except Exception as e:
+            print(f"[WARN] Failed to poll Dataform invocation {entry['invocation']}: {e}")
+            invocation, state = {}, entry["state"]
+
+        tracked_seconds = (datetime.now(timezone.utc) - entry["submitted_at"]).total_seconds()
+        if state not in TERMINAL_STATES and tracked_seconds >= DATAFORM_POLL_TIMEOUT_SECONDS:
+            state = "POLL_TIMEOUT"
+        if state not in TERMINAL_STATES:
+            still_running.append(entry["invocation"])
+            if state != entry["state"]:
+                updates.append({**entry, "state": state})
+            continue
+
+        timing = invocation.get("invocationTiming", {})
+        start_time, end_time = timing.get("startTime"), timing.get("endTime")
+        duration = None
+        if start_time and end_time:
+            duration = (_parse_time(end_time) - _parse_time(start_time)).total_seconds()
+        outcome = {
+            "event": "dataform_invocation_complete",
+            "invocation": entry["invocation"],
+            "property_id": entry["property_id"],
+            "state": state,
+            "commit_sha": entry["commit_sha"],
+            "start_time": start_time,
+            "end_time": end_time,
+            "duration_seconds": duration,
+            "tracked_seconds": round(tracked_seconds, 1),
+        }
+        print(json.dumps(outcome))
+        completed.append(outcome)
+        updates.append({
+            **entry, "state": state, "start_time": start_time, "end_time": end_time, "duration_seconds": duration,
+        })
+
+    if updates:
+        _append_rows(client, prop, [
+            {**row, "submitted_at": row["submitted_at"].isoformat()} for row in updates
+        ])
+    if on_complete is not None:
+        for outcome in completed:
+            try:
+                on_complete(outcome, still_running)
+            except Exception as e:
+                print(f"[WARN] Completion hook failed for Dataform invocation {outcome['invocation']}: {e}")
+    return {"running": still_running, "completed": completed}